@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class CommsApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'comms_api'
+
+    def ready(self):
+        from comms_api import authentication  # noqa: F401 - rejestruje sygnały unieważniające cache
+        from comms_api import metrics  # noqa: F401 - licznik zapytań na każdym nowym połączeniu z bazą
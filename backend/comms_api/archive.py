@@ -0,0 +1,210 @@
+import functools
+import mmap
+import os
+import struct
+import zlib
+from datetime import datetime, timedelta, timezone as dt_timezone
+import msgpack
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from comms_api.models import Attachment, Message, MessageArchive
+
+# Plik archiwum jednej miesięcznej partycji:
+#   nagłówek | bloki | indeks bloków | indeks załączników
+# Blok to skompresowana zlib lista do BLOCK_MESSAGES wiadomości jednej rozmowy, posortowana po (timestamp, id).
+# Oba indeksy mają rekordy stałej długości posortowane po kluczu, więc czytelnik szuka w nich binarnie
+# bezpośrednio w zmapowanym pliku i rozpakowuje tylko bloki potrzebne do strony historii.
+MAGIC = b"CMSGARC1"
+HEADER = struct.Struct("<8sQQQQ")  # magic, offset indeksu bloków, liczba bloków, offset i liczba załączników
+BLOCK = struct.Struct("<QqQQII")  # conversation_id, timestamp i id pierwszej wiadomości, offset, długość, liczba
+ATTACHMENT = struct.Struct("<QQQ")  # id wiadomości, conversation_id, attachment_id
+BLOCK_MESSAGES = 256
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+ARCHIVES_CACHE_KEY = "message_archives"
+
+# Kolumny w kolejności, w jakiej trafiają do pliku
+COLUMNS = ("id", "conversation_id", "sender_id", "recipient_id", "content", "attachment_id", "file_type", "timestamp")
+
+
+def _micros(value):
+    return (value - EPOCH) // timedelta(microseconds=1)
+
+
+def _datetime(micros):
+    return EPOCH + timedelta(microseconds=micros)
+
+
+def write_archive(path, rows):
+    # rows: krotki COLUMNS posortowane po (conversation_id, timestamp, id); zapis przez plik tymczasowy,
+    # żeby przerwane archiwizowanie nie zostawiło uciętego pliku pod docelową nazwą
+    blocks = []
+    attachments = []
+    stats = {"count": 0, "first_id": None, "last_id": None}
+    tmp_path = f"{path}.tmp"
+
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, 0, 0, 0, 0))
+        block = []
+        block_conversation = None
+
+        def flush():
+            data = zlib.compress(msgpack.packb(block), 6)
+            blocks.append((block_conversation, block[0][6], block[0][0], f.tell(), len(data), len(block)))
+            f.write(data)
+            block.clear()
+
+        for message_id, conversation_id, sender_id, recipient_id, content, attachment_id, file_type, timestamp in rows:
+            conversation_id = conversation_id or 0
+            if block and (conversation_id != block_conversation or len(block) >= BLOCK_MESSAGES):
+                flush()
+            block_conversation = conversation_id
+            block.append([message_id, sender_id, recipient_id, content, attachment_id, file_type, _micros(timestamp)])
+            if attachment_id:
+                attachments.append((message_id, conversation_id, attachment_id))
+            stats["count"] += 1
+            stats["first_id"] = min(message_id, stats["first_id"] or message_id)
+            stats["last_id"] = max(message_id, stats["last_id"] or message_id)
+        if block:
+            flush()
+
+        index_offset = f.tell()
+        for entry in blocks:
+            f.write(BLOCK.pack(*entry))
+        attachments_offset = f.tell()
+        attachments.sort()
+        for entry in attachments:
+            f.write(ATTACHMENT.pack(*entry))
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, index_offset, len(blocks), attachments_offset, len(attachments)))
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(tmp_path, path)
+    return stats
+
+
+class ArchiveReader:
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._index_offset, self._blocks, self._attachments_offset, self._attachments = HEADER.unpack_from(
+            self._map
+        )
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a message archive")
+
+    def _block(self, i):
+        return BLOCK.unpack_from(self._map, self._index_offset + i * BLOCK.size)
+
+    def _lower_bound(self, conversation_id):
+        lo, hi = 0, self._blocks
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._block(mid)[0] < conversation_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _rows(self, offset, length):
+        return msgpack.unpackb(zlib.decompress(self._map[offset:offset + length]))
+
+    def messages_before(self, conversation_id, before=None, limit=50):
+        # Najnowsze najpierw, jak strona historii; before to (timestamp w mikrosekundach, id) albo None
+        found = []
+        i = self._lower_bound(conversation_id + 1) - 1
+        while i >= 0 and len(found) < limit:
+            block_conversation, first_timestamp, first_id, offset, length, _ = self._block(i)
+            if block_conversation != conversation_id:
+                break
+            i -= 1
+            if before is not None and (first_timestamp, first_id) >= before:
+                continue
+            for row in reversed(self._rows(offset, length)):
+                if before is None or (row[6], row[0]) < before:
+                    found.append(row)
+                    if len(found) == limit:
+                        break
+        return found
+
+    def find_attachment(self, message_id):
+        lo, hi = 0, self._attachments
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry = ATTACHMENT.unpack_from(self._map, self._attachments_offset + mid * ATTACHMENT.size)
+            if entry[0] == message_id:
+                return entry[1], entry[2]
+            if entry[0] < message_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+
+@functools.lru_cache(maxsize=64)
+def open_archive(name):
+    # Zmapowane pliki zostają otwarte między żądaniami; strony odczytuje i cache'uje system
+    return ArchiveReader(settings.MESSAGE_ARCHIVE_DIR / name)
+
+
+def get_archives():
+    # Lista (month, path, first_message_id, last_message_id) od najnowszego miesiąca. Zmienia się raz w miesiącu,
+    # a każda krótka strona historii o nią pyta, więc trzymamy ją w cache; pusta lista to typowy przypadek.
+    archives = cache.get(ARCHIVES_CACHE_KEY)
+    if archives is None:
+        archives = list(MessageArchive.objects.order_by("-month").values_list(
+            "month", "path", "first_message_id", "last_message_id"
+        ))
+        cache.set(ARCHIVES_CACHE_KEY, archives, None)
+    return archives
+
+
+def invalidate_archives():
+    cache.delete(ARCHIVES_CACHE_KEY)
+
+
+def archived_history(conversation_id, before=None, limit=50):
+    # Dalszy ciąg historii za najstarszą wiadomością w bazie; before to (datetime, id) ostatniej pokazanej
+    archives = get_archives()
+    if not archives:
+        return []
+    cursor = None
+    if before is not None:
+        archives = [archive for archive in archives if archive[0] <= before[0].date()]
+        cursor = (_micros(before[0]), before[1])
+
+    rows = []
+    for _, path, _, _ in archives:
+        rows += open_archive(path).messages_before(conversation_id, cursor, limit - len(rows))
+        if len(rows) >= limit:
+            break
+    if not rows:
+        return []
+
+    messages = [
+        Message(
+            id=row[0], conversation_id=conversation_id, sender_id=row[1], recipient_id=row[2], content=row[3],
+            attachment_id=row[4], file_type=row[5], timestamp=_datetime(row[6]),
+        ) for row in rows
+    ]
+    # Użytkownik i załącznik mogły zniknąć po archiwizacji - klucz obcy już ich nie chroni
+    senders = User.objects.in_bulk({message.sender_id for message in messages})
+    attachments = Attachment.objects.in_bulk({message.attachment_id for message in messages if message.attachment_id})
+    for message in messages:
+        message.sender = senders.get(message.sender_id) or User(id=message.sender_id, username="")
+        message.attachment = attachments.get(message.attachment_id)
+    return messages
+
+
+def find_archived_attachment(message_id):
+    # (conversation_id, attachment_id) wiadomości z archiwum albo None
+    for _, path, first_id, last_id in reversed(get_archives()):
+        if first_id is None or not first_id <= message_id <= last_id:
+            continue
+        found = open_archive(path).find_attachment(message_id)
+        if found is not None:
+            return found
+    return None
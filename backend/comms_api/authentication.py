@@ -0,0 +1,140 @@
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils.crypto import salted_hmac
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from comms_api.models import CachedUser
+
+TOKEN_VERSION_CLAIM = "ver"
+# Pola User odtwarzane z cache - wszystko, co czytają uprawnienia i widoki, poza hasłem
+USER_FIELDS = (
+    "id", "username", "first_name", "last_name", "email", "is_staff", "is_active", "is_superuser",
+    "last_login", "date_joined",
+)
+
+
+def _token_version(password, is_active):
+    return salted_hmac("comms_api.token_version", f"{password}:{is_active}").hexdigest()[:16]
+
+
+def token_version(user):
+    # Zmiana hasła albo dezaktywacja konta zmienia wersję i unieważnia wydane tokeny
+    return _token_version(user.password, user.is_active)
+
+
+class LocalUserCache:
+    # Mały LRU w procesie: przy lawinie reconnectów trafienie nie wymaga nawet Redisa
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return entry[1]
+
+    def set(self, user_id, entry):
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + self.ttl, entry)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+
+_local_users = LocalUserCache(settings.AUTH_USER_LOCAL_CACHE_SIZE, settings.AUTH_USER_LOCAL_CACHE_TTL)
+
+
+def _cache_key(user_id):
+    return f"auth_user_fields:{user_id}"
+
+
+def _user_id(validated_token):
+    try:
+        return int(validated_token[api_settings.USER_ID_CLAIM])
+    except KeyError:
+        raise InvalidToken("Token contained no recognizable user identification")
+
+
+def _load_entry(user_id):
+    # W cache trzymamy pola z USER_FIELDS i wersję tokenu zamiast hasha hasła
+    row = User.objects.filter(pk=user_id).values_list(*USER_FIELDS, "password").first()
+    if row is None:
+        raise AuthenticationFailed("User not found", code="user_not_found")
+    fields = dict(zip(USER_FIELDS, row))
+    return row[:-1], _token_version(row[-1], fields["is_active"])
+
+
+def _check_user(entry, validated_token):
+    values, version = entry
+    user = CachedUser(**dict(zip(USER_FIELDS, values)))
+    if not user.is_active:
+        raise AuthenticationFailed("User is inactive", code="user_inactive")
+    claimed = validated_token.get(TOKEN_VERSION_CLAIM)
+    if claimed is None:
+        # Tokeny sprzed wprowadzenia wersji (i dostępowe odświeżone z takich) działają tylko przez czas życia
+        # tokenu dostępu od wydania, potem aplikacja loguje się ponownie i dostaje token z wersją
+        issued_at = validated_token.get("iat", 0)
+        if issued_at + api_settings.ACCESS_TOKEN_LIFETIME.total_seconds() < time.time():
+            raise AuthenticationFailed("Token has been revoked", code="token_revoked")
+    elif claimed != version:
+        raise AuthenticationFailed("Token has been revoked", code="token_revoked")
+    # Każde wywołanie dostaje własny obiekt - request.user i scope["user"] nie są współdzielone między wątkami
+    user._state.adding = False
+    return user
+
+
+def get_cached_user(validated_token):
+    # Tylko pamięć procesu, bez I/O - można wołać bezpośrednio z pętli asyncio
+    entry = _local_users.get(_user_id(validated_token))
+    if entry is None:
+        return None
+    return _check_user(entry, validated_token)
+
+
+def get_user(validated_token):
+    user_id = _user_id(validated_token)
+    entry = _local_users.get(user_id)
+    if entry is None:
+        entry = cache.get(_cache_key(user_id))
+        if entry is None:
+            entry = _load_entry(user_id)
+            cache.set(_cache_key(user_id), entry, settings.AUTH_USER_CACHE_TTL)
+        _local_users.set(user_id, entry)
+    return _check_user(entry, validated_token)
+
+
+def invalidate_user(user_id):
+    _local_users.discard(user_id)
+    cache.delete(_cache_key(user_id))
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_user_on_change(sender, instance, **kwargs):
+    _local_users.discard(instance.pk)
+    transaction.on_commit(lambda: invalidate_user(instance.pk))
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    def get_user(self, validated_token):
+        return get_user(validated_token)
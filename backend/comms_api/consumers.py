@@ -1,11 +1,170 @@
 import json
 import base64
-from comms_api.mqtt_client import send_notification
+import asyncio
+import time
+import msgpack
+from datetime import timedelta
+from uuid import UUID
+from comms_api import metrics, presence
+from comms_api.notifications import queue_notification, queue_notifications
+from comms_api.groups import group_channel, get_group_ids, get_member_ids
+from comms_api.ephemeral import EphemeralThrottle, is_stale
+from comms_api.ratelimit import RateLimiter
+from comms_api.friends import invalidate_friend_ids, get_friend_ids
+from comms_api.media import message_media_url
+from comms_api.thumbnails import schedule_thumbnail
+from comms_api.db_executor import run_db
+from comms_api.uploads import (
+    UploadError, parse_chunk, start_upload, resume_upload, get_completed_upload, store_bytes, validate_file_type
+)
 from channels.generic.websocket import AsyncWebsocketConsumer
 from asgiref.sync import sync_to_async
-from django.core.files.base import ContentFile
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction, IntegrityError
 from django.contrib.auth.models import AnonymousUser, User
-from comms_api.models import Message, Call, FriendRequest
+from comms_api.models import (
+    TIMESTAMP_ORDER_MARGIN, Message, Call, FriendRequest, Conversation, ConversationMember, Attachment, ClientMessageKey, DeliveryAck
+)
+from comms_api.serializers import MessageSerializer
+
+# Negocjowany w Sec-WebSocket-Protocol; bez niego zostaje JSON w ramkach tekstowych
+MSGPACK_SUBPROTOCOL = "msgpack"
+# Zamknięcie połączenia za ignorowanie slow_down (odpowiednik HTTP 429)
+RATE_LIMIT_CLOSE_CODE = 4429
+
+
+def _message_for_key(sender, client_key):
+    message_id = ClientMessageKey.objects.filter(sender=sender, key=client_key).values_list("message_id", flat=True)
+    return Message.objects.filter(pk__in=message_id).first()
+
+
+def create_message(sender, recipient_id=None, conversation=None, client_key=None, **fields):
+    # Zwraca (message, created) - ponowienie z tym samym client_key nie wstawia drugiej wiadomości.
+    # Odbiorcę sprawdza klucz obcy (przy commit), bez osobnego zapytania o użytkownika.
+    if client_key:
+        message = _message_for_key(sender, client_key)
+        if message is not None:
+            return message, False
+
+    try:
+        with transaction.atomic():
+            if conversation is None:
+                conversation = Conversation.objects.get_direct(sender.id, recipient_id)
+            message = Message.objects.create(
+                conversation=conversation, sender=sender, recipient_id=recipient_id, **fields
+            )
+            Conversation.objects.record_message(message)
+            if client_key:
+                ClientMessageKey.objects.create(sender=sender, key=client_key, message_id=message.id)
+            if message.attachment_id:
+                Attachment.objects.acquire(message.attachment_id)
+                if not message.attachment.thumbnail:
+                    # robust: wiadomość jest już zapisana, błąd miniatury nie może zatrzymać message_sent
+                    transaction.on_commit(lambda: schedule_thumbnail(message), robust=True)
+    except IntegrityError:
+        # Równoległe ponowienie zdążyło zapisać ten sam klucz
+        if client_key:
+            message = _message_for_key(sender, client_key)
+            if message is not None:
+                return message, False
+        raise
+    return message, True
+
+
+class NotAMember(Exception):
+    pass
+
+
+def resolve_attachment(sender, data):
+    if "upload_id" in data.keys():
+        upload = get_completed_upload(sender, data["upload_id"])
+        return upload.attachment, upload.file_type
+    elif "file" in data.keys():
+        file_data = data["file"]
+        format, file_str = file_data.split(";base64,")
+        ext = format.split("/")[-1]
+        file_type = validate_file_type(data.get("file_type", ""))
+        return store_bytes(base64.b64decode(file_str), ext), file_type
+    return None, ""
+
+
+def _client_key(data):
+    return str(data.get("client_id") or "")[:64] or None
+
+
+def store_direct_message(sender, recipient_id, data):
+    # Całość w jednym skoku do puli DB: załącznik, zapis wiadomości i liczniki rozmowy
+    attachment, file_type = resolve_attachment(sender, data)
+    return create_message(
+        sender=sender,
+        recipient_id=recipient_id,
+        client_key=_client_key(data),
+        content=data["message"],
+        attachment=attachment,
+        file_type=file_type or "",
+    )
+
+
+def store_group_message(sender, conversation_id, data):
+    member_ids = get_member_ids(conversation_id)
+    if sender.id not in member_ids:
+        raise NotAMember()
+    conversation = Conversation.objects.get(pk=conversation_id)
+    attachment, file_type = resolve_attachment(sender, data)
+    message, created = create_message(
+        sender=sender,
+        conversation=conversation,
+        client_key=_client_key(data),
+        content=data["message"],
+        attachment=attachment,
+        file_type=file_type or "",
+    )
+    return message, created, conversation, member_ids
+
+
+def get_missed_messages(user, after_id, limit):
+    # Zwraca (zakładka, nowe): nowe to do limit + 1 wiadomości po after_id (nadmiar = has_more),
+    # zakładka to wiadomości z niższym id z RESUME_ACK_OVERLAP_SECONDS przed potwierdzoną. Id są nadawane
+    # przy INSERT, a transakcje kończą się w innej kolejności: wiadomość z niższym id mogła stać się widoczna
+    # już po potwierdzeniu wyższego. Klient odrzuca duplikaty po id.
+    conversation_ids = ConversationMember.objects.filter(user=user).values("conversation_id")
+    messages = Message.objects.filter(conversation__in=conversation_ids).select_related(
+        "sender", "attachment"
+    ).order_by("id")
+    acked_at = Message.objects.filter(pk=after_id).values_list("timestamp", flat=True).first() if after_id else None
+    if acked_at is None:
+        # Pierwsza synchronizacja albo potwierdzona wiadomość już w archiwum
+        return [], list(messages.filter(id__gt=after_id)[:limit + 1])
+    # Dolna granica po timestamp odcina starsze partycje
+    newer = messages.filter(id__gt=after_id, timestamp__gte=acked_at - TIMESTAMP_ORDER_MARGIN)
+    overlap = messages.filter(
+        id__lt=after_id, timestamp__gte=acked_at - timedelta(seconds=settings.RESUME_ACK_OVERLAP_SECONDS)
+    )
+    return list(overlap[:limit]), list(newer[:limit + 1])
+
+
+def record_ack(user, device_id, message_id):
+    if not DeliveryAck.objects.filter(
+        user=user, device_id=device_id, last_acked_message_id__lt=message_id
+    ).update(last_acked_message_id=message_id):
+        DeliveryAck.objects.bulk_create(
+            [DeliveryAck(user=user, device_id=device_id, last_acked_message_id=message_id)], ignore_conflicts=True
+        )
+
+
+def get_last_ack(user, device_id):
+    return DeliveryAck.objects.filter(user=user, device_id=device_id).values_list(
+        "last_acked_message_id", flat=True
+    ).first() or 0
+
+
+def _device_id(data):
+    # Starsze aplikacje nie wysyłają identyfikatora urządzenia - dzielą jeden znacznik
+    device_id = data.get("device_id") or ""
+    if not isinstance(device_id, str):
+        raise ValueError("device_id must be a string")
+    return device_id[:64]
 
 
 class ChatConsumer(AsyncWebsocketConsumer):
@@ -15,20 +174,115 @@ class ChatConsumer(AsyncWebsocketConsumer):
             await self.close()
         else:
             self.user = user
+            self.uploads = {}
+            self.outbox = []
+            self.flush_task = None
+            self.ephemeral = EphemeralThrottle(
+                self.send_ephemeral,
+                interval=settings.EPHEMERAL_MIN_INTERVAL,
+                refresh=settings.EPHEMERAL_REFRESH,
+                rate=settings.EPHEMERAL_RATE,
+            )
+            self.rate_limiter = RateLimiter(user.id)
+            self.use_msgpack = MSGPACK_SUBPROTOCOL in self.scope.get("subprotocols", [])
             self.room_name = f"user_{user.id}"
+            metrics.WS_CONNECTIONS.inc()
             await self.channel_layer.group_add(self.room_name, self.channel_name)
-            await self.accept()
+            # Po group_add, żeby zmiana znajomości w międzyczasie nie przepadła (friends_changed przeładuje)
+            self.friend_ids = await run_db(get_friend_ids, user.id)
+            # Wiadomości grupowe przychodzą jednym group_send na rozmowę, nie na każdego członka
+            self.group_ids = set(await run_db(get_group_ids, user.id))
+            for conversation_id in self.group_ids:
+                await self.channel_layer.group_add(group_channel(conversation_id), self.channel_name)
+            await self.accept(subprotocol=MSGPACK_SUBPROTOCOL if self.use_msgpack else None)
+            await presence.touch(user.id, self.channel_name)
 
     async def disconnect(self, close_code):
+        if getattr(self, "flush_task", None):
+            self.flush_task.cancel()
+        if hasattr(self, "ephemeral"):
+            self.ephemeral.close()
+        for session in getattr(self, "uploads", {}).values():
+            session.close()
         if hasattr(self, "room_name"):
+            metrics.WS_CONNECTIONS.dec()
+            await presence.leave(self.user.id, self.channel_name)
             await self.channel_layer.group_discard(self.room_name, self.channel_name)
+            for conversation_id in self.group_ids:
+                await self.channel_layer.group_discard(group_channel(conversation_id), self.channel_name)
         else:
             await self.close()
 
-    async def receive(self, text_data):
-        data = json.loads(text_data)
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            if text_data is not None:
+                data = json.loads(text_data)
+            elif self.use_msgpack:
+                data = msgpack.unpackb(bytes_data, raw=False)
+            else:
+                with metrics.WS_ACTION_SECONDS.labels("upload_chunk").time():
+                    await self.handle_upload_chunk(bytes_data)
+                return
+        except (ValueError, msgpack.UnpackException):
+            await self.send_event({"type": "error", "error": "malformed frame"})
+            return
+
+        # Jedna ramka może nieść listę akcji, wykonywanych po kolei
+        for item in data if isinstance(data, list) else [data]:
+            if self.rate_limiter.abusive:
+                break
+            if isinstance(item, dict):
+                await self.handle_action(item)
+            else:
+                await self.send_event({"type": "error", "error": "action must be an object"})
+
+    async def handle_action(self, data):
         action = data.get("action")
+        if action == "send_message":
+            costs = {"message": 1}
+            if isinstance(data.get("file"), str):
+                costs["upload_bytes"] = len(data["file"]) * 3 // 4
+            extra = {"client_id": _client_key(data)}
+        else:
+            costs, extra = {"action": 1}, {}
+        if not await self.within_limits(action, costs, extra):
+            return
+
+        started = time.perf_counter()
+        try:
+            known = await self.run_action(action, data)
+        except (KeyError, TypeError, ValueError, ObjectDoesNotExist):
+            # Brakujące albo błędne pola od klienta: odpowiedź z błędem zamiast zerwania połączenia
+            metrics.WS_ACTION_ERRORS.labels(action).inc()
+            await self.send_event({"type": "error", "action": action, "error": "invalid payload"})
+            return
+        except Exception:
+            metrics.WS_ACTION_ERRORS.labels(action).inc()
+            raise
+        # Nieznane akcje bez własnej serii - inaczej klient mógłby mnożyć etykiety
+        if known:
+            metrics.WS_ACTION_SECONDS.labels(action).observe(time.perf_counter() - started)
+        else:
+            metrics.WS_UNKNOWN_ACTIONS.inc()
 
+    async def within_limits(self, action, costs, extra):
+        retry_after = await self.rate_limiter.acquire(**costs)
+        if not retry_after:
+            return True
+        if self.rate_limiter.abusive:
+            metrics.WS_ABUSE_CLOSES.inc()
+            await self.close(code=RATE_LIMIT_CLOSE_CODE)
+            return False
+        # Akcja nie została wykonana - klient ponawia ją sam po retry_after sekundach
+        await self.send_event({
+            "type": "slow_down",
+            "action": action,
+            "retry_after": round(retry_after, 3),
+            **extra,
+        })
+        return False
+
+    async def run_action(self, action, data):
         if action == "send_message":
             await self.handle_send_message(data)
         elif action == "friend_request_send":
@@ -37,60 +291,337 @@ class ChatConsumer(AsyncWebsocketConsumer):
             await self.handle_accept_request(data)
         elif action == "friend_delete":
             await self.handle_delete_friend(data)
+        elif action == "mark_read":
+            await self.handle_mark_read(data)
+        elif action == "upload_start":
+            await self.handle_upload_start(data)
+        elif action == "upload_commit":
+            await self.handle_upload_commit(data)
+        elif action == "upload_chunk":
+            await self.handle_upload_chunk_action(data)
+        elif action == "typing":
+            await self.handle_typing(data)
+        elif action == "seen":
+            await self.handle_seen(data)
+        elif action == "ping":
+            await self.handle_ping(data)
+        elif action == "ack":
+            await self.handle_ack(data)
+        elif action == "resume":
+            await self.handle_resume(data)
+        else:
+            return False
+        return True
+
+    async def send_event(self, event):
+        metrics.WS_EVENTS_SENT.labels(event["type"]).inc()
+        if not self.use_msgpack:
+            await self.send(text_data=json.dumps(event))
+            return
+        # Zdarzenia z tej samej chwili wychodzą jedną ramką (zawsze lista)
+        self.outbox.append(event)
+        if self.flush_task is None:
+            self.flush_task = asyncio.ensure_future(self.flush_outbox())
+
+    async def flush_outbox(self):
+        await asyncio.sleep(settings.WS_BATCH_WINDOW)
+        events, self.outbox, self.flush_task = self.outbox, [], None
+        await self.send(bytes_data=msgpack.packb(events, use_bin_type=True))
+
+    def message_event(self, message, **extra):
+        # Bez podpisanych linków - każdy odbiorca liczy je sobie w chat_message
+        attachment = message.attachment
+        return {
+            "type": "chat.message",
+            "message": {
+                "id": message.id,
+                **extra,
+                "sender_name": self.user.username,
+                "content": message.content,
+                "file_url": None,
+                "file_type": message.file_type,
+                "has_file": attachment is not None,
+                # Ten sam plik wysłany wcześniej ma już gotową miniaturę
+                "has_thumbnail": bool(attachment and attachment.thumbnail),
+                "thumbnail_url": None,
+                "thumbnail_width": attachment.thumbnail_width if attachment else None,
+                "thumbnail_height": attachment.thumbnail_height if attachment else None,
+                "timestamp": message.timestamp.isoformat(),
+            },
+        }
 
     async def handle_send_message(self, data):
+        if "conversation_id" in data:
+            await self.handle_send_group_message(data)
+            return
+
         from_user = self.user
-        to_user_id = data["to"]
-        content = data["message"]
-        to_user = await sync_to_async(User.objects.get)(id=to_user_id)
-        file = None
-        file_type = ""
-        if "file" in data.keys():
-            file_data = data["file"]
-            file_type = data["file_type"]
-            format, file_str = file_data.split(";base64,")
-            ext = format.split("/")[-1]
-            decoded_file = ContentFile(base64.b64decode(file_str), name=f"message_{from_user.id}_{to_user_id}.{ext}")
-            file = decoded_file
-
-        message = await sync_to_async(Message.objects.create)(
-            sender=from_user,
-            recipient=to_user,
-            content=content,
-            file=file,
-            file_type=file_type or ""
-        )
+        to_user_id = int(data["to"])
+        try:
+            message, created = await run_db(store_direct_message, from_user, to_user_id, data)
+        except UploadError as e:
+            await self.send_upload_error(data.get("upload_id"), e)
+            return
+        except IntegrityError:
+            await self.send_send_error(data, "unknown recipient")
+            return
 
-        await self.channel_layer.group_send(
-            f"user_{to_user_id}",
-            {
-                "type": "chat.message",
-                "message": {
-                    "sender_name": from_user.username,
-                    "content": content,
-                    "file_url": f"http://192.168.0.130:8000{message.file.url}" if message.file else None,
-                    "file_type": file_type,
-                    "timestamp": "Teraz",
-                },
-            }
+        await self.send_event({
+            "type": "message_sent",
+            "client_id": _client_key(data),
+            "id": message.id,
+            "chat_id": to_user_id,
+            "timestamp": message.timestamp.isoformat(),
+        })
+        if not created:
+            return
+
+        await metrics.group_send(
+            self.channel_layer, f"user_{to_user_id}", self.message_event(message, chat_id=from_user.id)
         )
 
-        send_notification(
-            to_user_id=to_user.id,
+        if await presence.is_foreground(to_user_id):
+            return
+        queue_notification(
+            to_user_id=to_user_id,
             payload={
                 "type": "chat_message",
                 "title": from_user.username,
-                "body": content[:60],
+                "body": message.content[:60],
                 "chat_id": from_user.id
             }
         )
 
+    async def handle_send_group_message(self, data):
+        conversation_id = int(data["conversation_id"])
+        try:
+            message, created, conversation, member_ids = await run_db(
+                store_group_message, self.user, conversation_id, data
+            )
+        except UploadError as e:
+            await self.send_upload_error(data.get("upload_id"), e)
+            return
+        except NotAMember:
+            await self.send_send_error(data, "not a member of this conversation")
+            return
+
+        await self.send_event({
+            "type": "message_sent",
+            "client_id": _client_key(data),
+            "id": message.id,
+            "conversation_id": conversation_id,
+            "timestamp": message.timestamp.isoformat(),
+        })
+        if not created:
+            return
+
+        await metrics.group_send(
+            self.channel_layer,
+            group_channel(conversation_id),
+            self.message_event(message, conversation_id=conversation_id),
+        )
+
+        # Push tylko do członków bez aplikacji na pierwszym planie, wszystkie w jednym przebiegu kolejki
+        recipients = member_ids - {self.user.id}
+        offline = recipients - await presence.get_foreground_ids(recipients)
+        if offline:
+            queue_notifications(offline, {
+                "type": "group_message",
+                "title": conversation.title,
+                "body": f"{self.user.username}: {message.content[:60]}",
+                "chat_id": conversation_id,
+            })
+
+    async def send_send_error(self, data, error):
+        await self.send_event({
+            "type": "error",
+            "action": "send_message",
+            "client_id": _client_key(data),
+            "to": data.get("to"),
+            "conversation_id": data.get("conversation_id"),
+            "error": error,
+        })
+
+    def is_friend(self, user_id):
+        # Zbiór z connect, przeładowywany przez friends_changed przy każdej zmianie znajomości (też przez REST
+        # i z innych połączeń) - pisanie i odczyty nie mogą na każde zdarzenie pytać bazy ani cache
+        return user_id in self.friend_ids
+
+    async def handle_typing(self, data):
+        try:
+            to_user_id = int(data["to"])
+        except (KeyError, TypeError, ValueError):
+            return
+        if self.is_friend(to_user_id):
+            self.ephemeral.push(("typing", to_user_id), {"typing": bool(data.get("typing", True))})
+
+    async def handle_seen(self, data):
+        try:
+            to_user_id, message_id = int(data["to"]), int(data["id"])
+        except (KeyError, TypeError, ValueError):
+            return
+        if self.is_friend(to_user_id):
+            self.ephemeral.push(("seen", to_user_id), {"id": message_id})
+
+    async def send_ephemeral(self, key, payload):
+        kind, to_user_id = key
+        # channels_redis odrzuca zdarzenia grupowe do przepełnionych kanałów zamiast je kolejkować
+        await metrics.group_send(
+            self.channel_layer,
+            f"user_{to_user_id}",
+            {
+                "type": f"chat.{kind}",
+                "sent_at": time.time(),
+                kind: {"chat_id": self.user.id, **payload},
+            }
+        )
+
+    async def handle_ping(self, data):
+        # Aplikacja pinguje co kilkanaście sekund i zgłasza, czy jest na pierwszym planie
+        state = presence.BACKGROUND if data.get("state") == "background" else presence.FOREGROUND
+        await presence.touch(self.user.id, self.channel_name, state)
+        await self.send_event({"type": "pong"})
+
+    async def handle_ack(self, data):
+        try:
+            device_id, message_id = _device_id(data), int(data["id"])
+        except (KeyError, TypeError, ValueError):
+            return
+        await run_db(record_ack, self.user, device_id, message_id)
+
+    async def handle_resume(self, data):
+        # Po reconnect klient podaje ostatnie widziane id (albo polega na zapisanym ack)
+        # i dostaje wszystko, co go ominęło, jedną ramką
+        try:
+            device_id = _device_id(data)
+            after_id = int(data["after"]) if data.get("after") is not None else None
+        except (TypeError, ValueError):
+            await self.send_event({"type": "error", "action": "resume", "error": "invalid after or device_id"})
+            return
+        if after_id is None:
+            after_id = await run_db(get_last_ack, self.user, device_id)
+        after_id = max(0, after_id)
+        limit = settings.RESUME_BATCH_SIZE
+        overlap, newer = await run_db(get_missed_messages, self.user, after_id, limit)
+        has_more = len(newer) > limit
+        messages = overlap + newer[:limit]
+
+        serializer = MessageSerializer(messages, many=True, context={"user_id": self.user.id})
+        payload = await run_db(lambda: serializer.data)
+        for item, message in zip(payload, messages):
+            item["conversation_id"] = message.conversation_id
+            if message.recipient_id is not None:
+                item["chat_id"] = message.recipient_id if message.sender_id == self.user.id else message.sender_id
+        await self.send_event({
+            "type": "resume",
+            "after": after_id,
+            "messages": payload,
+            "has_more": has_more,
+        })
+
+    async def handle_upload_start(self, data):
+        try:
+            if "upload_id" in data:
+                # Ponowny upload_start na tym samym połączeniu zastępuje poprzednią sesję i jej blokadę
+                self.close_upload(data["upload_id"])
+                session = await run_db(resume_upload, self.user, data["upload_id"])
+            else:
+                session = await run_db(
+                    start_upload, self.user, data["size"], data["ext"], data.get("file_type", "")
+                )
+        except UploadError as e:
+            await self.send_upload_error(data.get("upload_id"), e)
+            return
+
+        self.uploads[session.upload.pk] = session
+        await self.send_event({
+            "type": "upload_ready",
+            "upload_id": str(session.upload.pk),
+            "offset": session.received,
+            "chunk_size": settings.UPLOAD_CHUNK_SIZE,
+        })
+
+    async def handle_upload_chunk(self, frame):
+        try:
+            upload_id, offset, chunk = parse_chunk(frame)
+        except UploadError as e:
+            await self.send_upload_error(None, e)
+            return
+        await self.append_upload_chunk(upload_id, offset, chunk)
+
+    async def handle_upload_chunk_action(self, data):
+        # W trybie msgpack kawałek pliku to zwykła akcja z polem binarnym
+        try:
+            upload_id = UUID(str(data["upload_id"]))
+            offset, chunk = int(data["offset"]), data["data"]
+        except (KeyError, ValueError) as e:
+            await self.send_upload_error(data.get("upload_id"), e)
+            return
+        if not isinstance(chunk, bytes):
+            await self.send_upload_error(upload_id, UploadError("chunk data must be binary"))
+            return
+        await self.append_upload_chunk(upload_id, offset, chunk)
+
+    async def append_upload_chunk(self, upload_id, offset, chunk):
+        if not await self.within_limits(
+            "upload_chunk", {"upload_bytes": len(chunk)}, {"upload_id": str(upload_id), "offset": offset}
+        ):
+            return
+        try:
+            session = self.uploads.get(upload_id)
+            if session is None:
+                raise UploadError("upload not started")
+            received = await sync_to_async(session.append, thread_sensitive=False)(offset, chunk)
+        except UploadError as e:
+            await self.send_upload_error(upload_id, e)
+            return
+
+        await self.send_event({
+            "type": "upload_progress",
+            "upload_id": str(upload_id),
+            "offset": received,
+        })
+
+    async def handle_upload_commit(self, data):
+        session = None
+        try:
+            session = self.uploads.pop(UUID(str(data["upload_id"])), None) or await run_db(
+                resume_upload, self.user, data["upload_id"]
+            )
+            upload = await run_db(session.commit)
+        except (UploadError, ValueError) as e:
+            if session is not None:
+                session.close()
+            await self.send_upload_error(data.get("upload_id"), e)
+            return
+
+        await self.send_event({
+            "type": "upload_complete",
+            "upload_id": str(upload.pk),
+        })
+
+    def close_upload(self, upload_id):
+        try:
+            session = self.uploads.pop(UUID(str(upload_id)), None)
+        except ValueError:
+            return
+        if session is not None:
+            session.close()
+
+    async def send_upload_error(self, upload_id, error):
+        await self.send_event({
+            "type": "upload_error",
+            "upload_id": str(upload_id) if upload_id else None,
+            "error": str(error),
+        })
+
     async def handle_send_request(self, data):
         from_user = self.user
         to_user_id = data["to"]
         to_user = await sync_to_async(User.objects.get)(id=to_user_id)
 
-        await self.channel_layer.group_send(
+        await metrics.group_send(
+            self.channel_layer,
             f"user_{to_user_id}",
             {
                 "type": "friend.request",
@@ -112,8 +643,10 @@ class ChatConsumer(AsyncWebsocketConsumer):
     async def handle_accept_request(self, data):
         request_id = data["id"]
         friendRequest = await FriendRequest.objects.select_related('from_user').aget(id=request_id)
+        await sync_to_async(invalidate_friend_ids)(friendRequest.from_user.id, self.user.id)
 
-        await self.channel_layer.group_send(
+        await metrics.group_send(
+            self.channel_layer,
             f"user_{friendRequest.from_user.id}",
             {
                 "type": "friend.accept",
@@ -134,8 +667,10 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
     async def handle_delete_friend(self, data):
         to_user_id = data["friendId"]
+        await sync_to_async(invalidate_friend_ids)(self.user.id, to_user_id)
 
-        await self.channel_layer.group_send(
+        await metrics.group_send(
+            self.channel_layer,
             f"user_{to_user_id}",
             {
                 "type": "friend.remove",
@@ -145,26 +680,98 @@ class ChatConsumer(AsyncWebsocketConsumer):
             }
         )
 
+    async def handle_mark_read(self, data):
+        message_id = int(data["id"])
+        if "conversation_id" in data:
+            # W grupie odczyt zapisujemy, ale nie rozsyłamy - przy setkach członków
+            # każde potwierdzenie byłoby kolejnym fanoutem do wszystkich
+            await run_db(
+                Conversation.objects.mark_group_read, self.user, int(data["conversation_id"]), message_id
+            )
+            return
+
+        other_user_id = data["chat_id"]
+        advanced = await run_db(Conversation.objects.mark_read, self.user, other_user_id, message_id)
+        if not advanced:
+            return
+
+        await metrics.group_send(
+            self.channel_layer,
+            f"user_{other_user_id}",
+            {
+                "type": "chat.read",
+                "read": {"chat_id": self.user.id, "last_read_id": message_id},
+            }
+        )
+
     async def chat_message(self, event):
-        await self.send(text_data=json.dumps({
+        message = dict(event["message"])
+        if message.pop("has_file", False):
+            message["file_url"] = message_media_url(message["id"], self.user.id)
+        if message.pop("has_thumbnail", False):
+            message["thumbnail_url"] = message_media_url(message["id"], self.user.id, variant="thumbnail")
+        await self.send_event({
             "type": "chat_message",
-            **event["message"],
-        }))
+            **message,
+        })
+
+    async def chat_thumbnail(self, event):
+        thumbnail = event["thumbnail"]
+        await self.send_event({
+            "type": "message_thumbnail",
+            **thumbnail,
+            "thumbnail_url": message_media_url(thumbnail["id"], self.user.id, variant="thumbnail"),
+        })
+
+    async def group_joined(self, event):
+        self.group_ids.add(event["conversation_id"])
+        await self.channel_layer.group_add(group_channel(event["conversation_id"]), self.channel_name)
+        await self.send_event({"type": "group_joined", "conversation_id": event["conversation_id"]})
+
+    async def group_left(self, event):
+        self.group_ids.discard(event["conversation_id"])
+        await self.channel_layer.group_discard(group_channel(event["conversation_id"]), self.channel_name)
+        await self.send_event({"type": "group_left", "conversation_id": event["conversation_id"]})
+
+    async def chat_read(self, event):
+        await self.send_event({
+            "type": "message_read",
+            **event["read"],
+        })
+
+    async def chat_typing(self, event):
+        if is_stale(event, settings.EPHEMERAL_MAX_AGE):
+            return
+        await self.send_event({
+            "type": "typing",
+            **event["typing"],
+        })
+
+    async def chat_seen(self, event):
+        if is_stale(event, settings.EPHEMERAL_MAX_AGE):
+            return
+        await self.send_event({
+            "type": "seen",
+            **event["seen"],
+        })
 
     async def friend_request(self, event):
-        await self.send(text_data=json.dumps({
+        await self.send_event({
             "type": "friend_request",
             **event["request"],
-        }))
+        })
 
     async def friend_accept(self, event):
-        await self.send(text_data=json.dumps({
+        await self.send_event({
             "type": "friend_request",
             **event["accept"],
-        }))
+        })
 
     async def friend_remove(self, event):
-        await self.send(text_data=json.dumps({
+        await self.send_event({
             "type": "friend_delete",
             **event["remove"],
-        }))
+        })
+
+    async def friends_changed(self, event):
+        self.friend_ids = await run_db(get_friend_ids, self.user.id)
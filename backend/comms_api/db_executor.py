@@ -0,0 +1,101 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from channels.db import DatabaseSyncToAsync
+from django.conf import settings
+from django.db import close_old_connections, connections
+from comms_api.metrics import track_db_executor
+
+logger = logging.getLogger(__name__)
+
+
+# Osobna, ograniczona pula wątków na zapytania z konsumerów WebSocket. Domyślny
+# sync_to_async ma jeden wątek na cały proces, więc wszystkie połączenia czekały
+# w jednej kolejce. Każdy wątek puli trzyma własne połączenie z bazą.
+class DBExecutor:
+    def __init__(self, workers, warn_queue, conn_max_age=0):
+        self.workers = workers
+        self.warn_queue = warn_queue
+        self.conn_max_age = conn_max_age
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="comms-db", initializer=self._init_thread
+        )
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._max_queued = 0
+
+    def _init_thread(self):
+        # Trwałe połączenia tylko w wątkach puli, których jest stała liczba. Widoki REST pod ASGI dostają
+        # nowy wątek na każde żądanie i zostają przy CONN_MAX_AGE z DATABASES.
+        for alias in connections:
+            connection = connections[alias]
+            connection.settings_dict = {**connection.settings_dict, "CONN_MAX_AGE": self.conn_max_age}
+
+    async def run(self, func, *args, **kwargs):
+        with self._lock:
+            self._in_flight += 1
+            queued = self.queued
+            self._max_queued = max(self._max_queued, queued)
+        if queued > self.warn_queue:
+            logger.warning("DB executor queue depth %s (%s workers)", queued, self.workers)
+        try:
+            return await DatabaseSyncToAsync(func, thread_sensitive=False, executor=self._executor)(*args, **kwargs)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def submit(self, func, *args):
+        # Zadanie w tle zlecane spoza pętli zdarzeń (np. z callbacku innej puli); błąd trafia tylko do logu
+        with self._lock:
+            self._in_flight += 1
+
+        def call():
+            close_old_connections()
+            try:
+                func(*args)
+            except Exception:
+                logger.exception("Background DB task %s failed", func.__name__)
+            finally:
+                close_old_connections()
+                with self._lock:
+                    self._in_flight -= 1
+
+        return self._executor.submit(call)
+
+    @property
+    def queued(self):
+        return max(0, self._in_flight - self.workers)
+
+    def stats(self, reset=False):
+        # Do doboru DB_EXECUTOR_WORKERS: max_queued to najgłębsza kolejka od ostatniego odczytu
+        with self._lock:
+            stats = {
+                "workers": self.workers,
+                "in_flight": self._in_flight,
+                "queued": self.queued,
+                "max_queued": self._max_queued,
+            }
+            if reset:
+                self._max_queued = self.queued
+        return stats
+
+    def close_connections(self):
+        # Każde zadanie czeka na barierze, więc trafia do innego wątku puli
+        barrier = threading.Barrier(self.workers)
+
+        def close():
+            barrier.wait()
+            connections.close_all()
+
+        for future in [self._executor.submit(close) for _ in range(self.workers)]:
+            future.result()
+
+
+db_executor = DBExecutor(
+    settings.DB_EXECUTOR_WORKERS, settings.DB_EXECUTOR_WARN_QUEUE, settings.DB_EXECUTOR_CONN_MAX_AGE
+)
+track_db_executor(db_executor)
+
+
+def run_db(func, *args, **kwargs):
+    return db_executor.run(func, *args, **kwargs)
@@ -0,0 +1,83 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Zdarzenia ulotne (pisze..., widział) nie trafiają do bazy ani do MQTT.
+# Na połączenie: najwyżej jedno zdarzenie na (rodzaj, odbiorca) co `interval` sekund,
+# powtórzenia tego samego stanu są pomijane, a całość ogranicza budżet `rate` na sekundę.
+
+
+class EphemeralThrottle:
+    def __init__(self, emit, interval, refresh, rate, max_keys=64):
+        self.emit = emit
+        self.interval = interval
+        self.refresh = refresh
+        self.rate = rate
+        self.max_keys = max_keys
+        self._last = {}
+        self._pending = {}
+        # Referencje do wysyłek w toku: bez nich pętla trzyma tylko słabe odwołanie do zadania
+        self._tasks = set()
+        self._tokens = rate
+        self._tokens_at = time.monotonic()
+
+    def push(self, key, payload):
+        if key in self._pending:
+            # Czeka już zdarzenie dla tego klucza - wygrywa najnowszy stan
+            self._pending[key][1] = payload
+            return
+        now = time.monotonic()
+        last = self._last.get(key)
+        if last is not None and last[1] == payload and now - last[0] < self.refresh:
+            return
+        if last is not None and now - last[0] < self.interval:
+            handle = asyncio.get_running_loop().call_later(self.interval - (now - last[0]), self._flush, key)
+            self._pending[key] = [handle, payload]
+            return
+        self._send(key, payload, now)
+
+    def close(self):
+        for handle, _ in self._pending.values():
+            handle.cancel()
+        self._pending.clear()
+        for task in self._tasks:
+            task.cancel()
+        self._tasks.clear()
+
+    def _flush(self, key):
+        _, payload = self._pending.pop(key)
+        last = self._last.get(key)
+        if last is not None and last[1] == payload:
+            return
+        self._send(key, payload, time.monotonic())
+
+    def _take_token(self, now):
+        self._tokens = min(self.rate, self._tokens + (now - self._tokens_at) * self.rate)
+        self._tokens_at = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    def _send(self, key, payload, now):
+        if not self._take_token(now):
+            return
+        self._last.pop(key, None)
+        self._last[key] = (now, payload)
+        if len(self._last) > self.max_keys:
+            del self._last[next(iter(self._last))]
+        task = asyncio.ensure_future(self.emit(key, payload))
+        self._tasks.add(task)
+        task.add_done_callback(self._emitted)
+
+    def _emitted(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("Ephemeral event failed", exc_info=task.exception())
+
+
+def is_stale(event, max_age):
+    # Zdarzenie, które przeleżało w kolejce kanału, nic już nie znaczy
+    return time.time() - event.get("sent_at", 0) > max_age
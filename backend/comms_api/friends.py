@@ -0,0 +1,53 @@
+import logging
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+from redis import RedisError
+from comms_api.models import Friendship
+
+logger = logging.getLogger(__name__)
+
+
+def _cache_key(user_id):
+    return f"friend_ids:{user_id}"
+
+
+def get_friend_ids(user_id):
+    friend_ids = cache.get(_cache_key(user_id))
+    if friend_ids is None:
+        friend_ids = frozenset(Friendship.objects.filter(user_id=user_id).values_list("friend_id", flat=True))
+        cache.set(_cache_key(user_id), friend_ids, settings.FRIEND_IDS_CACHE_TTL)
+    return friend_ids
+
+
+def are_friends(user_id, other_user_id):
+    return int(other_user_id) in get_friend_ids(user_id)
+
+
+def invalidate_friend_ids(*user_ids):
+    cache.delete_many([_cache_key(user_id) for user_id in user_ids])
+    # Otwarte gniazda tych użytkowników trzymają własny zbiór znajomych - dostają sygnał, żeby go przeładować
+    channel_layer = get_channel_layer()
+    for user_id in user_ids:
+        try:
+            async_to_sync(channel_layer.group_send)(f"user_{user_id}", {"type": "friends.changed"})
+        except RedisError:
+            logger.warning("Friend list refresh not delivered to user %s", user_id, exc_info=True)
+
+
+def add_friendship(user_a_id, user_b_id):
+    Friendship.objects.bulk_create(
+        [Friendship(user_id=user_a_id, friend_id=user_b_id), Friendship(user_id=user_b_id, friend_id=user_a_id)],
+        ignore_conflicts=True,
+    )
+    transaction.on_commit(lambda: invalidate_friend_ids(user_a_id, user_b_id))
+
+
+def remove_friendship(user_a_id, user_b_id):
+    Friendship.objects.filter(
+        Q(user_id=user_a_id, friend_id=user_b_id) | Q(user_id=user_b_id, friend_id=user_a_id)
+    ).delete()
+    transaction.on_commit(lambda: invalidate_friend_ids(user_a_id, user_b_id))
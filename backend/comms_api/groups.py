@@ -0,0 +1,86 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from comms_api.models import Conversation, ConversationMember
+
+
+class GroupError(Exception):
+    pass
+
+
+def group_channel(conversation_id):
+    return f"conversation_{conversation_id}"
+
+
+def _cache_key(conversation_id):
+    return f"group_members:{conversation_id}"
+
+
+def get_member_ids(conversation_id):
+    # Sprawdzane przy każdej wiadomości w grupie, więc trzymane w cache jak lista znajomych
+    member_ids = cache.get(_cache_key(conversation_id))
+    if member_ids is None:
+        member_ids = frozenset(ConversationMember.objects.filter(
+            conversation_id=conversation_id, conversation__is_group=True
+        ).values_list("user_id", flat=True))
+        cache.set(_cache_key(conversation_id), member_ids, settings.GROUP_MEMBERS_CACHE_TTL)
+    return member_ids
+
+
+def invalidate_member_ids(conversation_id):
+    cache.delete(_cache_key(conversation_id))
+
+
+def get_group_ids(user_id):
+    return list(ConversationMember.objects.filter(
+        user_id=user_id, conversation__is_group=True
+    ).values_list("conversation_id", flat=True))
+
+
+def create_group(creator, title, member_ids):
+    member_ids = {int(user_id) for user_id in member_ids} - {creator.id}
+    if len(member_ids) + 1 > settings.GROUP_MAX_MEMBERS:
+        raise GroupError(f"group can have at most {settings.GROUP_MAX_MEMBERS} members")
+    with transaction.atomic():
+        conversation = Conversation.objects.create_group(creator, title[:100], member_ids)
+        transaction.on_commit(lambda: notify_membership(conversation.id, [creator.id, *member_ids], joined=True))
+    return conversation
+
+
+def add_members(conversation_id, user_ids):
+    user_ids = {int(user_id) for user_id in user_ids} - get_member_ids(conversation_id)
+    if len(get_member_ids(conversation_id)) + len(user_ids) > settings.GROUP_MAX_MEMBERS:
+        raise GroupError(f"group can have at most {settings.GROUP_MAX_MEMBERS} members")
+    with transaction.atomic():
+        ConversationMember.objects.bulk_create(
+            [ConversationMember(conversation_id=conversation_id, user_id=user_id) for user_id in user_ids],
+            ignore_conflicts=True,
+        )
+        transaction.on_commit(lambda: invalidate_member_ids(conversation_id))
+        transaction.on_commit(lambda: notify_membership(conversation_id, user_ids, joined=True))
+    return user_ids
+
+
+def remove_member(conversation_id, user_id):
+    with transaction.atomic():
+        deleted, _ = ConversationMember.objects.filter(
+            conversation_id=conversation_id, conversation__is_group=True, user_id=user_id
+        ).delete()
+        transaction.on_commit(lambda: invalidate_member_ids(conversation_id))
+        transaction.on_commit(lambda: notify_membership(conversation_id, [user_id], joined=False))
+    return bool(deleted)
+
+
+def notify_membership(conversation_id, user_ids, joined):
+    # Otwarte połączenia dołączają do grupy kanałów rozmowy (albo z niej wychodzą) od razu
+    channel_layer = get_channel_layer()
+    for user_id in user_ids:
+        async_to_sync(channel_layer.group_send)(
+            f"user_{user_id}",
+            {
+                "type": "group.joined" if joined else "group.left",
+                "conversation_id": conversation_id,
+            }
+        )
@@ -0,0 +1,33 @@
+import subprocess
+from io import BytesIO
+from PIL import Image, ImageOps
+
+# Ten moduł wykonuje się w procesach puli miniatur, więc nie może importować niczego z Django
+
+
+def _poster_frame(path):
+    try:
+        result = subprocess.run(
+            ["ffmpeg", "-v", "error", "-ss", "1", "-i", path, "-frames:v", "1", "-f", "image2pipe", "-vcodec", "png", "-"],
+            capture_output=True, timeout=30,
+        )
+    except (FileNotFoundError, subprocess.TimeoutExpired):
+        return None
+    if result.returncode != 0 or not result.stdout:
+        return None
+    return BytesIO(result.stdout)
+
+
+def render_thumbnail(path, file_type, max_size):
+    source = _poster_frame(path) if file_type == "video" else path
+    if source is None:
+        return None
+
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_size, max_size))
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        output = BytesIO()
+        image.save(output, "JPEG", quality=80, optimize=True)
+    return output.getvalue(), image.width, image.height
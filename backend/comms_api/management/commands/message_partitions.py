@@ -0,0 +1,29 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from comms_api.partitions import archive_partition, ensure_partitions, partition_name, partitions_to_archive
+
+
+class Command(BaseCommand):
+    help = (
+        "Create upcoming monthly message partitions and, with --archive, move partitions older "
+        "than the retention window into compressed archive files"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--ahead", type=int, default=settings.MESSAGE_PARTITIONS_AHEAD, help="months to premake")
+        parser.add_argument("--archive", action="store_true", help="archive partitions past the retention window")
+        parser.add_argument("--retention-months", type=int, default=settings.MESSAGE_RETENTION_MONTHS)
+        parser.add_argument("--dry-run", action="store_true", help="only list partitions that would be archived")
+
+    def handle(self, *args, **options):
+        for name in ensure_partitions(options["ahead"]):
+            self.stdout.write(f"Created {name}")
+
+        if not options["archive"]:
+            return
+        for month in partitions_to_archive(options["retention_months"]):
+            if options["dry_run"]:
+                self.stdout.write(f"Would archive {partition_name(month)}")
+                continue
+            stats = archive_partition(month)
+            self.stdout.write(f"Archived {partition_name(month)}: {stats['count']} messages")
@@ -0,0 +1,203 @@
+import random
+import time
+from datetime import timedelta
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+from comms_api.models import Message, Conversation, ConversationMember, FriendRequest, Friendship
+from comms_api.partitions import add_months, create_partition, current_month, monthly_partitions
+
+WORDS = (
+    "cześć hej co tam dzisiaj jutro wieczorem spotkanie kino obiad praca szkoła projekt "
+    "ok dzięki super jasne może zobaczymy później teraz zaraz gdzie jesteś dzwonię "
+    "hello thanks sure see you soon meeting tomorrow tonight lunch call me"
+).split()
+
+
+def _sentence(rng):
+    return " ".join(rng.choices(WORDS, k=rng.randint(1, 12)))
+
+
+class Command(BaseCommand):
+    help = (
+        "Generate a synthetic dataset: users, accepted and pending friend requests, direct "
+        "conversations and messages with skewed (Zipf) conversation sizes"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=1000)
+        parser.add_argument("--friends", type=int, default=20, help="average friends per user")
+        parser.add_argument("--pending", type=int, default=2, help="pending friend requests sent per user")
+        parser.add_argument("--messages", type=int, default=100000)
+        parser.add_argument("--skew", type=float, default=1.1, help="Zipf exponent for conversation sizes")
+        parser.add_argument("--days", type=int, default=365, help="time span of the message history")
+        parser.add_argument("--prefix", default="seed_", help="username prefix")
+        parser.add_argument("--password", default="seed")
+        parser.add_argument("--batch-size", type=int, default=5000)
+        parser.add_argument("--seed", type=int, default=None, help="random seed for a repeatable dataset")
+
+    def handle(self, *args, **options):
+        prefix = options["prefix"]
+        if User.objects.filter(username__startswith=prefix).exists():
+            raise CommandError(f"Users with prefix {prefix!r} already exist")
+
+        self.rng = random.Random(options["seed"])
+        self.batch_size = options["batch_size"]
+        started = time.monotonic()
+
+        users = self.create_users(options["users"], prefix, options["password"])
+        pairs = self.create_friendships(users, options["friends"], options["pending"])
+        conversations = self.create_conversations(pairs)
+        messages = self.create_messages(conversations, options["messages"], options["skew"], options["days"])
+
+        self.stdout.write(
+            f"Created {len(users)} users, {len(pairs)} friendships, {len(conversations)} conversations "
+            f"and {messages} messages in {time.monotonic() - started:.1f} s"
+        )
+
+    def create_users(self, count, prefix, password):
+        # Haszowanie hasła jest celowo wolne, więc jeden hash dla wszystkich
+        password = make_password(password)
+        User.objects.bulk_create(
+            [User(username=f"{prefix}{i}", password=password) for i in range(count)],
+            batch_size=self.batch_size,
+        )
+        return list(User.objects.filter(username__startswith=prefix).order_by("id").values_list("id", flat=True))
+
+    def create_friendships(self, user_ids, friends, pending):
+        rng = self.rng
+        pairs = set()
+        for _ in range(len(user_ids) * friends // 2):
+            a, b = rng.sample(user_ids, 2)
+            pairs.add((min(a, b), max(a, b)))
+
+        # Oczekujące zaproszenia tylko między osobami, które nie są znajomymi
+        requests = set()
+        for user_id in user_ids:
+            for _ in range(pending):
+                other = rng.choice(user_ids)
+                if other != user_id and (min(user_id, other), max(user_id, other)) not in pairs:
+                    if (other, user_id) not in requests:
+                        requests.add((user_id, other))
+
+        now = timezone.now()
+        with transaction.atomic():
+            FriendRequest.objects.bulk_create(
+                [FriendRequest(
+                    from_user_id=a, to_user_id=b, status=FriendRequest.Status.ACCEPTED, responded_at=now
+                ) for a, b in pairs] + [
+                    FriendRequest(from_user_id=a, to_user_id=b) for a, b in requests
+                ],
+                batch_size=self.batch_size,
+            )
+            Friendship.objects.bulk_create(
+                [Friendship(user_id=a, friend_id=b) for pair in pairs for a, b in (pair, pair[::-1])],
+                batch_size=self.batch_size,
+            )
+        return sorted(pairs)
+
+    def create_conversations(self, pairs):
+        with transaction.atomic():
+            conversations = Conversation.objects.bulk_create(
+                [Conversation(key=Conversation.direct_key(a, b)) for a, b in pairs], batch_size=self.batch_size
+            )
+            ConversationMember.objects.bulk_create(
+                [
+                    ConversationMember(conversation=conversation, user_id=user_id)
+                    for conversation, pair in zip(conversations, pairs)
+                    for user_id in pair
+                ],
+                batch_size=self.batch_size,
+            )
+        return [(conversation.id, pair) for conversation, pair in zip(conversations, pairs)]
+
+    def create_messages(self, conversations, count, skew, days):
+        if not conversations or not count:
+            return 0
+        rng = self.rng
+
+        # Kilka rozmów ma większość wiadomości, reszta po kilka
+        ranked = conversations[:]
+        rng.shuffle(ranked)
+        weights = [1 / (rank ** skew) for rank in range(1, len(ranked) + 1)]
+
+        # Znacznik odczytu jak w aplikacji: wysyłając, członek przeczytał wszystko wcześniej
+        last_message = {}
+        last_read = {}
+        unread = {}
+
+        step = timedelta(days=days) / count
+        start = timezone.now() - timedelta(days=days)
+        self.create_partitions(start)
+        created = 0
+        while created < count:
+            size = min(self.batch_size, count - created)
+            batch = []
+            for conversation_id, pair in rng.choices(ranked, weights, k=size):
+                sender_id, recipient_id = pair if rng.random() < 0.5 else pair[::-1]
+                batch.append(Message(
+                    conversation_id=conversation_id,
+                    sender_id=sender_id,
+                    recipient_id=recipient_id,
+                    content=_sentence(rng),
+                    timestamp=start + step * (created + len(batch)),
+                ))
+            self.insert_messages(batch)
+            for message in batch:
+                last_message[message.conversation_id] = message
+                last_read[message.conversation_id, message.sender_id] = message.id
+                unread[message.conversation_id, message.sender_id] = 0
+                key = (message.conversation_id, message.recipient_id)
+                unread[key] = unread.get(key, 0) + 1
+            created += size
+            self.stdout.write(f"  {created}/{count} messages", ending="\r")
+        self.stdout.write("")
+
+        with transaction.atomic():
+            Conversation.objects.bulk_update(
+                [Conversation(
+                    id=conversation_id,
+                    last_message_id=message.id,
+                    last_message_preview=message.content[:Conversation.PREVIEW_LENGTH],
+                    last_message_at=message.timestamp,
+                ) for conversation_id, message in last_message.items()],
+                ["last_message_id", "last_message_preview", "last_message_at"],
+                batch_size=self.batch_size,
+            )
+            members = ConversationMember.objects.filter(conversation_id__in=list(last_message)).only(
+                "id", "conversation_id", "user_id"
+            )
+            updated = []
+            for member in members.iterator():
+                key = (member.conversation_id, member.user_id)
+                member.unread_count = unread.get(key, 0)
+                member.last_read_message_id = last_read.get(key)
+                updated.append(member)
+            ConversationMember.objects.bulk_update(
+                updated, ["unread_count", "last_read_message_id"], batch_size=self.batch_size
+            )
+        return created
+
+    def insert_messages(self, batch):
+        # bulk_create nadpisałby rozłożone w czasie znaczniki przez auto_now_add, więc INSERT wprost;
+        # id z RETURNING wracają w kolejności wierszy z VALUES, tak jak w bulk_create
+        columns = ("conversation_id", "sender_id", "recipient_id", "content", "file_type", "timestamp")
+        rows = ", ".join(["(%s, %s, %s, %s, %s, %s)"] * len(batch))
+        params = [getattr(message, column) for message in batch for column in columns]
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {Message._meta.db_table} ({', '.join(columns)}) VALUES {rows} RETURNING id", params
+            )
+            for message, (message_id,) in zip(batch, cursor.fetchall()):
+                message.id = message_id
+
+    def create_partitions(self, start):
+        # Bez partycji na miesiące z przeszłości cała historia wylądowałaby w partycji domyślnej
+        existing = set(monthly_partitions())
+        month = start.date().replace(day=1)
+        while month <= current_month():
+            if month not in existing:
+                create_partition(month)
+            month = add_months(month, 1)
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from comms_api.uploads import sweep_uploads
+
+
+class Command(BaseCommand):
+    help = "Delete expired chunked uploads with their .part files and attachments that were never sent"
+
+    def handle(self, *args, **options):
+        stats = sweep_uploads()
+        self.stdout.write(f"Removed {stats['uploads']} uploads and {stats['attachments']} attachments")
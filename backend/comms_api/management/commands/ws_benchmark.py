@@ -0,0 +1,299 @@
+import asyncio
+import json
+import os
+import subprocess
+import time
+from collections import defaultdict, deque
+from uuid import UUID
+import msgpack
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from comms_api.consumers import ChatConsumer, MSGPACK_SUBPROTOCOL
+from comms_api.db_executor import db_executor
+from comms_api.friends import add_friendship
+from comms_api.models import Conversation, Message
+from comms_api.uploads import CHUNK_HEADER
+
+
+def _percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+
+    def at(p):
+        return round(values[min(len(values) - 1, int(p / 100 * len(values)))] * 1000, 3)
+
+    return {"count": len(values), "p50": at(50), "p95": at(95), "p99": at(99), "max": round(values[-1] * 1000, 3)}
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=settings.BASE_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class BenchClient:
+    # Jeden symulowany telefon: czytnik zdarzeń w tle i nadawca w pętli zamkniętej (czeka na message_sent)
+    def __init__(self, bench, user, peer, use_msgpack):
+        self.bench = bench
+        self.user = user
+        self.peer = peer
+        self.use_msgpack = use_msgpack
+        self.acks = {}
+        self.uploads = asyncio.Queue()
+        self.communicator = None
+        self.reader = None
+
+    async def connect(self):
+        self.communicator = WebsocketCommunicator(
+            ChatConsumer.as_asgi(), "/ws/chat/", subprotocols=[MSGPACK_SUBPROTOCOL] if self.use_msgpack else None
+        )
+        self.communicator.scope["user"] = self.user
+        connected, _ = await self.communicator.connect()
+        if not connected:
+            raise RuntimeError(f"connection refused for {self.user.username}")
+        self.reader = asyncio.ensure_future(self.read())
+
+    async def disconnect(self):
+        self.reader.cancel()
+        await self.communicator.disconnect()
+
+    async def send(self, data):
+        if self.use_msgpack:
+            await self.communicator.send_to(bytes_data=msgpack.packb(data, use_bin_type=True))
+        else:
+            await self.communicator.send_to(text_data=json.dumps(data))
+
+    async def read(self):
+        while True:
+            output = await self.communicator.receive_output(timeout=None)
+            if output["type"] != "websocket.send":
+                continue
+            if output.get("bytes") is not None:
+                events = msgpack.unpackb(output["bytes"], raw=False)
+            else:
+                events = [json.loads(output["text"])]
+            now = time.perf_counter()
+            for event in events:
+                self.bench.on_event(self, event, now)
+
+    async def request(self, data):
+        # Opóźnienie od wysłania do potwierdzenia message_sent u nadawcy
+        ack = self.acks[data["client_id"]] = asyncio.get_running_loop().create_future()
+        started = self.bench.sent_at[data["message"]] = time.perf_counter()
+        await self.send(data)
+        if (await ack)["type"] == "message_sent":
+            self.bench.ack_latency.append(time.perf_counter() - started)
+
+    async def run_messages(self, count):
+        for seq in range(count):
+            await self.request({
+                "action": "send_message",
+                "to": self.peer.id,
+                "client_id": f"m-{self.user.id}-{seq}",
+                "message": f"bench {self.user.id}:{seq}",
+            })
+
+    async def run_files(self, count, size):
+        chunk_size = settings.UPLOAD_CHUNK_SIZE
+        for seq in range(count):
+            # Różna treść w każdym pliku - deduplikacja nie może skrócić ścieżki
+            payload = os.urandom(size)
+            started = time.perf_counter()
+            await self.send({"action": "upload_start", "size": size, "ext": "bin", "file_type": "file"})
+            upload_id = (await self.uploads.get())["upload_id"]
+            for offset in range(0, size, chunk_size):
+                chunk = payload[offset:offset + chunk_size]
+                if self.use_msgpack:
+                    await self.send({"action": "upload_chunk", "upload_id": upload_id, "offset": offset, "data": chunk})
+                else:
+                    header = CHUNK_HEADER.pack(UUID(upload_id).bytes, offset)
+                    await self.communicator.send_to(bytes_data=header + chunk)
+                if (await self.uploads.get())["type"] == "upload_error":
+                    break
+            await self.send({"action": "upload_commit", "upload_id": upload_id})
+            if (await self.uploads.get())["type"] == "upload_error":
+                self.bench.delivered()
+                continue
+            self.bench.upload_latency.append(time.perf_counter() - started)
+            await self.request({
+                "action": "send_message",
+                "to": self.peer.id,
+                "client_id": f"f-{self.user.id}-{seq}",
+                "message": f"file {self.user.id}:{seq}",
+                "upload_id": upload_id,
+            })
+
+    async def run_friend_actions(self, count):
+        for _ in range(count):
+            for data in ({"action": "friend_request_send", "to": self.peer.id}, {"action": "friend_delete", "friendId": self.peer.id}):
+                self.bench.friend_sent[self.peer.id].append(time.perf_counter())
+                await self.send(data)
+
+
+class Benchmark:
+    def __init__(self, expected):
+        self.expected = expected
+        self.received = 0
+        self.done = asyncio.Event()
+        self.sent_at = {}
+        self.friend_sent = defaultdict(deque)
+        self.message_latency = []
+        self.file_latency = []
+        self.ack_latency = []
+        self.friend_latency = []
+        self.upload_latency = []
+        self.errors = []
+
+    def on_event(self, client, event, now):
+        kind = event.get("type")
+        if kind == "chat_message":
+            sent_at = self.sent_at.pop(event["content"], None)
+            if sent_at is None:
+                return
+            (self.file_latency if event.get("file_url") else self.message_latency).append(now - sent_at)
+            self.delivered()
+        elif kind == "message_sent":
+            ack = client.acks.pop(event["client_id"], None)
+            if ack is not None:
+                ack.set_result(event)
+        elif kind in ("friend_request", "friend_delete"):
+            self.friend_latency.append(now - self.friend_sent[client.user.id].popleft())
+            self.delivered()
+        elif kind in ("upload_ready", "upload_progress", "upload_complete"):
+            client.uploads.put_nowait(event)
+        elif kind == "upload_error":
+            self.errors.append(event)
+            client.uploads.put_nowait(event)
+        elif kind == "error":
+            # Wiadomość nie dotrze, więc nie czekamy na nią do timeoutu
+            self.errors.append(event)
+            ack = client.acks.pop(event.get("client_id"), None)
+            if ack is not None:
+                ack.set_result(event)
+            self.delivered()
+
+    def delivered(self):
+        self.received += 1
+        if self.received >= self.expected:
+            self.done.set()
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark ChatConsumer: N simulated clients send messages, files and friend actions "
+        "to each other; prints throughput and delivery latency percentiles as JSON. Runs against the "
+        "configured database, channel layer, Redis and MQTT broker and removes its users afterwards; "
+        "raise the RATE_LIMIT_* settings in the environment, otherwise the limiter is what gets measured"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--clients", type=int, default=20)
+        parser.add_argument("--messages", type=int, default=50, help="text messages per client")
+        parser.add_argument("--files", type=int, default=2, help="file messages per client")
+        parser.add_argument("--file-size", type=int, default=64 * 1024)
+        parser.add_argument("--friend-actions", type=int, default=2, help="friend request + delete rounds per client")
+        parser.add_argument("--msgpack", action="store_true", help="use the msgpack subprotocol")
+        parser.add_argument("--prefix", default="bench_", help="username prefix of the benchmark users")
+        parser.add_argument("--timeout", type=float, default=120)
+        parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+
+    def handle(self, *args, **options):
+        prefix = options["prefix"]
+        if User.objects.filter(username__startswith=prefix).exists():
+            raise CommandError(f"Users with prefix {prefix!r} already exist")
+
+        try:
+            report = async_to_sync(self.run_benchmark)(options)
+        finally:
+            self.cleanup(prefix)
+
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(output + "\n")
+        else:
+            self.stdout.write(output)
+
+    async def run_benchmark(self, options):
+        clients_count = options["clients"]
+        users = await sync_to_async(self.create_users)(clients_count, options["prefix"])
+        expected = clients_count * (options["messages"] + options["files"] + 2 * options["friend_actions"])
+        bench = Benchmark(expected)
+
+        # Pierścień: klient i pisze do klienta i+1, więc każdy jest też odbiorcą
+        clients = [
+            BenchClient(bench, user, users[(i + 1) % clients_count], options["msgpack"])
+            for i, user in enumerate(users)
+        ]
+        connect_started = time.perf_counter()
+        await asyncio.gather(*(client.connect() for client in clients))
+        connect_time = time.perf_counter() - connect_started
+        db_executor.stats(reset=True)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            coroutine
+            for client in clients
+            for coroutine in (
+                client.run_messages(options["messages"]),
+                client.run_files(options["files"], options["file_size"]),
+                client.run_friend_actions(options["friend_actions"]),
+            )
+        ))
+        try:
+            await asyncio.wait_for(bench.done.wait(), options["timeout"])
+        except asyncio.TimeoutError:
+            pass
+        duration = time.perf_counter() - started
+        executor_stats = db_executor.stats()
+
+        await asyncio.gather(*(client.disconnect() for client in clients))
+
+        delivered_messages = len(bench.message_latency) + len(bench.file_latency)
+        return {
+            "commit": _git_commit(),
+            "config": {
+                key: options[key]
+                for key in ("clients", "messages", "files", "file_size", "friend_actions", "msgpack")
+            },
+            "channel_layer": settings.CHANNEL_LAYERS["default"]["BACKEND"],
+            "connect_seconds": round(connect_time, 3),
+            "duration_seconds": round(duration, 3),
+            "messages_per_second": round(delivered_messages / duration, 1) if duration else None,
+            "events_per_second": round(bench.received / duration, 1) if duration else None,
+            "expected_events": expected,
+            "delivered_events": bench.received,
+            "errors": len(bench.errors),
+            "latency_ms": {
+                "message_delivery": _percentiles(bench.message_latency),
+                "message_ack": _percentiles(bench.ack_latency),
+                "file_delivery": _percentiles(bench.file_latency),
+                "file_upload": _percentiles(bench.upload_latency),
+                "friend_event": _percentiles(bench.friend_latency),
+            },
+            "db_executor": executor_stats,
+        }
+
+    def create_users(self, count, prefix):
+        User.objects.bulk_create([User(username=f"{prefix}{i}") for i in range(count)])
+        users = list(User.objects.filter(username__startswith=prefix).order_by("id"))
+        for user, peer in zip(users, users[1:] + users[:1]):
+            add_friendship(user.id, peer.id)
+        return users
+
+    def cleanup(self, prefix):
+        # Użytkownicy benchmarku piszą tylko do siebie nawzajem. Usunięcie wiadomości zwalnia załączniki
+        # (sygnał post_delete), a rozmowy i użytkownika chroni przed usunięciem PROTECT z wiadomości.
+        users = User.objects.filter(username__startswith=prefix)
+        with transaction.atomic():
+            Message.objects.filter(sender__in=users).delete()
+            Conversation.objects.filter(members__user__in=users).delete()
+            users.delete()
@@ -0,0 +1,129 @@
+import mimetypes
+import os
+import re
+import time
+from django.conf import settings
+from django.core import signing
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.http import http_date
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class _MediaSigner(signing.TimestampSigner):
+    # Czas podpisu zaokrąglony w dół do MEDIA_URL_STABLE_FOR: w tym oknie URL się nie zmienia,
+    # więc cache Coil/odtwarzacza dalej trafia, a wyciekły link i tak wygasa po MEDIA_URL_MAX_AGE
+    def timestamp(self):
+        window = settings.MEDIA_URL_STABLE_FOR
+        return signing.b62_encode(int(time.time()) // window * window)
+
+
+_signer = _MediaSigner(salt="comms_api.media")
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def media_url(message, user_id, request=None, variant=None):
+    return message_media_url(message.pk, user_id, request, variant)
+
+
+def message_media_url(message_id, user_id, request=None, variant=None):
+    # Podpisany link, bo Coil/odtwarzacz w aplikacji nie wysyłają nagłówka Authorization.
+    # Klient dostaje świeże linki w każdej historii i każdym zdarzeniu, więc mogą wygasać.
+    signature = _signer.sign(f"{message_id}:{user_id}")
+    path = f"/api/media/{message_id}/?sig={signature}"
+    if variant:
+        path += f"&variant={variant}"
+    if request:
+        return request.build_absolute_uri(path)
+    return f"{settings.PUBLIC_BASE_URL}{path}"
+
+
+def signed_media_user(signature, message_id):
+    if not signature:
+        return None
+    try:
+        value = _signer.unsign(signature, max_age=settings.MEDIA_URL_MAX_AGE)
+    except signing.BadSignature:
+        # Także SignatureExpired
+        return None
+    signed_message_id, user_id = value.split(":")
+    if int(signed_message_id) != int(message_id):
+        return None
+    return int(user_id)
+
+
+def parse_range(header, size):
+    match = RANGE_RE.match(header.strip())
+    if not match:
+        return None
+    start, end = match.groups()
+    if not start:
+        # Sufiks z pustego pliku też nie ma żadnego bajtu do wysłania
+        if not end or int(end) == 0 or size == 0:
+            raise RangeNotSatisfiable()
+        return max(size - int(end), 0), size - 1
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        raise RangeNotSatisfiable()
+    return start, end
+
+
+def _read_range(path, start, length):
+    with open(path, "rb") as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(STREAM_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def serve_media(request, field_file, etag=None):
+    stat = os.stat(field_file.path)
+    # Treść adresowana hashem jest niezmienna, więc hash wystarcza za ETag
+    etag = f'"{etag}"' if etag else f'"{stat.st_size:x}-{int(stat.st_mtime):x}"'
+    headers = {
+        "ETag": etag,
+        "Last-Modified": http_date(stat.st_mtime),
+        "Cache-Control": f"private, max-age={settings.MEDIA_CACHE_MAX_AGE}, immutable",
+        "Accept-Ranges": "bytes",
+    }
+
+    if etag in request.headers.get("If-None-Match", ""):
+        return HttpResponse(status=304, headers=headers)
+
+    content_type = mimetypes.guess_type(field_file.name)[0] or "application/octet-stream"
+
+    # Proxy (nginx/Apache) sam obsłuży Range i wyśle bajty, Python tylko autoryzuje
+    if settings.MEDIA_ACCEL_REDIRECT_PREFIX:
+        headers["X-Accel-Redirect"] = f"{settings.MEDIA_ACCEL_REDIRECT_PREFIX}{field_file.name}"
+        return HttpResponse(content_type=content_type, headers=headers)
+    if settings.MEDIA_USE_X_SENDFILE:
+        headers["X-Sendfile"] = field_file.path
+        return HttpResponse(content_type=content_type, headers=headers)
+
+    try:
+        byte_range = parse_range(request.headers.get("Range", ""), stat.st_size)
+    except RangeNotSatisfiable:
+        headers["Content-Range"] = f"bytes */{stat.st_size}"
+        return HttpResponse(status=416, headers=headers)
+
+    if byte_range is None:
+        response = FileResponse(open(field_file.path, "rb"), content_type=content_type)
+        for name, value in headers.items():
+            response[name] = value
+        return response
+
+    start, end = byte_range
+    length = end - start + 1
+    headers["Content-Range"] = f"bytes {start}-{end}/{stat.st_size}"
+    headers["Content-Length"] = str(length)
+    return StreamingHttpResponse(
+        _read_range(field_file.path, start, length), status=206, content_type=content_type, headers=headers
+    )
@@ -0,0 +1,110 @@
+import hmac
+import threading
+import time
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.http import HttpResponse
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+
+# Kubełki od 1 ms: akcje WS i zapytania są zwykle krótkie, ogon interesuje nas do kilku sekund
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+
+WS_CONNECTIONS = Gauge("comms_ws_connections", "Open WebSocket connections in this worker")
+WS_ACTION_SECONDS = Histogram(
+    "comms_ws_action_seconds", "Time spent handling one WebSocket action", ["action"], buckets=LATENCY_BUCKETS
+)
+WS_ACTION_ERRORS = Counter("comms_ws_action_errors_total", "WebSocket actions that raised", ["action"])
+WS_UNKNOWN_ACTIONS = Counter("comms_ws_unknown_actions_total", "WebSocket frames with an unknown action")
+WS_EVENTS_SENT = Counter("comms_ws_events_sent_total", "Events sent to WebSocket clients", ["type"])
+WS_RATE_LIMITED = Counter("comms_ws_rate_limited_total", "WebSocket actions refused by a rate limit", ["bucket"])
+WS_ABUSE_CLOSES = Counter("comms_ws_abuse_closes_total", "WebSocket connections closed for ignoring rate limits")
+CHANNEL_SEND_SECONDS = Histogram(
+    "comms_channel_layer_send_seconds", "Channel layer group_send latency", ["type"], buckets=LATENCY_BUCKETS
+)
+
+MQTT_PUBLISH_SECONDS = Histogram(
+    "comms_mqtt_publish_seconds", "Time to hand a notification to the MQTT client", buckets=LATENCY_BUCKETS
+)
+MQTT_QUEUE_WAIT_SECONDS = Histogram(
+    "comms_mqtt_queue_wait_seconds", "Time a notification waited in the publisher queue", buckets=LATENCY_BUCKETS
+)
+MQTT_PUBLISH_FAILURES = Counter("comms_mqtt_publish_failures_total", "Dropped or failed MQTT publishes", ["reason"])
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "comms_http_request_seconds", "REST request latency", ["view", "method", "status"], buckets=LATENCY_BUCKETS
+)
+HTTP_DB_QUERIES = Histogram(
+    "comms_http_db_queries", "Database queries per REST request", ["view"], buckets=QUERY_COUNT_BUCKETS
+)
+DB_QUERY_SECONDS = Histogram("comms_db_query_seconds", "Database query latency", buckets=LATENCY_BUCKETS)
+
+
+def track_db_executor(executor):
+    Gauge("comms_db_executor_in_flight", "DB executor calls running or queued").set_function(
+        lambda: executor.stats()["in_flight"]
+    )
+    Gauge("comms_db_executor_queued", "DB executor calls waiting for a worker").set_function(
+        lambda: executor.stats()["queued"]
+    )
+
+
+def track_mqtt_queue(publisher):
+    Gauge("comms_mqtt_queue_size", "Notifications waiting in the MQTT publisher queue").set_function(
+        publisher.queue_size
+    )
+
+
+async def group_send(channel_layer, group, event):
+    with CHANNEL_SEND_SECONDS.labels(event["type"]).time():
+        await channel_layer.group_send(group, event)
+
+
+# Licznik zapytań na wątek: widok synchroniczny wykonuje się w całości w jednym wątku
+_queries = threading.local()
+
+
+def _query_count():
+    return getattr(_queries, "count", 0)
+
+
+def _observe_query(execute, sql, params, many, context):
+    _queries.count = _query_count() + 1
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        DB_QUERY_SECONDS.observe(time.perf_counter() - started)
+
+
+@receiver(connection_created)
+def instrument_connection(sender, connection, **kwargs):
+    if _observe_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_observe_query)
+
+
+class MetricsMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        queries = _query_count()
+        response = self.get_response(request)
+        # Trasa zamiast ścieżki - id w URL-u rozsadziłyby liczbę serii
+        match = request.resolver_match
+        view = match.route if match else "unmatched"
+        HTTP_REQUEST_SECONDS.labels(view, request.method, response.status_code).observe(time.perf_counter() - started)
+        HTTP_DB_QUERIES.labels(view).observe(_query_count() - queries)
+        return response
+
+
+def metrics_view(request):
+    # Bez skonfigurowanego tokenu endpoint jest wyłączony - metryki zdradzają trasy i ruch
+    if not settings.METRICS_TOKEN:
+        return HttpResponse(status=404)
+    authorization = request.headers.get("Authorization", "")
+    if not hmac.compare_digest(authorization.encode(), f"Bearer {settings.METRICS_TOKEN}".encode()):
+        return HttpResponse(status=401)
+    return HttpResponse(generate_latest(), content_type=CONTENT_TYPE_LATEST)
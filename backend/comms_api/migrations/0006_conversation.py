@@ -0,0 +1,70 @@
+# Generated by Django 5.2.1 on 2026-10-18 13:49
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def build_conversations(apps, schema_editor):
+    Message = apps.get_model('comms_api', 'Message')
+    Conversation = apps.get_model('comms_api', 'Conversation')
+    ConversationMember = apps.get_model('comms_api', 'ConversationMember')
+
+    summaries = {}
+    messages = Message.objects.order_by('id').values(
+        'id', 'sender_id', 'recipient_id', 'content', 'timestamp', 'is_read'
+    )
+    for message in messages.iterator():
+        low, high = sorted((message['sender_id'], message['recipient_id']))
+        summary = summaries.setdefault(f"{low}:{high}", {'unread': {low: 0, high: 0}})
+        summary['last'] = message
+        if not message['is_read'] and message['recipient_id'] != message['sender_id']:
+            summary['unread'][message['recipient_id']] += 1
+
+    for key, summary in summaries.items():
+        last = summary['last']
+        conversation = Conversation.objects.create(
+            key=key,
+            last_message_id=last['id'],
+            last_message_preview=last['content'][:100],
+            last_message_at=last['timestamp'],
+        )
+        ConversationMember.objects.bulk_create([
+            ConversationMember(conversation=conversation, user_id=user_id, unread_count=unread)
+            for user_id, unread in summary['unread'].items()
+        ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comms_api', '0005_userfcmtoken'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Conversation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64, unique=True)),
+                ('last_message_id', models.BigIntegerField(blank=True, null=True)),
+                ('last_message_preview', models.CharField(blank=True, max_length=100)),
+                ('last_message_at', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ConversationMember',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='members', to='comms_api.conversation')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='conversation_memberships', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('conversation', 'user')},
+            },
+        ),
+        migrations.RunPython(build_conversations, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.2.1 on 2026-10-18 13:50
+
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def init_watermarks(apps, schema_editor):
+    Message = apps.get_model('comms_api', 'Message')
+    ConversationMember = apps.get_model('comms_api', 'ConversationMember')
+
+    for member in ConversationMember.objects.select_related('conversation').iterator():
+        if member.unread_count == 0:
+            member.last_read_message_id = member.conversation.last_message_id
+        else:
+            low, high = (int(user_id) for user_id in member.conversation.key.split(':'))
+            other_user_id = high if member.user_id == low else low
+            member.last_read_message_id = Message.objects.filter(
+                sender_id=other_user_id, recipient_id=member.user_id, is_read=True
+            ).aggregate(last_read=Max('id'))['last_read']
+        member.save(update_fields=['last_read_message_id'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comms_api', '0006_conversation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversationmember',
+            name='last_read_message_id',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.RunPython(init_watermarks, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='message',
+            name='is_read',
+        ),
+    ]
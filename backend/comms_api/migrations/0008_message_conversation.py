@@ -0,0 +1,42 @@
+# Generated by Django 5.2.1 on 2026-10-18 13:52
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Q
+
+
+def assign_conversations(apps, schema_editor):
+    Message = apps.get_model('comms_api', 'Message')
+    Conversation = apps.get_model('comms_api', 'Conversation')
+
+    for conversation in Conversation.objects.iterator():
+        low, high = (int(user_id) for user_id in conversation.key.split(':'))
+        Message.objects.filter(
+            Q(sender_id=low, recipient_id=high) | Q(sender_id=high, recipient_id=low)
+        ).update(conversation=conversation)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comms_api', '0007_read_watermark'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='conversation',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='messages', to='comms_api.conversation'),
+        ),
+        migrations.RunPython(assign_conversations, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation', '-timestamp', '-id'], name='message_conv_timestamp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation', 'id'], include=('sender',), name='message_conv_unread_idx'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.2.1 on 2026-10-18 13:52
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def build_friendships(apps, schema_editor):
+    FriendRequest = apps.get_model('comms_api', 'FriendRequest')
+    Friendship = apps.get_model('comms_api', 'Friendship')
+
+    friendships = []
+    for from_user_id, to_user_id in FriendRequest.objects.filter(status='ACCEPTED').values_list('from_user_id', 'to_user_id'):
+        friendships.append(Friendship(user_id=from_user_id, friend_id=to_user_id))
+        friendships.append(Friendship(user_id=to_user_id, friend_id=from_user_id))
+    Friendship.objects.bulk_create(friendships, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comms_api', '0008_message_conversation'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Friendship',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('friend', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='friendships', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'friend')},
+            },
+        ),
+        migrations.RunPython(build_friendships, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.1 on 2026-10-18 14:05
+
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comms_api', '0009_friendship'),
+        ('auth', '0012_alter_user_first_name_max_length'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        # Wyrażenia odpowiadają temu, co Django generuje dla icontains/istartswith
+        migrations.RunSQL(
+            'CREATE INDEX IF NOT EXISTS auth_user_username_trgm_idx '
+            'ON auth_user USING gin (UPPER(username::text) gin_trgm_ops)',
+            'DROP INDEX IF EXISTS auth_user_username_trgm_idx',
+        ),
+        migrations.RunSQL(
+            'CREATE INDEX IF NOT EXISTS auth_user_username_prefix_idx '
+            'ON auth_user (UPPER(username::text) text_pattern_ops)',
+            'DROP INDEX IF EXISTS auth_user_username_prefix_idx',
+        ),
+    ]
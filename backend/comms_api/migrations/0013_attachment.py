@@ -0,0 +1,120 @@
+# Generated by Django 5.2.1 on 2026-10-18 14:06
+
+import hashlib
+import comms_api.models
+import django.db.models.deletion
+from django.core.files.storage import default_storage
+from django.db import migrations, models
+
+
+def _sha256(name):
+    hasher = hashlib.sha256()
+    with default_storage.open(name, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def build_attachments(apps, schema_editor):
+    # Istniejące pliki zostają pod starymi nazwami; duplikaty treści są usuwane na końcu
+    Message = apps.get_model('comms_api', 'Message')
+    Upload = apps.get_model('comms_api', 'Upload')
+    Attachment = apps.get_model('comms_api', 'Attachment')
+
+    by_name = {}
+    by_hash = {}
+    stale = []
+
+    def attachment_for(name):
+        if name in by_name:
+            return by_name[name]
+        if not default_storage.exists(name):
+            by_name[name] = None
+            return None
+        sha256 = _sha256(name)
+        attachment = by_hash.get(sha256)
+        if attachment is None:
+            attachment = Attachment.objects.create(sha256=sha256, file=name, size=default_storage.size(name))
+            by_hash[sha256] = attachment
+        by_name[name] = attachment
+        return attachment
+
+    messages = Message.objects.exclude(file='').exclude(file__isnull=True).order_by('id')
+    for message in messages.iterator():
+        attachment = attachment_for(message.file.name)
+        if attachment is None:
+            continue
+        attachment.ref_count += 1
+        if message.thumbnail and not attachment.thumbnail:
+            attachment.thumbnail = message.thumbnail.name
+            attachment.thumbnail_width = message.thumbnail_width
+            attachment.thumbnail_height = message.thumbnail_height
+        elif message.thumbnail and message.thumbnail.name != attachment.thumbnail.name:
+            stale.append(message.thumbnail.name)
+        attachment.save()
+        Message.objects.filter(pk=message.pk).update(attachment=attachment)
+
+    uploads = Upload.objects.exclude(file='').exclude(file__isnull=True)
+    for upload in uploads.iterator():
+        attachment = attachment_for(upload.file.name)
+        if attachment is not None:
+            Upload.objects.filter(pk=upload.pk).update(attachment=attachment)
+
+    kept = {attachment.file.name for attachment in by_hash.values()}
+    stale += [name for name, attachment in by_name.items() if attachment is not None and name not in kept]
+    schema_editor.connection.on_commit(lambda: [default_storage.delete(name) for name in stale])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comms_api', '0012_message_thumbnail'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Attachment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(max_length=64, unique=True)),
+                ('file', models.FileField(upload_to=comms_api.models.attachment_path)),
+                ('size', models.PositiveBigIntegerField()),
+                ('thumbnail', models.FileField(blank=True, null=True, upload_to='thumbnails/')),
+                ('thumbnail_width', models.PositiveIntegerField(blank=True, null=True)),
+                ('thumbnail_height', models.PositiveIntegerField(blank=True, null=True)),
+                ('ref_count', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='attachment',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='messages', to='comms_api.attachment'),
+        ),
+        migrations.AddField(
+            model_name='upload',
+            name='attachment',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='comms_api.attachment'),
+        ),
+        migrations.RunPython(build_attachments, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='message',
+            name='file',
+        ),
+        migrations.RemoveField(
+            model_name='message',
+            name='thumbnail',
+        ),
+        migrations.RemoveField(
+            model_name='message',
+            name='thumbnail_height',
+        ),
+        migrations.RemoveField(
+            model_name='message',
+            name='thumbnail_width',
+        ),
+        migrations.RemoveField(
+            model_name='upload',
+            name='file',
+        ),
+    ]
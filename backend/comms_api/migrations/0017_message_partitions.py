@@ -0,0 +1,107 @@
+# Generated by Django 5.2.1 on 2026-10-18 14:38
+
+from datetime import date, datetime, timezone
+from django.conf import settings
+from django.db import migrations, models
+
+TABLE = 'comms_api_message'
+
+
+def _add_months(month, count):
+    years, month_index = divmod(month.month - 1 + count, 12)
+    return date(month.year + years, month_index + 1, 1)
+
+
+def _month_start(month):
+    return datetime(month.year, month.month, 1, tzinfo=timezone.utc)
+
+
+def partition_messages(apps, schema_editor):
+    # Postgres nie zamieni istniejącej tabeli w partycjonowaną: nowa tabela o tej samej nazwie,
+    # kopia wierszy do miesięcznych partycji, a na końcu te same indeksy i klucze obce co wcześniej.
+    # Klucz główny musi zawierać kolumnę partycjonującą, więc to (id, timestamp); id dalej jest unikalne,
+    # bo pochodzi z jednej sekwencji. Kolumna tożsamości nie jest dozwolona w tabeli partycjonowanej przed PG 17.
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT relkind FROM pg_class WHERE oid = %s::regclass", [TABLE])
+        if cursor.fetchone()[0] == 'p':
+            # Już partycjonowana (migracja cofnięta i ponowiona)
+            return
+        cursor.execute(
+            "SELECT indexdef FROM pg_indexes WHERE schemaname = current_schema() AND tablename = %s "
+            "AND indexname <> %s",
+            [TABLE, f'{TABLE}_pkey'],
+        )
+        indexes = [row[0] for row in cursor.fetchall()]
+        cursor.execute(
+            "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint WHERE conrelid = %s::regclass "
+            "AND contype = 'f'",
+            [TABLE],
+        )
+        foreign_keys = cursor.fetchall()
+        cursor.execute(
+            "SELECT attname FROM pg_attribute WHERE attrelid = %s::regclass AND attnum > 0 "
+            "AND NOT attisdropped AND attgenerated = '' ORDER BY attnum",
+            [TABLE],
+        )
+        columns = ', '.join(f'"{row[0]}"' for row in cursor.fetchall())
+        cursor.execute(f'SELECT min("timestamp") FROM {TABLE}')
+        oldest = cursor.fetchone()[0]
+
+        cursor.execute(f'ALTER TABLE {TABLE} RENAME TO {TABLE}_unpartitioned')
+        cursor.execute(
+            f'CREATE TABLE {TABLE} (LIKE {TABLE}_unpartitioned INCLUDING DEFAULTS INCLUDING GENERATED) '
+            f'PARTITION BY RANGE ("timestamp")'
+        )
+        now = datetime.now(timezone.utc).date().replace(day=1)
+        month = min(oldest.astimezone(timezone.utc).date().replace(day=1), now) if oldest else now
+        while month <= _add_months(now, settings.MESSAGE_PARTITIONS_AHEAD):
+            cursor.execute(
+                f'CREATE TABLE {TABLE}_p{month:%Y%m} PARTITION OF {TABLE} FOR VALUES FROM (%s) TO (%s)',
+                [_month_start(month), _month_start(_add_months(month, 1))],
+            )
+            month = _add_months(month, 1)
+        cursor.execute(f'CREATE TABLE {TABLE}_default PARTITION OF {TABLE} DEFAULT')
+
+        cursor.execute(f'INSERT INTO {TABLE} ({columns}) SELECT {columns} FROM {TABLE}_unpartitioned')
+        cursor.execute(f'DROP TABLE {TABLE}_unpartitioned')
+
+        cursor.execute(f'CREATE SEQUENCE {TABLE}_id_seq OWNED BY {TABLE}.id')
+        cursor.execute(f"SELECT setval('{TABLE}_id_seq', COALESCE(MAX(id), 0) + 1, false) FROM {TABLE}")
+        cursor.execute(f"ALTER TABLE {TABLE} ALTER COLUMN id SET DEFAULT nextval('{TABLE}_id_seq')")
+        cursor.execute(f'ALTER TABLE {TABLE} ADD CONSTRAINT {TABLE}_pkey PRIMARY KEY (id, "timestamp")')
+        for indexdef in indexes:
+            cursor.execute(indexdef)
+        for name, definition in foreign_keys:
+            cursor.execute(f'ALTER TABLE {TABLE} ADD CONSTRAINT "{name}" {definition}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comms_api', '0016_message_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageArchive',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField(unique=True)),
+                ('path', models.CharField(max_length=255)),
+                ('message_count', models.PositiveIntegerField()),
+                ('first_message_id', models.BigIntegerField(null=True)),
+                ('last_message_id', models.BigIntegerField(null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        # Model się nie zmienia, więc cofnięcie zostawia tabelę partycjonowaną
+        migrations.RunPython(partition_messages, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='message',
+            name='message_conv_unread_idx',
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation', 'id'], include=('sender', 'timestamp'), name='message_conv_unread_idx'),
+        ),
+    ]
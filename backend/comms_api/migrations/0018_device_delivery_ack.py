@@ -0,0 +1,37 @@
+# Generated by Django 5.2.1 on 2026-10-18 14:49
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comms_api', '0017_message_partitions'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        # Najpierw user przestaje być kluczem głównym, dopiero potem dochodzi id; istniejące znaczniki
+        # zostają jako znaczniki urządzenia bez identyfikatora (device_id='')
+        migrations.AlterField(
+            model_name='deliveryack',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='deliveryack',
+            name='device_id',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='deliveryack',
+            name='id',
+            field=models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='deliveryack',
+            unique_together={('user', 'device_id')},
+        ),
+    ]
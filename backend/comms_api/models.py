@@ -1,18 +1,254 @@
-from django.db import models
+import os
+import uuid
+from datetime import timedelta
+from django.db import models, transaction, IntegrityError
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.db.models import ProtectedError, F, Q, Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
 from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector, SearchVectorField
+
+
+# timestamp (auto_now_add) powstaje w Pythonie przed nadaniem id z sekwencji, więc przy równoległych
+# wysyłkach wiadomość z wyższym id może mieć odrobinę starszy timestamp; zapas dla warunków na timestamp
+TIMESTAMP_ORDER_MARGIN = timedelta(minutes=5)
+
+
+class MessageManager(models.Manager):
+    def get_queryset(self):
+        # tsvector jest potrzebny tylko w wyszukiwaniu, historia i zdarzenia go nie pobierają
+        return super().get_queryset().defer("search_vector")
 
 
 class Message(models.Model):
+    # Bez stemmera: polskiego słownika nie ma w standardowym Postgresie, odmianę łapie wyszukiwanie prefiksowe
+    SEARCH_CONFIG = "simple"
+
+    conversation = models.ForeignKey(
+        "Conversation", on_delete=models.PROTECT, related_name="messages", null=True, db_index=False
+    )
     sender = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.PROTECT, related_name="sent_messages")
-    recipient = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.PROTECT, related_name="received_messages")
+    # Puste w rozmowach grupowych - odbiorcami są członkowie rozmowy
+    recipient = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.PROTECT, related_name="received_messages", null=True, blank=True
+    )
     content = models.TextField(blank=True)
-    file = models.FileField(upload_to="chat_files/", null=True, blank=True)
+    attachment = models.ForeignKey(
+        "Attachment", on_delete=models.PROTECT, related_name="messages", null=True, blank=True
+    )
     file_type = models.CharField(max_length=10, blank=True)
     timestamp = models.DateTimeField(auto_now_add=True)
-    is_read = models.BooleanField(default=False)
+    # Liczony przez bazę przy każdym INSERT/UPDATE treści
+    search_vector = models.GeneratedField(
+        expression=SearchVector("content", config=SEARCH_CONFIG),
+        output_field=SearchVectorField(),
+        db_persist=True,
+    )
+
+    objects = MessageManager()
+
+    class Meta:
+        indexes = [
+            # Historia rozmowy i stronicowanie kursorem (timestamp, id)
+            models.Index(fields=["conversation", "-timestamp", "-id"], name="message_conv_timestamp_idx"),
+            # Liczenie nieprzeczytanych za znacznikiem odczytu bez sięgania do tabeli;
+            # timestamp w INCLUDE, bo warunek na nim odcina starsze partycje
+            models.Index(
+                fields=["conversation", "id"], include=["sender", "timestamp"], name="message_conv_unread_idx"
+            ),
+            # btree_gin: jeden indeks zawęża i do rozmów użytkownika, i do słów zapytania
+            GinIndex(fields=["conversation", "search_vector"], name="message_search_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.pk} | {self.sender} -> {self.recipient or self.conversation}"
+
+
+class MessageArchive(models.Model):
+    # Miesięczna partycja wiadomości przeniesiona z bazy do pliku w MESSAGE_ARCHIVE_DIR (comms_api.archive)
+    month = models.DateField(unique=True)
+    path = models.CharField(max_length=255)
+    message_count = models.PositiveIntegerField()
+    first_message_id = models.BigIntegerField(null=True)
+    last_message_id = models.BigIntegerField(null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.month:%Y-%m} ({self.message_count} messages)"
+
+
+def attachment_path(instance, filename):
+    extension = os.path.splitext(filename)[1].lower()
+    return f"chat_files/{instance.sha256[:2]}/{instance.sha256}{extension}"
+
+
+class AttachmentManager(models.Manager):
+    def store(self, content, sha256, size, extension):
+        # Ten sam plik zapisywany jest tylko raz, kolejne wiadomości dostają istniejący wiersz
+        attachment = self.filter(sha256=sha256).first()
+        if attachment is not None:
+            return attachment
+
+        attachment = Attachment(sha256=sha256, size=size)
+        attachment.file.save(f"{sha256}.{extension}", content, save=False)
+        try:
+            with transaction.atomic():
+                attachment.save()
+        except IntegrityError:
+            attachment.file.delete(save=False)
+            return self.get(sha256=sha256)
+        return attachment
+
+    def acquire(self, attachment_id):
+        self.filter(pk=attachment_id).update(ref_count=F("ref_count") + 1)
+
+    def release(self, attachment_id):
+        self.filter(pk=attachment_id, ref_count__gt=0).update(ref_count=F("ref_count") - 1)
+        orphan = self.filter(pk=attachment_id, ref_count=0).first()
+        if orphan is None:
+            return
+        files = [orphan.file, orphan.thumbnail]
+        try:
+            orphan.delete()
+        except ProtectedError:
+            # Ktoś właśnie wysłał ten sam plik ponownie
+            return
+        transaction.on_commit(lambda: [f.delete(save=False) for f in files if f])
+
+
+class Attachment(models.Model):
+    sha256 = models.CharField(max_length=64, unique=True)
+    file = models.FileField(upload_to=attachment_path)
+    size = models.PositiveBigIntegerField()
+    thumbnail = models.FileField(upload_to="thumbnails/", null=True, blank=True)
+    thumbnail_width = models.PositiveIntegerField(null=True, blank=True)
+    thumbnail_height = models.PositiveIntegerField(null=True, blank=True)
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = AttachmentManager()
+
+    def __str__(self):
+        return f"{self.sha256[:12]} ({self.size} B, {self.ref_count} refs)"
+
+
+class ConversationManager(models.Manager):
+    def get_direct(self, user_a_id, user_b_id):
+        conversation, created = self.get_or_create(key=Conversation.direct_key(user_a_id, user_b_id))
+        if created:
+            ConversationMember.objects.bulk_create(
+                [ConversationMember(conversation=conversation, user_id=user_id) for user_id in {user_a_id, user_b_id}],
+                ignore_conflicts=True,
+            )
+        return conversation
+
+    def create_group(self, creator, title, member_ids):
+        conversation = self.create(key=Conversation.group_key(), is_group=True, title=title, created_by=creator)
+        ConversationMember.objects.bulk_create(
+            [ConversationMember(conversation=conversation, user_id=user_id) for user_id in {creator.id, *member_ids}],
+            ignore_conflicts=True,
+        )
+        return conversation
+
+    def record_message(self, message):
+        # Wywoływane w tej samej transakcji co zapis wiadomości
+        self.filter(pk=message.conversation_id).update(
+            last_message_id=message.id,
+            last_message_preview=message.content[:Conversation.PREVIEW_LENGTH],
+            last_message_at=message.timestamp,
+        )
+        if message.conversation.is_group:
+            # W grupie licznik na członka oznaczałby przy każdej wiadomości nową wersję wiersza każdego z setek
+            # członków, czekającą na blokady z mark_group_read. Nieprzeczytane liczy with_unread od znacznika.
+            return
+        ConversationMember.objects.filter(conversation_id=message.conversation_id).exclude(
+            user_id=message.sender_id
+        ).update(unread_count=F("unread_count") + 1)
+
+    def mark_read(self, user, other_user_id, message_id, since=None):
+        return self._mark_read(
+            user, message_id, since, conversation__key=Conversation.direct_key(user.id, other_user_id)
+        )
+
+    def mark_group_read(self, user, conversation_id, message_id):
+        # W grupie tylko znacznik odczytu, licznik wynika z niego (ConversationMemberQuerySet.with_unread)
+        return ConversationMember.objects.filter(
+            Q(last_read_message_id__isnull=True) | Q(last_read_message_id__lt=message_id),
+            user=user,
+            conversation_id=conversation_id,
+            conversation__is_group=True,
+        ).update(last_read_message_id=message_id)
+
+    def _mark_read(self, user, message_id, since=None, **conversation_filter):
+        # Przesuwa znacznik odczytu tylko do przodu; nieprzeczytane liczone są od znacznika.
+        # since (timestamp wiadomości-znacznika) pozwala Postgresowi pominąć starsze partycje.
+        unread = Message.objects.filter(conversation=OuterRef("conversation"), id__gt=message_id)
+        if since is not None:
+            unread = unread.filter(timestamp__gte=since - TIMESTAMP_ORDER_MARGIN)
+        unread = unread.exclude(sender=user).order_by().values("conversation").annotate(
+            count=Count("pk")
+        ).values("count")
+        return ConversationMember.objects.filter(
+            Q(last_read_message_id__isnull=True) | Q(last_read_message_id__lt=message_id),
+            user=user,
+            **conversation_filter,
+        ).update(last_read_message_id=message_id, unread_count=Coalesce(Subquery(unread), 0))
+
+
+class Conversation(models.Model):
+    PREVIEW_LENGTH = 100
+
+    key = models.CharField(max_length=64, unique=True)
+    is_group = models.BooleanField(default=False)
+    title = models.CharField(max_length=100, blank=True)
+    created_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, related_name="+", null=True, blank=True
+    )
+    last_message_id = models.BigIntegerField(null=True, blank=True)
+    last_message_preview = models.CharField(max_length=PREVIEW_LENGTH, blank=True)
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = ConversationManager()
+
+    @staticmethod
+    def direct_key(user_a_id, user_b_id):
+        low, high = sorted((int(user_a_id), int(user_b_id)))
+        return f"{low}:{high}"
+
+    @staticmethod
+    def group_key():
+        return f"g:{uuid.uuid4().hex}"
+
+    def __str__(self):
+        return f"{self.pk} | {self.key}"
+
+
+class ConversationMemberQuerySet(models.QuerySet):
+    def with_unread(self):
+        # Nieprzeczytane w grupie: wiadomości innych po znaczniku odczytu, index only scan po message_conv_unread_idx
+        unread = Message.objects.filter(
+            conversation=OuterRef("conversation"), id__gt=Coalesce(OuterRef("last_read_message_id"), 0)
+        ).exclude(sender=OuterRef("user")).order_by().values("conversation").annotate(count=Count("pk")).values("count")
+        return self.annotate(unread=Coalesce(Subquery(unread), 0))
+
+
+class ConversationMember(models.Model):
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name="members")
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="conversation_memberships")
+    unread_count = models.PositiveIntegerField(default=0)
+    last_read_message_id = models.BigIntegerField(null=True, blank=True)
+
+    objects = ConversationMemberQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ('conversation', 'user')
 
     def __str__(self):
-        return f"{self.pk} | {self.sender} -> {self.recipient}"
+        return f"{self.user} @ {self.conversation} ({self.unread_count} unread)"
 
 
 class Call(models.Model):
@@ -43,7 +279,75 @@ class FriendRequest(models.Model):
         return f"{self.from_user} -> {self.to_user} ({self.status})"
 
 
+class Friendship(models.Model):
+    # Każda znajomość zapisana w obu kierunkach, więc lista znajomych to jeden odczyt po indeksie
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='friendships', on_delete=models.CASCADE)
+    friend = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='+', on_delete=models.CASCADE)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('user', 'friend')
+
+    def __str__(self):
+        return f"{self.user} <-> {self.friend}"
+
+
+class ClientMessageKey(models.Model):
+    # Klucz idempotencji nadawany przez aplikację; ponowiona wysyłka dostaje istniejącą wiadomość.
+    # Osobna tabela, żeby unikalność nie wisiała na samej tabeli wiadomości.
+    sender = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="+")
+    key = models.CharField(max_length=64)
+    message_id = models.BigIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ("sender", "key")
+
+
+class DeliveryAck(models.Model):
+    # Najwyższe id wiadomości potwierdzone przez dane urządzenie użytkownika; każde urządzenie
+    # ma własny znacznik, żeby ack z telefonu nie ukrył wiadomości przed tabletem offline
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="+")
+    device_id = models.CharField(max_length=64, blank=True)
+    last_acked_message_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ("user", "device_id")
+
+
+class Upload(models.Model):
+    # Załącznik przesyłany kawałkami przez ws/chat/; postęp to rozmiar pliku .part
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="uploads")
+    size = models.PositiveBigIntegerField()
+    extension = models.CharField(max_length=10)
+    file_type = models.CharField(max_length=10, blank=True)
+    attachment = models.ForeignKey(Attachment, on_delete=models.SET_NULL, related_name="+", null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.pk} | {self.owner} ({self.size} B)"
+
+
 class UserFCMToken(models.Model):
     user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     token = models.TextField()
     updated_at = models.DateTimeField(auto_now=True)
+
+
+@receiver(post_delete, sender=Message)
+def release_message_attachment(sender, instance, **kwargs):
+    if instance.attachment_id:
+        Attachment.objects.release(instance.attachment_id)
+
+
+class CachedUser(User):
+    # request.user zbudowany z cache uwierzytelniania (comms_api.authentication) - bez hasha hasła,
+    # więc zapis wyczyściłby kolumnę password. Do zmian trzeba pobrać User z bazy.
+    class Meta:
+        proxy = True
+
+    def save(self, *args, **kwargs):
+        raise TypeError("CachedUser is read-only, load the User from the database to save it")
@@ -1,17 +1,134 @@
 import json
+import logging
+import queue
+import threading
+import time
 import paho.mqtt.client as mqtt
 from django.conf import settings
+from comms_api.metrics import (
+    MQTT_PUBLISH_SECONDS, MQTT_QUEUE_WAIT_SECONDS, MQTT_PUBLISH_FAILURES, track_mqtt_queue
+)
 
-MQTT_HOST = settings.HOST
-MQTT_PORT = 1883
+logger = logging.getLogger(__name__)
 
+MQTT_HOST = settings.MQTT_HOST
+MQTT_PORT = settings.MQTT_PORT
 
-def send_notification(to_user_id, payload):
-    client = mqtt.Client()
-    client.connect(MQTT_HOST, MQTT_PORT, 60)
+# Wrzucany do kolejki przez stop(), żeby obudzić wątek czekający na get()
+_STOP = object()
+
+
+# Jedno połączenie z brokerem na proces: sieć i reconnect obsługuje wątek paho,
+# a publikacje idą przez ograniczoną kolejkę, więc wywołujący nigdy nie czeka na TCP.
+class MqttPublisher:
+    def __init__(self, host, port, keepalive=60, max_queue=10000):
+        self.host = host
+        self.port = port
+        self.keepalive = keepalive
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._connected = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._started = False
+        self._lock = threading.Lock()
+
+        self._client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        self._client.reconnect_delay_set(min_delay=1, max_delay=30)
+        self._client.max_queued_messages_set(max_queue)
+        self._client.on_connect = self._on_connect
+        self._client.on_disconnect = self._on_disconnect
+
+    def start(self):
+        with self._lock:
+            if self._started or self._stopping.is_set():
+                return
+            self._client.connect_async(self.host, self.port, self.keepalive)
+            self._client.loop_start()
+            self._thread = threading.Thread(target=self._drain, name="mqtt-publisher", daemon=True)
+            self._thread.start()
+            self._started = True
+
+    def stop(self, timeout=5):
+        # Zatrzymany publisher się nie wznawia - publish() po stop() tylko odrzuca wiadomości
+        with self._lock:
+            if self._stopping.is_set():
+                return
+            self._stopping.set()
+            if not self._started:
+                return
+            try:
+                self._queue.put_nowait(_STOP)
+            except queue.Full:
+                # Wątek i tak zobaczy _stopping po najbliższej wiadomości
+                pass
+            self._client.disconnect()
+            self._client.loop_stop()
+            self._started = False
+        self._thread.join(timeout)
+
+    def publish(self, topic, message):
+        if self._stopping.is_set():
+            MQTT_PUBLISH_FAILURES.labels("stopped").inc()
+            return False
+        if not self._started:
+            self.start()
+        try:
+            self._queue.put_nowait((topic, message, time.monotonic()))
+            return True
+        except queue.Full:
+            MQTT_PUBLISH_FAILURES.labels("queue_full").inc()
+            logger.warning("MQTT queue full, dropping notification for %s", topic)
+            return False
+
+    def queue_size(self):
+        return self._queue.qsize()
+
+    def _drain(self):
+        while not self._stopping.is_set():
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            topic, message, queued_at = item
+            # Bez połączenia czekamy, ale co sekundę sprawdzamy, czy nie było stop()
+            while not self._connected.wait(1):
+                if self._stopping.is_set():
+                    return
+            MQTT_QUEUE_WAIT_SECONDS.observe(time.monotonic() - queued_at)
+            with MQTT_PUBLISH_SECONDS.time():
+                info = self._client.publish(topic, message)
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                MQTT_PUBLISH_FAILURES.labels("publish_error").inc()
+                logger.warning("MQTT publish to %s failed: %s", topic, mqtt.error_string(info.rc))
 
+    def _on_connect(self, client, userdata, flags, reason_code, properties):
+        if reason_code.is_failure:
+            logger.warning("MQTT connect refused: %s", reason_code)
+            return
+        self._connected.set()
+
+    def _on_disconnect(self, client, userdata, flags, reason_code, properties):
+        self._connected.clear()
+        if reason_code != 0:
+            logger.warning("MQTT connection lost: %s", reason_code)
+
+
+_publisher = None
+_publisher_lock = threading.Lock()
+
+
+def get_publisher():
+    global _publisher
+    if _publisher is None:
+        with _publisher_lock:
+            if _publisher is None:
+                _publisher = MqttPublisher(MQTT_HOST, MQTT_PORT, max_queue=settings.MQTT_QUEUE_SIZE)
+                _publisher.start()
+                track_mqtt_queue(_publisher)
+    return _publisher
+
+
+def send_notification(to_user_id, payload):
     topic = f"user/{to_user_id}"
     message = json.dumps(payload)
 
-    client.publish(topic, message)
-    client.disconnect()
+    return get_publisher().publish(topic, message)
@@ -0,0 +1,76 @@
+import threading
+import time
+from django.conf import settings
+from comms_api.mqtt_client import send_notification
+
+
+def _new_messages_body(count):
+    if count % 10 in (2, 3, 4) and count % 100 not in (12, 13, 14):
+        return f"{count} nowe wiadomości"
+    return f"{count} nowych wiadomości"
+
+
+# Powiadomienia czekają tu przez krótkie okno, a kolejne dla tej samej rozmowy
+# (odbiorca, typ, chat_id) są sklejane w jedno "N nowych wiadomości".
+class NotificationCoalescer:
+    def __init__(self, window, batch_size=500):
+        self.window = window
+        self.batch_size = batch_size
+        self._pending = {}
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def push(self, to_user_id, payload):
+        self.push_many([to_user_id], payload)
+
+    def push_many(self, to_user_ids, payload):
+        # Cała grupa odbiorców pod jednym lockiem; wyślą się w tym samym przebiegu wątku
+        deadline = time.monotonic() + self.window
+        with self._cond:
+            for to_user_id in to_user_ids:
+                key = (int(to_user_id), payload.get("type"), payload.get("chat_id"))
+                entry = self._pending.get(key)
+                if entry is None:
+                    self._pending[key] = [deadline, 1, payload]
+                else:
+                    entry[1] += 1
+                    entry[2] = payload
+            self._cond.notify()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="notification-coalescer", daemon=True)
+                self._thread.start()
+
+    def _take_due(self):
+        with self._cond:
+            while True:
+                while not self._pending:
+                    self._cond.wait()
+                now = time.monotonic()
+                due = []
+                # Słownik zachowuje kolejność wstawiania, więc terminy są rosnące.
+                for key, (deadline, _, _) in self._pending.items():
+                    if deadline > now or len(due) >= self.batch_size:
+                        break
+                    due.append(key)
+                if due:
+                    return [(key, self._pending.pop(key)) for key in due]
+                next_deadline = next(iter(self._pending.values()))[0]
+                self._cond.wait(next_deadline - now)
+
+    def _run(self):
+        while True:
+            for (to_user_id, _, _), (_, count, payload) in self._take_due():
+                if count > 1:
+                    payload = {**payload, "body": _new_messages_body(count), "count": count}
+                send_notification(to_user_id=to_user_id, payload=payload)
+
+
+_coalescer = NotificationCoalescer(settings.NOTIFICATION_COALESCE_WINDOW)
+
+
+def queue_notification(to_user_id, payload):
+    _coalescer.push(to_user_id, payload)
+
+
+def queue_notifications(to_user_ids, payload):
+    _coalescer.push_many(to_user_ids, payload)
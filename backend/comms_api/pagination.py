@@ -0,0 +1,77 @@
+import base64
+from datetime import datetime
+from django.db.models import Q
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def parse_limit(value, default, maximum):
+    # Rozmiar strony z query params przycięty do [1, maximum]; ValueError, gdy to nie liczba
+    if value is None:
+        return default
+    return max(1, min(int(value), maximum))
+
+
+def _encode(*parts):
+    raw = "|".join(str(part) for part in parts).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def _decode(cursor, count):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+    except (ValueError, UnicodeDecodeError) as e:
+        raise InvalidCursor(cursor) from e
+    parts = raw.split("|", count - 1)
+    if len(parts) != count:
+        raise InvalidCursor(cursor)
+    return parts
+
+
+def encode_cursor(timestamp, pk):
+    return _encode(timestamp.isoformat(), pk)
+
+
+def decode_cursor(cursor):
+    timestamp, pk = _decode(cursor, 2)
+    try:
+        return datetime.fromisoformat(timestamp), int(pk)
+    except ValueError as e:
+        raise InvalidCursor(cursor) from e
+
+
+def encode_search_cursor(rank, username):
+    return _encode(rank, username)
+
+
+def decode_search_cursor(cursor):
+    rank, username = _decode(cursor, 2)
+    try:
+        return int(rank), username
+    except ValueError as e:
+        raise InvalidCursor(cursor) from e
+
+
+def encode_rank_cursor(rank, pk):
+    # repr floata odtwarza dokładnie tę samą wartość, więc porównanie rank=... trafia w wiersz
+    return _encode(repr(rank), pk)
+
+
+def decode_rank_cursor(cursor):
+    rank, pk = _decode(cursor, 2)
+    try:
+        return float(rank), int(pk)
+    except ValueError as e:
+        raise InvalidCursor(cursor) from e
+
+
+def before_cursor(cursor):
+    timestamp, pk = decode_cursor(cursor)
+    return Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=pk)
+
+
+def after_cursor(cursor):
+    timestamp, pk = decode_cursor(cursor)
+    return Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=pk)
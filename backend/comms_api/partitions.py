@@ -0,0 +1,133 @@
+import logging
+import re
+from datetime import date, datetime, timezone as dt_timezone
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from comms_api.archive import COLUMNS, invalidate_archives, write_archive
+from comms_api.models import ClientMessageKey, Message, MessageArchive
+
+logger = logging.getLogger(__name__)
+
+# Tabela wiadomości jest partycjonowana zakresami po timestamp (migracja 0017), jedna partycja na miesiąc.
+# Partycja domyślna łapie wiersze spoza założonych miesięcy, żeby spóźnione zakładanie nie blokowało zapisu.
+TABLE = Message._meta.db_table
+DEFAULT_PARTITION = f"{TABLE}_default"
+_PARTITION_NAME = re.compile(rf"^{TABLE}_p(\d{{4}})(\d{{2}})$")
+
+
+def add_months(month, count):
+    years, month_index = divmod(month.month - 1 + count, 12)
+    return date(month.year + years, month_index + 1, 1)
+
+
+def current_month():
+    return timezone.now().astimezone(dt_timezone.utc).date().replace(day=1)
+
+
+def partition_name(month):
+    return f"{TABLE}_p{month:%Y%m}"
+
+
+def _month_start(month):
+    return datetime(month.year, month.month, 1, tzinfo=dt_timezone.utc)
+
+
+def month_bounds(month):
+    return _month_start(month), _month_start(add_months(month, 1))
+
+
+def monthly_partitions():
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = %s::regclass",
+            [TABLE],
+        )
+        names = [row[0] for row in cursor.fetchall()]
+    months = []
+    for name in names:
+        match = _PARTITION_NAME.match(name)
+        if match:
+            months.append(date(int(match[1]), int(match[2]), 1))
+    return sorted(months)
+
+
+def create_partition(month):
+    name = partition_name(month)
+    start, end = month_bounds(month)
+    columns = ", ".join(connection.ops.quote_name(f.column) for f in Message._meta.concrete_fields if not f.generated)
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            f'SELECT EXISTS (SELECT 1 FROM {DEFAULT_PARTITION} WHERE "timestamp" >= %s AND "timestamp" < %s)',
+            [start, end],
+        )
+        stray = cursor.fetchone()[0]
+        if stray:
+            # Postgres nie założy partycji, dopóki jej wiersze leżą w domyślnej -
+            # przenosimy je w tej samej transakcji
+            cursor.execute(f"ALTER TABLE {TABLE} DETACH PARTITION {DEFAULT_PARTITION}")
+        cursor.execute(f"CREATE TABLE {name} PARTITION OF {TABLE} FOR VALUES FROM (%s) TO (%s)", [start, end])
+        if stray:
+            cursor.execute(
+                f'WITH moved AS (DELETE FROM {DEFAULT_PARTITION} WHERE "timestamp" >= %s AND "timestamp" < %s '
+                f"RETURNING {columns}) INSERT INTO {TABLE} ({columns}) SELECT {columns} FROM moved",
+                [start, end],
+            )
+            cursor.execute(f"ALTER TABLE {TABLE} ATTACH PARTITION {DEFAULT_PARTITION} DEFAULT")
+    logger.info("Created message partition %s", name)
+    return name
+
+
+def ensure_partitions(ahead=None):
+    # Bieżący miesiąc i kolejne; wywoływane przy starcie i cyklicznie przez message_partitions
+    ahead = settings.MESSAGE_PARTITIONS_AHEAD if ahead is None else ahead
+    existing = set(monthly_partitions())
+    month = current_month()
+    created = []
+    for i in range(ahead + 1):
+        candidate = add_months(month, i)
+        if candidate not in existing:
+            created.append(create_partition(candidate))
+    return created
+
+
+def archive_partition(month):
+    name = partition_name(month)
+    start, end = month_bounds(month)
+    filename = f"messages-{month:%Y%m}.arc"
+    settings.MESSAGE_ARCHIVE_DIR.mkdir(parents=True, exist_ok=True)
+
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            # Stara partycja nie dostaje już zapisów, blokada tylko to gwarantuje na czas eksportu
+            cursor.execute(f"LOCK TABLE {name} IN SHARE MODE")
+        # Plik zapisuje brak rozmowy jako 0, a Postgres sortuje NULL na końcu - porządek musi być ten sam co w pliku
+        rows = Message.objects.filter(timestamp__gte=start, timestamp__lt=end).order_by(
+            Coalesce("conversation_id", 0), "timestamp", "id"
+        ).values_list(*COLUMNS)
+        stats = write_archive(settings.MESSAGE_ARCHIVE_DIR / filename, rows.iterator(chunk_size=5000))
+        MessageArchive.objects.create(
+            month=month,
+            path=filename,
+            message_count=stats["count"],
+            first_message_id=stats["first_id"],
+            last_message_id=stats["last_id"],
+        )
+        # Klucze idempotencji starszych wiadomości i tak nie trafią już w ponowioną wysyłkę
+        ClientMessageKey.objects.filter(created_at__lt=end).delete()
+        with connection.cursor() as cursor:
+            # DETACH bierze na chwilę blokadę całej tabeli wiadomości; lepiej się wycofać niż czekać w kolejce
+            cursor.execute("SET LOCAL lock_timeout = '5s'")
+            cursor.execute(f"ALTER TABLE {TABLE} DETACH PARTITION {name}")
+            cursor.execute(f"DROP TABLE {name}")
+        transaction.on_commit(invalidate_archives)
+    logger.info("Archived %s messages from %s to %s", stats["count"], name, filename)
+    return stats
+
+
+def partitions_to_archive(retention_months=None):
+    retention_months = settings.MESSAGE_RETENTION_MONTHS if retention_months is None else retention_months
+    cutoff = add_months(current_month(), -retention_months)
+    return [month for month in monthly_partitions() if month < cutoff]
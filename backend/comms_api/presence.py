@@ -0,0 +1,83 @@
+import logging
+import time
+from django.conf import settings
+from redis import RedisError
+from comms_api.redis_client import get_redis, get_async_redis
+
+logger = logging.getLogger(__name__)
+
+FOREGROUND = "fg"
+BACKGROUND = "bg"
+
+# presence:<user_id> to hash: nazwa kanału (jedno urządzenie) -> "<wygasa>:<stan>".
+# Cały klucz ma TTL odświeżany pingiem, więc po awarii procesu obecność sama znika.
+
+
+def _key(user_id):
+    return f"presence:{user_id}"
+
+
+def _live_states(entries, now):
+    states = []
+    for value in entries.values():
+        expires, _, state = value.partition(":")
+        if float(expires) > now:
+            states.append(state)
+    return states
+
+
+async def touch(user_id, channel_name, state=FOREGROUND):
+    now = time.time()
+    try:
+        async with get_async_redis().pipeline(transaction=False) as pipe:
+            pipe.hset(_key(user_id), channel_name, f"{now + settings.PRESENCE_TTL:.0f}:{state}")
+            pipe.expire(_key(user_id), settings.PRESENCE_TTL)
+            await pipe.execute()
+    except RedisError:
+        logger.warning("Presence update failed for user %s", user_id, exc_info=True)
+
+
+async def leave(user_id, channel_name):
+    try:
+        await get_async_redis().hdel(_key(user_id), channel_name)
+    except RedisError:
+        logger.warning("Presence update failed for user %s", user_id, exc_info=True)
+
+
+async def is_foreground(user_id):
+    # Aplikacja na pierwszym planie na którymkolwiek urządzeniu -> push niepotrzebny.
+    # Bez Redisa lepiej wysłać push za dużo niż zgubić powiadomienie.
+    try:
+        entries = await get_async_redis().hgetall(_key(user_id))
+    except RedisError:
+        return False
+    return FOREGROUND in _live_states(entries, time.time())
+
+
+async def get_foreground_ids(user_ids):
+    # Dla grup: obecność wszystkich członków w jednym przebiegu potoku
+    user_ids = list(user_ids)
+    try:
+        async with get_async_redis().pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.hgetall(_key(user_id))
+            results = await pipe.execute()
+    except RedisError:
+        return set()
+    now = time.time()
+    return {user_id for user_id, entries in zip(user_ids, results) if FOREGROUND in _live_states(entries, now)}
+
+
+def get_online_ids(user_ids):
+    user_ids = list(user_ids)
+    if not user_ids:
+        return set()
+    try:
+        with get_redis().pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.hgetall(_key(user_id))
+            results = pipe.execute()
+    except RedisError:
+        return set()
+    now = time.time()
+    return {user_id for user_id, entries in zip(user_ids, results) if _live_states(entries, now)}
@@ -0,0 +1,88 @@
+import logging
+import time
+from collections import deque
+from django.conf import settings
+from redis import RedisError
+from comms_api import metrics
+from comms_api.redis_client import get_async_redis
+
+logger = logging.getLogger(__name__)
+
+# Kubełki żetonów w Redisie, wspólne dla wszystkich workerów i urządzeń użytkownika.
+# Skrypt sprawdza wszystkie kubełki akcji naraz: albo pobiera ze wszystkich, albo z żadnego,
+# i zwraca numer kubełka, który zablokował, oraz czas do uzupełnienia brakujących żetonów.
+TOKEN_BUCKET_LUA = """
+local now_parts = redis.call('TIME')
+local now = tonumber(now_parts[1]) + tonumber(now_parts[2]) / 1000000
+local tokens = {}
+local blocked, retry_after = 0, 0
+for i, key in ipairs(KEYS) do
+    local rate, burst, cost = tonumber(ARGV[i * 3 - 2]), tonumber(ARGV[i * 3 - 1]), tonumber(ARGV[i * 3])
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local available = tonumber(state[1]) or burst
+    local elapsed = math.max(0, now - (tonumber(state[2]) or now))
+    available = math.min(burst, available + elapsed * rate)
+    -- Pojedynczy koszt większy niż pojemność opróżnia cały kubełek zamiast blokować na zawsze
+    cost = math.min(cost, burst)
+    if available < cost and (cost - available) / rate > retry_after then
+        blocked, retry_after = i, (cost - available) / rate
+    end
+    tokens[i] = {available, cost, math.ceil(burst / rate) + 1}
+end
+for i, key in ipairs(KEYS) do
+    local available = tokens[i][1]
+    if blocked == 0 then
+        available = available - tokens[i][2]
+    end
+    redis.call('HSET', key, 'tokens', tostring(available), 'ts', tostring(now))
+    redis.call('EXPIRE', key, tokens[i][3])
+end
+return {blocked, tostring(retry_after)}
+"""
+
+
+def _limits():
+    return {
+        "message": (settings.RATE_LIMIT_MESSAGES_PER_SECOND, settings.RATE_LIMIT_MESSAGES_BURST),
+        "action": (settings.RATE_LIMIT_ACTIONS_PER_SECOND, settings.RATE_LIMIT_ACTIONS_BURST),
+        "upload_bytes": (settings.RATE_LIMIT_UPLOAD_BYTES_PER_SECOND, settings.RATE_LIMIT_UPLOAD_BYTES_BURST),
+    }
+
+
+class RateLimiter:
+    # Jeden na połączenie: kubełki są per użytkownik, a licznik odmów per połączenie
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.limits = _limits()
+        self._script = None
+        self._denials = deque()
+
+    async def acquire(self, **costs):
+        # Zwraca 0, gdy akcja mieści się w limitach, w przeciwnym razie liczbę sekund do ponowienia
+        buckets = list(costs)
+        args = []
+        for bucket in buckets:
+            args += [*self.limits[bucket], costs[bucket]]
+        try:
+            if self._script is None:
+                self._script = get_async_redis().register_script(TOKEN_BUCKET_LUA)
+            blocked, retry_after = await self._script(
+                keys=[f"ratelimit:{self.user_id}:{bucket}" for bucket in buckets], args=args
+            )
+        except RedisError:
+            # Jak przy obecności: awaria Redisa nie może zatrzymać czatu
+            logger.warning("Rate limit check failed for user %s", self.user_id, exc_info=True)
+            return 0
+        if not blocked:
+            return 0
+        metrics.WS_RATE_LIMITED.labels(buckets[int(blocked) - 1]).inc()
+        self._denials.append(time.monotonic())
+        return float(retry_after)
+
+    @property
+    def abusive(self):
+        # Klient, który ignoruje slow_down i dalej zasypuje serwer, zostaje rozłączony
+        horizon = time.monotonic() - settings.RATE_LIMIT_ABUSE_WINDOW
+        while self._denials and self._denials[0] < horizon:
+            self._denials.popleft()
+        return len(self._denials) > settings.RATE_LIMIT_ABUSE_DENIALS
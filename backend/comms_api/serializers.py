@@ -1,24 +1,39 @@
 from rest_framework import serializers
 from django.contrib.auth.models import User
-from django.db.models import Q
 from django.utils import timezone
-from comms_api.models import Message, Call, FriendRequest
+from comms_api.media import media_url
+from comms_api.models import Message, Call, FriendRequest, ConversationMember
 
 
 class MessageSerializer(serializers.ModelSerializer):
     sender_name = serializers.CharField(source="sender.username")
     file_url = serializers.SerializerMethodField()
+    thumbnail_url = serializers.SerializerMethodField()
+    thumbnail_width = serializers.IntegerField(source="attachment.thumbnail_width", read_only=True)
+    thumbnail_height = serializers.IntegerField(source="attachment.thumbnail_height", read_only=True)
 
     class Meta:
         model = Message
-        fields = ["id", "sender_name", "content", "file_url", "file_type", "timestamp"]
+        fields = [
+            "id", "sender_id", "sender_name", "content", "file_url", "file_type",
+            "thumbnail_url", "thumbnail_width", "thumbnail_height", "timestamp"
+        ]
 
-    def get_file_url(self, obj):
+    # Z widoku przychodzi request, z konsumera WebSocket samo user_id
+    def _viewer(self):
         request = self.context.get("request")
-        if obj.file and hasattr(obj.file, "url"):
-            if request:
-                return request.build_absolute_uri(obj.file.url)
-            return obj.file.url
+        if request is not None:
+            return request.user.id, request
+        return self.context["user_id"], None
+
+    def get_file_url(self, obj):
+        if obj.attachment:
+            return media_url(obj, *self._viewer())
+        return None
+
+    def get_thumbnail_url(self, obj):
+        if obj.attachment and obj.attachment.thumbnail:
+            return media_url(obj, *self._viewer(), variant="thumbnail")
         return None
 
 
@@ -67,51 +82,72 @@ class UserSerializer(serializers.ModelSerializer):
     lastMessage = serializers.SerializerMethodField()
     hasNewMessage = serializers.SerializerMethodField()
     timestamp = serializers.SerializerMethodField()
+    isOnline = serializers.SerializerMethodField()
 
     class Meta:
         model = User
-        fields = ["id", "username", "lastMessage", "hasNewMessage", "timestamp"]
+        fields = ["id", "username", "lastMessage", "hasNewMessage", "timestamp", "isOnline"]
 
+    # Pola last_message_* i unread_count pochodzą z adnotacji w FriendsListView
     def get_lastMessage(self, obj):
-        user = self.context.get("request").user
-        message = Message.objects.filter(
-            Q(sender=user, recipient=obj) | Q(sender=obj, recipient=user)
-        ).order_by("-timestamp").first()
+        if obj.last_message_at is None:
+            return None
+        return obj.last_message_preview
 
-        return message.content if message else None
-    
     def get_hasNewMessage(self, obj):
-        user = self.context.get("request").user
-        message = Message.objects.filter(
-            Q(sender=user, recipient=obj) | Q(sender=obj, recipient=user)
-        ).order_by("-timestamp").first()
+        return bool(obj.unread_count)
 
-        return not message.is_read
+    def get_isOnline(self, obj):
+        return obj.id in self.context.get("online_ids", ())
 
     def get_timestamp(self, obj):
-        user = self.context.get("request").user
-        message = Message.objects.filter(
-            Q(sender=user, recipient=obj) | Q(sender=obj, recipient=user)
-        ).order_by("-timestamp").first()
+        return relative_time(obj.last_message_at)
+
+
+class GroupSerializer(serializers.ModelSerializer):
+    # Serializuje członkostwo zalogowanego użytkownika z adnotacją with_unread - stąd licznik nieprzeczytanych
+    id = serializers.IntegerField(source="conversation.id")
+    title = serializers.CharField(source="conversation.title")
+    lastMessage = serializers.SerializerMethodField()
+    hasNewMessage = serializers.SerializerMethodField()
+    unreadCount = serializers.IntegerField(source="unread")
+    timestamp = serializers.SerializerMethodField()
 
-        if not message:
+    class Meta:
+        model = ConversationMember
+        fields = ["id", "title", "lastMessage", "hasNewMessage", "unreadCount", "timestamp"]
+
+    def get_lastMessage(self, obj):
+        if obj.conversation.last_message_at is None:
             return None
+        return obj.conversation.last_message_preview
+
+    def get_hasNewMessage(self, obj):
+        return bool(obj.unread)
+
+    def get_timestamp(self, obj):
+        return relative_time(obj.conversation.last_message_at)
+
+
+def relative_time(value):
+    if value is None:
+        return None
 
-        now = timezone.now()
-        delta = now - message.timestamp
-
-        seconds = delta.total_seconds()
-        minutes = seconds // 60
-        hours = minutes // 60
-        days = delta.days
-
-        if minutes < 1:
-            return "just now"
-        elif minutes < 60:
-            return f"{int(minutes)} m"
-        elif hours < 24:
-            return f"{int(hours)} h"
-        elif days < 30:
-            return f"{int(days)} d"
-        else:
-            return message.timestamp.strftime("%Y-%m-%d")  # fallback: exact date
+    now = timezone.now()
+    delta = now - value
+
+    seconds = delta.total_seconds()
+    minutes = seconds // 60
+    hours = minutes // 60
+    days = delta.days
+
+    if minutes < 1:
+        return "just now"
+    elif minutes < 60:
+        return f"{int(minutes)} m"
+    elif hours < 24:
+        return f"{int(hours)} h"
+    elif days < 30:
+        return f"{int(days)} d"
+    else:
+        return value.strftime("%Y-%m-%d")  # fallback: exact date
@@ -1,3 +1,1338 @@
-from django.test import TestCase
+import asyncio
+import json
+import msgpack
+import os
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures.process import BrokenProcessPool
+from datetime import timedelta
+from io import BytesIO
+from pathlib import Path
+from unittest import mock, skipUnless
+from asgiref.sync import async_to_sync
+from channels.testing import WebsocketCommunicator
+from PIL import Image
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.models import Count
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken
+from prometheus_client import REGISTRY
+from redis import RedisError
+from comms_api import presence
+from comms_api.consumers import (
+    MSGPACK_SUBPROTOCOL, RATE_LIMIT_CLOSE_CODE, ChatConsumer, create_message, get_last_ack, get_missed_messages, record_ack,
+    store_direct_message,
+)
+from comms_api.archive import open_archive
+from comms_api.db_executor import DBExecutor
+from comms_api.ephemeral import EphemeralThrottle, is_stale
+from comms_api.authentication import _cache_key, get_user
+from comms_api.friends import are_friends
+from comms_api.groups import add_members, create_group, remove_member
+from comms_api.metrics import MQTT_PUBLISH_FAILURES
+from comms_api.mqtt_client import MqttPublisher
+from comms_api.notifications import NotificationCoalescer, _new_messages_body
+from comms_api.media import RangeNotSatisfiable, message_media_url, parse_range, signed_media_user
+from comms_api.models import (
+    TIMESTAMP_ORDER_MARGIN, Attachment, DeliveryAck, Message, MessageArchive, Conversation, ConversationMember,
+    FriendRequest, Upload,
+)
+from comms_api import thumbnails
+from comms_api.imaging import render_thumbnail
+from comms_api.pagination import before_cursor, encode_cursor
+from comms_api.ratelimit import RateLimiter
+from comms_api.uploads import UploadError, part_path, resume_upload, start_upload, store_bytes, sweep_uploads
+from comms_api.partitions import add_months, create_partition, current_month, monthly_partitions, partition_name
 
-# Create your tests here.
+
+@skipUnless(connection.vendor == "postgresql", "EXPLAIN plans are PostgreSQL specific")
+class MessageIndexTests(TransactionTestCase):
+    # TransactionTestCase, bo VACUUM nie działa w transakcji, a bez niego mapa widoczności
+    # jest pusta i planner nie ma powodu wybierać index only scan
+    def setUp(self):
+        self.alice = User.objects.create_user("alice", password="secret")
+        self.bob = User.objects.create_user("bob", password="secret")
+        self.carol = User.objects.create_user("carol", password="secret")
+        for i in range(40):
+            create_message(sender=self.alice, recipient_id=self.bob.id, content=f"ab {i}")
+            create_message(sender=self.carol, recipient_id=self.alice.id, content=f"ca {i}")
+        self.conversation = Conversation.objects.get(key=Conversation.direct_key(self.alice.id, self.bob.id))
+        with connection.cursor() as cursor:
+            cursor.execute("VACUUM ANALYZE comms_api_message")
+
+    def explain(self, queryset):
+        # Na kilkudziesięciu wierszach planner i tak wybrałby seq scan albo bitmap scan
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute("SET LOCAL enable_seqscan = off")
+            cursor.execute("SET LOCAL enable_bitmapscan = off")
+            return queryset.explain()
+
+    def partition_indexes(self, index_name):
+        # Indeks tabeli partycjonowanej to w planie osobne indeksy partycji, z nazwami nadanymi przez Postgresa
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                "WHERE i.inhparent = %s::regclass",
+                [index_name],
+            )
+            return {row[0] for row in cursor.fetchall()}
+
+    def assertUsesIndex(self, plan, index_name, index_only=False):
+        scan = "Index Only Scan" if index_only else "Index Scan"
+        used = re.findall(r"(Index Only Scan|Index Scan) using (\S+) on comms_api_message", plan)
+        self.assertTrue(used, plan)
+        indexes = self.partition_indexes(index_name)
+        for kind, name in used:
+            self.assertEqual(kind, scan, plan)
+            self.assertIn(name, indexes, plan)
+        self.assertNotIn("Seq Scan on comms_api_message", plan)
+        # Merge Append łączy posortowane partycje i też wypisuje "Sort Key", ale nie sortuje
+        self.assertNotRegex(plan, r"(^|->)\s*(Incremental )?Sort\b")
+
+    def test_history_page_uses_conversation_index(self):
+        messages = Message.objects.filter(
+            conversation=self.conversation
+        ).select_related("sender").order_by("-timestamp", "-id")[:20]
+
+        self.assertUsesIndex(self.explain(messages), "message_conv_timestamp_idx")
+
+    def test_history_cursor_page_uses_conversation_index(self):
+        pivot = Message.objects.filter(conversation=self.conversation).order_by("-timestamp", "-id")[10]
+        messages = Message.objects.filter(
+            before_cursor(encode_cursor(pivot.timestamp, pivot.id)), conversation=self.conversation
+        ).order_by("-timestamp", "-id")[:20]
+
+        plan = self.explain(messages)
+        self.assertUsesIndex(plan, "message_conv_timestamp_idx")
+        # Kursor ogranicza timestamp z góry, więc późniejsze partycje wypadają z planu
+        self.assertNotIn(partition_name(add_months(current_month(), 1)), plan)
+
+    def test_last_message_is_index_only(self):
+        last_message = Message.objects.filter(
+            conversation=self.conversation
+        ).order_by("-timestamp", "-id").values("id", "timestamp")[:1]
+
+        self.assertUsesIndex(self.explain(last_message), "message_conv_timestamp_idx", index_only=True)
+
+    def test_unread_count_is_index_only(self):
+        unread = Message.objects.filter(
+            conversation=self.conversation, id__gt=self.conversation.last_message_id - 10
+        ).exclude(sender=self.bob).values("id")
+
+        self.assertUsesIndex(self.explain(unread), "message_conv_unread_idx", index_only=True)
+
+    def test_unread_count_since_marker_skips_older_partitions(self):
+        older = add_months(current_month(), -1)
+        if older not in monthly_partitions():
+            create_partition(older)
+        marker = Message.objects.filter(conversation=self.conversation).order_by("-timestamp", "-id")[10]
+        unread = Message.objects.filter(
+            conversation=self.conversation, id__gt=marker.id, timestamp__gte=marker.timestamp - TIMESTAMP_ORDER_MARGIN
+        ).exclude(sender=self.bob).values("id")
+
+        plan = self.explain(unread)
+        self.assertUsesIndex(plan, "message_conv_unread_idx", index_only=True)
+        self.assertNotIn(partition_name(older), plan)
+
+
+class EndpointQueryTests(TransactionTestCase):
+    # Liczba zapytań nie może rosnąć z liczbą znajomych, zaproszeń ani długością historii.
+    # Z QUERY_BENCH_REPORT=<plik> czasy odpowiedzi lądują w JSON-ie do porównań między commitami.
+    timings = {}
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        report = os.getenv("QUERY_BENCH_REPORT")
+        if report:
+            with open(report, "w") as f:
+                json.dump({
+                    name: {"count": len(values), "min_ms": round(min(values) * 1000, 3), "max_ms": round(max(values) * 1000, 3)}
+                    for name, values in cls.timings.items()
+                }, f, indent=2)
+
+    def setUp(self):
+        with open(os.devnull, "w") as devnull:
+            call_command("seed_data", users=40, friends=6, pending=3, messages=3000, seed=21, stdout=devnull)
+        users = User.objects.filter(username__startswith="seed_").annotate(friend_count=Count("friendships"))
+        self.popular = users.order_by("-friend_count", "id").first()
+        self.loner = users.order_by("friend_count", "id").first()
+        busiest = Conversation.objects.annotate(size=Count("messages")).order_by("-size").first()
+        user_id, self.busiest_friend_id = map(int, busiest.key.split(":"))
+        self.busiest_user = User.objects.get(id=user_id)
+        cache.clear()
+
+    def get(self, name, user, url):
+        client = APIClient()
+        client.force_authenticate(user)
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            response = client.get(url)
+            self.timings.setdefault(name, []).append(time.perf_counter() - started)
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_friends_list_queries_do_not_grow_with_friends(self):
+        response, queries = self.get("friends_list", self.popular, "/api/friends/")
+        _, loner_queries = self.get("friends_list", self.loner, "/api/friends/")
+
+        self.assertGreater(len(response.data), 1)
+        self.assertLessEqual(queries, 2)
+        self.assertEqual(queries, loner_queries)
+
+    def test_chat_history_queries_do_not_grow_with_page_size(self):
+        url = f"/api/chat/history/?user_id={self.busiest_friend_id}"
+        response, queries = self.get("chat_history", self.busiest_user, url + "&limit=100")
+        _, small_page_queries = self.get("chat_history", self.busiest_user, url + "&limit=5")
+        _, older_page_queries = self.get(
+            "chat_history", self.busiest_user, url + f"&before={response.data['nextCursor']}"
+        )
+
+        self.assertEqual(len(response.data["data"]), 100)
+        self.assertLessEqual(queries, 4)
+        self.assertLessEqual(small_page_queries, 4)
+        self.assertLessEqual(older_page_queries, 3)
+
+    def test_user_search_is_single_query(self):
+        response, queries = self.get("user_search", self.popular, "/api/users/search/?q=seed_1&limit=50")
+
+        self.assertGreater(len(response.data), 1)
+        self.assertLessEqual(queries, 2)
+
+    def test_friend_requests_queries_do_not_grow_with_requests(self):
+        busiest = User.objects.annotate(received=Count("received_requests")).order_by("-received").first()
+        FriendRequest.objects.bulk_create([
+            FriendRequest(from_user=sender, to_user=busiest)
+            for sender in User.objects.exclude(id=busiest.id).exclude(sent_requests__to_user=busiest)[:10]
+        ])
+        response, queries = self.get("friend_requests", busiest, "/api/friends/requests/")
+
+        self.assertGreaterEqual(len(response.data["received"]), 10)
+        self.assertLessEqual(queries, 2)
+
+    def test_message_search_queries_do_not_grow_with_page_size(self):
+        url = "/api/messages/search/?q=spotkanie"
+        response, queries = self.get("message_search", self.busiest_user, url + "&limit=50")
+        _, small_page_queries = self.get("message_search", self.busiest_user, url + "&limit=5")
+
+        self.assertGreater(len(response.data["data"]), 5)
+        self.assertLessEqual(queries, 2)
+        self.assertEqual(queries, small_page_queries)
+
+
+class SeedDataTests(TestCase):
+    def test_messages_keep_spread_timestamps(self):
+        with open(os.devnull, "w") as devnull:
+            call_command("seed_data", users=6, friends=2, messages=60, days=90, seed=3, stdout=devnull)
+
+        timestamps = list(Message.objects.order_by("id").values_list("timestamp", flat=True))
+        self.assertEqual(len(timestamps), 60)
+        self.assertEqual(timestamps, sorted(timestamps))
+        self.assertGreater(timestamps[-1] - timestamps[0], timedelta(days=80))
+        for conversation in Conversation.objects.exclude(last_message_id=None):
+            last = conversation.messages.order_by("-id").first()
+            self.assertEqual((conversation.last_message_id, conversation.last_message_at), (last.id, last.timestamp))
+        self.assertTrue(Message._meta.get_field("timestamp").auto_now_add)
+
+
+class FriendRequestResponseTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user("alice", password="secret")
+        self.bob = User.objects.create_user("bob", password="secret")
+        self.mallory = User.objects.create_user("mallory", password="secret")
+        self.request = FriendRequest.objects.create(from_user=self.alice, to_user=self.bob)
+
+    def client_for(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client
+
+    def test_only_recipient_can_accept_pending_request(self):
+        url = f"/api/friends/request/{self.request.pk}/"
+
+        self.assertEqual(self.client_for(self.mallory).patch(url).status_code, 404)
+        self.assertEqual(self.client_for(self.alice).patch(url).status_code, 404)
+        self.assertFalse(are_friends(self.alice.id, self.bob.id))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.client_for(self.bob).patch(url).status_code, 204)
+        self.assertEqual(self.client_for(self.bob).patch(url).status_code, 400)
+        self.assertTrue(are_friends(self.alice.id, self.bob.id))
+
+    def test_deleting_accepted_request_removes_friendship(self):
+        url = f"/api/friends/request/{self.request.pk}/"
+        self.client_for(self.bob).patch(url)
+
+        self.assertEqual(self.client_for(self.mallory).delete(url).status_code, 404)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.client_for(self.alice).delete(url).status_code, 204)
+        self.assertFalse(are_friends(self.alice.id, self.bob.id))
+        self.assertFalse(are_friends(self.bob.id, self.alice.id))
+
+
+class ChatHistoryParamsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user("alice", password="secret")
+        self.bob = User.objects.create_user("bob", password="secret")
+        self.messages = [
+            create_message(sender=self.alice, recipient_id=self.bob.id, content=f"m {i}")[0] for i in range(5)
+        ]
+        self.client = APIClient()
+        self.client.force_authenticate(self.bob)
+
+    def history(self, params):
+        return self.client.get(f"/api/chat/history/?user_id={self.alice.id}&{params}")
+
+    def test_invalid_limit_and_offset_are_rejected(self):
+        for params in ("limit=abc", "offset=abc", "offset=-1"):
+            with self.subTest(params=params):
+                self.assertEqual(self.history(params).status_code, 400)
+
+    def test_limit_is_clamped(self):
+        self.assertEqual(len(self.history("limit=0").data["data"]), 1)
+        self.assertEqual(len(self.history("limit=-5").data["data"]), 1)
+        with mock.patch("comms_api.views.ChatHistoryView.MAX_LIMIT", 3):
+            self.assertEqual(len(self.history("limit=100000").data["data"]), 3)
+
+    def test_around_with_single_message_page(self):
+        pivot = self.messages[2]
+        response = self.history(f"around={pivot.id}&limit=1")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([message["id"] for message in response.data["data"]], [pivot.id])
+
+
+class DeliveryTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user("alice", password="secret")
+        self.bob = User.objects.create_user("bob", password="secret")
+
+    def send(self, content, **extra):
+        return store_direct_message(self.alice, self.bob.id, {"message": content, **extra})
+
+    def test_retried_send_with_same_client_id_is_stored_once(self):
+        message, created = self.send("hej", client_id="c-1")
+        retried, retried_created = self.send("hej", client_id="c-1")
+
+        self.assertTrue(created)
+        self.assertFalse(retried_created)
+        self.assertEqual(retried.id, message.id)
+        self.assertEqual(Message.objects.filter(content="hej").count(), 1)
+        self.assertTrue(self.send("hej", client_id="c-2")[1])
+
+    def test_ack_watermark_is_per_device_and_never_moves_back(self):
+        record_ack(self.bob, "phone", 10)
+        record_ack(self.bob, "phone", 7)
+        record_ack(self.bob, "tablet", 3)
+
+        self.assertEqual(get_last_ack(self.bob, "phone"), 10)
+        self.assertEqual(get_last_ack(self.bob, "tablet"), 3)
+        self.assertEqual(get_last_ack(self.bob, ""), 0)
+
+    def test_resume_is_batched_after_ack(self):
+        ids = [self.send(f"m {i}")[0].id for i in range(6)]
+
+        overlap, newer = get_missed_messages(self.bob, 0, 4)
+        self.assertEqual(overlap, [])
+        self.assertEqual([message.id for message in newer], ids[:5])
+
+        with override_settings(RESUME_ACK_OVERLAP_SECONDS=0):
+            overlap, newer = get_missed_messages(self.bob, ids[3], 4)
+        self.assertEqual([message.id for message in newer], ids[4:])
+
+    def test_resume_replays_recent_messages_below_ack(self):
+        old, _ = self.send("old")
+        late, _ = self.send("late")
+        acked, _ = self.send("acked")
+        Message.objects.filter(pk=old.pk).update(timestamp=acked.timestamp - timedelta(minutes=1))
+
+        with override_settings(RESUME_ACK_OVERLAP_SECONDS=5):
+            overlap, newer = get_missed_messages(self.bob, acked.id, 10)
+
+        self.assertEqual([message.id for message in overlap], [late.id])
+        self.assertEqual(newer, [])
+
+    def test_malformed_ack_and_resume_frames_do_not_raise(self):
+        consumer = ChatConsumer()
+        consumer.user = self.bob
+        consumer.send_event = mock.AsyncMock()
+
+        for data in ({}, {"id": "x"}, {"id": 5, "device_id": 7}):
+            async_to_sync(consumer.handle_ack)(data)
+        async_to_sync(consumer.handle_resume)({"after": "x"})
+
+        self.assertFalse(DeliveryAck.objects.exists())
+        self.assertEqual(consumer.send_event.call_args.args[0]["type"], "error")
+
+
+class GroupTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user("alice", password="secret")
+        self.bob = User.objects.create_user("bob", password="secret")
+        self.carol = User.objects.create_user("carol", password="secret")
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+        friends = mock.patch("comms_api.views.get_friend_ids", return_value={self.bob.id, self.carol.id})
+        friends.start()
+        self.addCleanup(friends.stop)
+        layer = mock.patch("comms_api.groups.get_channel_layer")
+        self.channel_layer = layer.start().return_value
+        self.channel_layer.group_send = mock.AsyncMock()
+        self.addCleanup(layer.stop)
+
+    def create(self, member_ids):
+        with self.captureOnCommitCallbacks(execute=True):
+            return create_group(self.alice, "grupa", member_ids)
+
+    def sent_events(self):
+        return [(call.args[0], call.args[1]["type"]) for call in self.channel_layer.group_send.call_args_list]
+
+    def test_invalid_user_ids_are_rejected(self):
+        group = self.create([self.bob.id])
+        for user_ids in (["x"], [None], "1,2", {"id": 1}):
+            with self.subTest(user_ids=user_ids):
+                response = self.client.post("/api/groups/", {"title": "t", "userIds": user_ids}, format="json")
+                self.assertEqual(response.status_code, 400)
+                response = self.client.post(
+                    f"/api/groups/{group.id}/members/", {"userIds": user_ids}, format="json"
+                )
+                self.assertEqual(response.status_code, 400)
+
+        outsider = User.objects.create_user("dave", password="secret")
+        response = self.client.post("/api/groups/", {"title": "t", "userIds": [outsider.id]}, format="json")
+        self.assertEqual(response.status_code, 400)
+
+    def test_create_group_and_membership_notifications(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post("/api/groups/", {"title": "grupa", "userIds": [self.bob.id]}, format="json")
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data["unreadCount"], 0)
+        conversation_id = response.data["id"]
+        self.assertEqual(
+            set(self.sent_events()),
+            {(f"user_{self.alice.id}", "group.joined"), (f"user_{self.bob.id}", "group.joined")},
+        )
+
+        self.channel_layer.group_send.reset_mock()
+        with self.captureOnCommitCallbacks(execute=True):
+            add_members(conversation_id, [self.carol.id, self.bob.id])
+        self.assertEqual(self.sent_events(), [(f"user_{self.carol.id}", "group.joined")])
+
+        self.channel_layer.group_send.reset_mock()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertTrue(remove_member(conversation_id, self.bob.id))
+        self.assertEqual(self.sent_events(), [(f"user_{self.bob.id}", "group.left")])
+        self.assertEqual(
+            set(ConversationMember.objects.filter(conversation_id=conversation_id).values_list("user_id", flat=True)),
+            {self.alice.id, self.carol.id},
+        )
+
+    def test_unread_count_follows_read_watermark(self):
+        group = self.create([self.bob.id, self.carol.id])
+        create_message(sender=self.alice, conversation=group, content="moja")
+        for i in range(3):
+            create_message(sender=self.bob, conversation=group, content=f"m {i}")
+
+        # Zapis wiadomości nie dotyka wierszy członków
+        self.assertFalse(ConversationMember.objects.filter(conversation=group).exclude(unread_count=0).exists())
+        unread = dict(ConversationMember.objects.filter(conversation=group).with_unread().values_list("user_id", "unread"))
+        self.assertEqual(unread, {self.alice.id: 3, self.bob.id: 1, self.carol.id: 4})
+
+        response = self.client.get("/api/groups/")
+        self.assertEqual(response.data[0]["unreadCount"], 3)
+        self.assertTrue(response.data[0]["hasNewMessage"])
+
+        self.client.get(f"/api/chat/history/?conversation_id={group.id}")
+        response = self.client.get("/api/groups/")
+        self.assertEqual(response.data[0]["unreadCount"], 0)
+        self.assertFalse(response.data[0]["hasNewMessage"])
+
+    def test_group_message_is_one_group_send(self):
+        group = self.create([self.bob.id, self.carol.id])
+        message = create_message(sender=self.alice, conversation=group, content="hej")[0]
+        consumer = ChatConsumer()
+        consumer.user = self.alice
+        consumer.channel_layer = mock.Mock()
+        consumer.send_event = mock.AsyncMock()
+        stored = (message, True, group, frozenset({self.alice.id, self.bob.id, self.carol.id}))
+
+        with mock.patch("comms_api.consumers.run_db", mock.AsyncMock(return_value=stored)), \
+                mock.patch("comms_api.consumers.metrics.group_send", mock.AsyncMock()) as group_send, \
+                mock.patch("comms_api.consumers.presence.get_foreground_ids", mock.AsyncMock(return_value=set())), \
+                mock.patch("comms_api.consumers.queue_notifications") as queue:
+            async_to_sync(consumer.handle_send_message)({"conversation_id": group.id, "message": "hej"})
+
+        group_send.assert_awaited_once()
+        self.assertEqual(group_send.call_args.args[1], f"conversation_{group.id}")
+        self.assertEqual(queue.call_args.args[0], {self.bob.id, self.carol.id})
+
+
+class AuthenticationTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user("alice", password="secret")
+        cache.clear()
+
+    def login(self, password="secret"):
+        response = APIClient().post("/api/login/", {"username": "alice", "password": password})
+        self.assertEqual(response.status_code, 200)
+        return response.data["access"]
+
+    def get_friends(self, access):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f"Bearer {access}")
+        return client.get("/api/friends/")
+
+    def test_password_change_revokes_issued_tokens(self):
+        access = self.login()
+        self.assertEqual(self.get_friends(access).status_code, 200)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.alice.set_password("changed")
+            self.alice.save()
+
+        self.assertEqual(self.get_friends(access).status_code, 401)
+        self.assertEqual(self.get_friends(self.login("changed")).status_code, 200)
+
+    def test_deactivated_user_is_rejected(self):
+        token = AccessToken(self.login())
+        get_user(token)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.alice.is_active = False
+            self.alice.save(update_fields=["is_active"])
+
+        with self.assertRaises(AuthenticationFailed):
+            get_user(token)
+
+    def test_cached_lookup_builds_fresh_user_without_password(self):
+        token = AccessToken(self.login())
+        first = get_user(token)
+        with self.assertNumQueries(0):
+            second = get_user(token)
+
+        self.assertEqual((second.id, second.username), (self.alice.id, "alice"))
+        self.assertIsNot(first, second)
+        values, _ = cache.get(_cache_key(self.alice.id))
+        self.assertNotIn(self.alice.password, values)
+        self.assertFalse(second.password)
+
+    def test_cached_user_keeps_permission_fields_and_refuses_save(self):
+        User.objects.filter(pk=self.alice.pk).update(is_staff=True, email="alice@example.com")
+        user = get_user(AccessToken(self.login()))
+
+        self.assertTrue(user.is_staff)
+        self.assertEqual(user.email, "alice@example.com")
+        with self.assertRaises(TypeError):
+            user.save()
+        self.assertTrue(User.objects.get(pk=self.alice.pk).check_password("secret"))
+
+    def test_token_without_version_expires_after_access_lifetime(self):
+        token = AccessToken.for_user(self.alice)
+        self.assertEqual(get_user(token), self.alice)
+
+        token.set_iat(at_time=timezone.now() - api_settings.ACCESS_TOKEN_LIFETIME - timedelta(seconds=1))
+        with self.assertRaises(AuthenticationFailed):
+            get_user(token)
+
+
+class MediaSignatureTests(SimpleTestCase):
+    def signature(self, message_id, user_id):
+        return message_media_url(message_id, user_id).split("sig=")[1]
+
+    def test_signature_is_bound_to_message(self):
+        signature = self.signature(5, 7)
+
+        self.assertEqual(signed_media_user(signature, 5), 7)
+        self.assertIsNone(signed_media_user(signature, 6))
+        self.assertIsNone(signed_media_user(signature + "x", 5))
+        self.assertIsNone(signed_media_user(None, 5))
+
+    @override_settings(MEDIA_URL_MAX_AGE=7 * 24 * 3600, MEDIA_URL_STABLE_FOR=24 * 3600)
+    def test_link_is_stable_within_window_and_expires(self):
+        now = 1_800_000_000
+        with mock.patch("time.time", return_value=now):
+            signature = self.signature(5, 7)
+        with mock.patch("time.time", return_value=now + 60):
+            self.assertEqual(self.signature(5, 7), signature)
+        with mock.patch("time.time", return_value=now + 6 * 24 * 3600):
+            self.assertEqual(signed_media_user(signature, 5), 7)
+        with mock.patch("time.time", return_value=now + 8 * 24 * 3600):
+            self.assertIsNone(signed_media_user(signature, 5))
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user("alice", password="secret")
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def requests(self, view, method="GET", status=200):
+        return REGISTRY.get_sample_value(
+            "comms_http_request_seconds_count", {"view": view, "method": method, "status": str(status)}
+        ) or 0
+
+    def test_middleware_labels_requests_by_route(self):
+        route = "api/groups/<int:conversation_id>/members/"
+        before = self.requests(route, status=404), self.requests("unmatched", status=404)
+
+        self.client.get("/api/groups/123/members/")
+        self.client.get("/api/groups/456/members/")
+        self.client.get("/no/such/path/")
+
+        self.assertEqual(self.requests(route, status=404), before[0] + 2)
+        self.assertEqual(self.requests("unmatched", status=404), before[1] + 1)
+
+    def test_metrics_require_configured_token(self):
+        with override_settings(METRICS_TOKEN=""):
+            self.assertEqual(self.client.get("/metrics").status_code, 404)
+        with override_settings(METRICS_TOKEN="s3cret"):
+            self.assertEqual(self.client.get("/metrics").status_code, 401)
+            self.assertEqual(self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer wrong").status_code, 401)
+            response = self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer s3cret")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"comms_http_request_seconds", response.content)
+
+
+class DBExecutorTests(SimpleTestCase):
+    def setUp(self):
+        self.executor = DBExecutor(workers=2, warn_queue=1, conn_max_age=60)
+        self.addCleanup(self.executor._executor.shutdown)
+
+    def test_run_uses_pool_threads_with_persistent_connections(self):
+        def where():
+            return threading.current_thread().name, connection.settings_dict["CONN_MAX_AGE"]
+
+        name, max_age = async_to_sync(self.executor.run)(where)
+
+        self.assertTrue(name.startswith("comms-db"))
+        self.assertEqual(max_age, 60)
+        self.assertEqual(connection.settings_dict.get("CONN_MAX_AGE", 0), 0)
+
+    def test_stats_count_in_flight_and_queued(self):
+        release = threading.Event()
+
+        async def run():
+            tasks = [asyncio.ensure_future(self.executor.run(release.wait)) for _ in range(4)]
+            await asyncio.sleep(0.05)
+            busy = self.executor.stats(reset=True)
+            release.set()
+            await asyncio.gather(*tasks)
+            return busy
+
+        with self.assertLogs("comms_api.db_executor", "WARNING"):
+            busy = async_to_sync(run)()
+
+        self.assertEqual(busy, {"workers": 2, "in_flight": 4, "queued": 2, "max_queued": 2})
+        # Reset zostawia bieżącą kolejkę jako punkt wyjścia następnego odczytu
+        self.assertEqual(self.executor.stats(reset=True)["max_queued"], 2)
+        self.assertEqual(self.executor.stats(), {"workers": 2, "in_flight": 0, "queued": 0, "max_queued": 0})
+
+    def test_close_connections_runs_in_every_worker(self):
+        threads = set()
+        with mock.patch("comms_api.db_executor.connections") as connections:
+            connections.close_all.side_effect = lambda: threads.add(threading.current_thread().name)
+            self.executor.close_connections()
+
+        self.assertEqual(len(threads), 2)
+
+
+class MqttPublisherTests(SimpleTestCase):
+    def setUp(self):
+        client = mock.patch("comms_api.mqtt_client.mqtt.Client")
+        self.client = client.start().return_value
+        self.addCleanup(client.stop)
+        self.client.publish.return_value.rc = 0
+
+    def failures(self, reason):
+        return MQTT_PUBLISH_FAILURES.labels(reason)._value.get()
+
+    def test_publish_does_not_wait_for_broker(self):
+        publisher = MqttPublisher("broker", 1883, max_queue=2)
+        started = time.monotonic()
+        self.assertTrue(publisher.publish("user/1", "a"))
+        self.assertTrue(publisher.publish("user/1", "b"))
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.client.publish.assert_not_called()
+
+        dropped = self.failures("queue_full")
+        self.assertFalse(publisher.publish("user/1", "c"))
+        self.assertEqual(self.failures("queue_full"), dropped + 1)
+
+        publisher.stop()
+        self.assertFalse(publisher._thread.is_alive())
+
+    def test_drain_publishes_once_connected_and_stops(self):
+        publisher = MqttPublisher("broker", 1883)
+        publisher.publish("user/1", "a")
+        publisher._connected.set()
+        publisher.publish("user/2", "b")
+        deadline = time.monotonic() + 2
+        while self.client.publish.call_count < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        publisher.stop()
+
+        self.assertFalse(publisher._thread.is_alive())
+        self.assertEqual([call.args for call in self.client.publish.call_args_list], [("user/1", "a"), ("user/2", "b")])
+        # Po stop() nie startuje drugi wątek
+        thread = publisher._thread
+        self.assertFalse(publisher.publish("user/3", "c"))
+        self.assertIs(publisher._thread, thread)
+        self.client.loop_start.assert_called_once()
+
+
+@override_settings(
+    RATE_LIMIT_MESSAGES_PER_SECOND=5, RATE_LIMIT_MESSAGES_BURST=30,
+    RATE_LIMIT_UPLOAD_BYTES_PER_SECOND=100, RATE_LIMIT_UPLOAD_BYTES_BURST=1000,
+    RATE_LIMIT_ABUSE_DENIALS=2, RATE_LIMIT_ABUSE_WINDOW=10,
+)
+class RateLimiterTests(SimpleTestCase):
+    # Sam skrypt Lua wykonuje Redis; tutaj sprawdzamy, jak limiter go woła i co robi z wynikiem
+    def limiter(self, *results):
+        script = mock.AsyncMock(side_effect=results)
+        redis = mock.Mock(register_script=mock.Mock(return_value=script))
+        patcher = mock.patch("comms_api.ratelimit.get_async_redis", return_value=redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return RateLimiter(7), script
+
+    def test_all_buckets_are_checked_in_one_script_call(self):
+        limiter, script = self.limiter([0, "0"])
+
+        self.assertEqual(async_to_sync(limiter.acquire)(message=1, upload_bytes=400), 0)
+        script.assert_awaited_once_with(
+            keys=["ratelimit:7:message", "ratelimit:7:upload_bytes"], args=[5, 30, 1, 100, 1000, 400]
+        )
+
+    def test_blocked_action_returns_retry_after(self):
+        limiter, _ = self.limiter([2, "1.5"])
+
+        self.assertEqual(async_to_sync(limiter.acquire)(message=1, upload_bytes=400), 1.5)
+        self.assertFalse(limiter.abusive)
+
+    def test_redis_failure_lets_action_through(self):
+        limiter, _ = self.limiter(RedisError("down"), RedisError("down"), RedisError("down"))
+
+        with self.assertLogs("comms_api.ratelimit", "WARNING"):
+            for _ in range(3):
+                self.assertEqual(async_to_sync(limiter.acquire)(message=1), 0)
+        self.assertFalse(limiter.abusive)
+
+    def test_denials_count_only_within_abuse_window(self):
+        limiter, _ = self.limiter([1, "0.2"], [1, "0.2"], [1, "0.2"])
+        with mock.patch("comms_api.ratelimit.time.monotonic", return_value=100):
+            for _ in range(3):
+                async_to_sync(limiter.acquire)(message=1)
+            self.assertTrue(limiter.abusive)
+        with mock.patch("comms_api.ratelimit.time.monotonic", return_value=111):
+            self.assertFalse(limiter.abusive)
+
+    def consumer(self, *results):
+        consumer = ChatConsumer()
+        consumer.rate_limiter, _ = self.limiter(*results)
+        consumer.close = mock.AsyncMock()
+        consumer.send_event = mock.AsyncMock()
+        return consumer
+
+    def test_consumer_sends_slow_down_then_closes_abusive_client(self):
+        consumer = self.consumer([1, "0.2"], [1, "0.2"], [1, "0.2"])
+        within_limits = async_to_sync(consumer.within_limits)
+
+        self.assertFalse(within_limits("send_message", {"message": 1}, {"client_id": "c1"}))
+        consumer.send_event.assert_awaited_once_with(
+            {"type": "slow_down", "action": "send_message", "retry_after": 0.2, "client_id": "c1"}
+        )
+        self.assertFalse(within_limits("send_message", {"message": 1}, {}))
+        consumer.close.assert_not_awaited()
+
+        self.assertFalse(within_limits("send_message", {"message": 1}, {}))
+        consumer.close.assert_awaited_once_with(code=RATE_LIMIT_CLOSE_CODE)
+
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}, WS_BATCH_WINDOW=0.05
+)
+class WebSocketProtocolTests(SimpleTestCase):
+    # Redis (obecność, limity) i baza podmienione - tu liczy się tylko format ramek
+    def setUp(self):
+        limiter = mock.Mock(acquire=mock.AsyncMock(return_value=0), abusive=False)
+        for patcher in (
+            mock.patch("comms_api.presence.touch", mock.AsyncMock()),
+            mock.patch("comms_api.presence.leave", mock.AsyncMock()),
+            mock.patch("comms_api.consumers.RateLimiter", return_value=limiter),
+            mock.patch("comms_api.consumers.get_group_ids", return_value=set()),
+            mock.patch("comms_api.consumers.get_friend_ids", return_value=frozenset()),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def run_client(self, scenario, subprotocols=None):
+        async def run():
+            client = WebsocketCommunicator(ChatConsumer.as_asgi(), "/ws/chat/", subprotocols=subprotocols)
+            client.scope["user"] = User(id=1, username="alice")
+            connected, subprotocol = await client.connect()
+            self.assertTrue(connected)
+            try:
+                return subprotocol, await scenario(client)
+            finally:
+                await client.disconnect()
+
+        return asyncio.run(run())
+
+    def test_msgpack_client_gets_batched_events(self):
+        async def scenario(client):
+            await client.send_to(bytes_data=msgpack.packb([{"action": "ping"}, {"action": "ping"}]))
+            frame = msgpack.unpackb(await client.receive_from(1))
+            return frame, await client.receive_nothing(0.1)
+
+        subprotocol, (frame, nothing_else) = self.run_client(scenario, [MSGPACK_SUBPROTOCOL])
+
+        self.assertEqual(subprotocol, MSGPACK_SUBPROTOCOL)
+        self.assertEqual(frame, [{"type": "pong"}, {"type": "pong"}])
+        self.assertTrue(nothing_else)
+
+    def test_json_client_gets_one_event_per_frame(self):
+        async def scenario(client):
+            await client.send_json_to([{"action": "ping"}, {"action": "ping"}])
+            return [await client.receive_json_from(1), await client.receive_json_from(1)]
+
+        subprotocol, events = self.run_client(scenario)
+
+        self.assertIsNone(subprotocol)
+        self.assertEqual(events, [{"type": "pong"}, {"type": "pong"}])
+
+    def test_malformed_frames_get_errors_and_keep_connection(self):
+        frames = [
+            "{not json", "[1]", {"action": "send_message"}, {"action": "friend_request_send"},
+            {"action": "upload_start", "size": "big", "ext": "jpg"}, {"action": "upload_commit", "upload_id": 123},
+        ]
+
+        async def scenario(client):
+            events = []
+            for frame in frames:
+                if isinstance(frame, str):
+                    await client.send_to(text_data=frame)
+                else:
+                    await client.send_json_to(frame)
+                events.append(await client.receive_json_from(1))
+            await client.send_json_to({"action": "ping"})
+            events.append(await client.receive_json_from(1))
+            return events
+
+        _, events = self.run_client(scenario)
+
+        self.assertEqual([event["type"] for event in events], [
+            "error", "error", "error", "error", "upload_error", "upload_error", "pong",
+        ])
+
+    def test_malformed_msgpack_frame_gets_error(self):
+        async def scenario(client):
+            await client.send_to(bytes_data=b"\xc1")
+            await client.send_to(bytes_data=msgpack.packb({"action": "ping"}))
+            return msgpack.unpackb(await client.receive_from(1))
+
+        _, frame = self.run_client(scenario, [MSGPACK_SUBPROTOCOL])
+
+        self.assertEqual(frame, [{"type": "error", "error": "malformed frame"}, {"type": "pong"}])
+
+
+class PresenceTests(SimpleTestCase):
+    # presence:<id> w Redisie: kanał -> "<wygasa>:<stan>"; zegar zatrzymany na 1000
+    def redis(self, *entries, error=None):
+        redis = mock.MagicMock()
+        redis.hgetall = mock.AsyncMock(side_effect=error or entries)
+        pipe = redis.pipeline.return_value.__aenter__.return_value
+        pipe.hgetall = mock.Mock()
+        pipe.execute = mock.AsyncMock(side_effect=error, return_value=list(entries))
+        for patcher in (
+            mock.patch("comms_api.presence.get_async_redis", return_value=redis),
+            mock.patch("comms_api.presence.time.time", return_value=1000),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_only_live_foreground_device_counts(self):
+        self.redis({"phone": "1030:bg", "tablet": "990:fg"}, {"phone": "1030:bg", "tablet": "1030:fg"})
+
+        self.assertFalse(async_to_sync(presence.is_foreground)(1))
+        self.assertTrue(async_to_sync(presence.is_foreground)(1))
+
+    def test_foreground_ids_in_one_pipeline(self):
+        self.redis({"phone": "1030:fg"}, {"phone": "1030:bg"}, {})
+
+        self.assertEqual(async_to_sync(presence.get_foreground_ids)([1, 2, 3]), {1})
+
+    def test_redis_failure_means_nobody_is_foreground(self):
+        self.redis(error=RedisError("down"))
+
+        self.assertFalse(async_to_sync(presence.is_foreground)(1))
+        self.assertEqual(async_to_sync(presence.get_foreground_ids)([1, 2]), set())
+
+    def consumer(self, stored):
+        consumer = ChatConsumer()
+        consumer.user = User(id=1, username="alice")
+        consumer.channel_layer = mock.Mock()
+        consumer.send_event = mock.AsyncMock()
+        for patcher in (
+            mock.patch("comms_api.consumers.run_db", mock.AsyncMock(return_value=stored)),
+            mock.patch("comms_api.consumers.metrics.group_send", mock.AsyncMock()),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        return consumer
+
+    def test_direct_push_skipped_for_foreground_recipient(self):
+        message = Message(id=5, content="hej", timestamp=timezone.now())
+        consumer = self.consumer((message, True))
+
+        for foreground, pushes in ((True, 0), (False, 1)):
+            with mock.patch("comms_api.presence.is_foreground", mock.AsyncMock(return_value=foreground)), \
+                    mock.patch("comms_api.consumers.queue_notification") as queue_notification:
+                async_to_sync(consumer.handle_send_message)({"to": 2, "content": "hej"})
+            self.assertEqual(queue_notification.call_count, pushes)
+
+    def test_group_push_skips_foreground_members(self):
+        message = Message(id=5, content="hej", timestamp=timezone.now())
+        consumer = self.consumer((message, True, Conversation(id=9, title="team"), {1, 2, 3}))
+
+        with mock.patch("comms_api.presence.get_foreground_ids", mock.AsyncMock(return_value={2})), \
+                mock.patch("comms_api.consumers.queue_notifications") as queue_notifications:
+            async_to_sync(consumer.handle_send_message)({"conversation_id": 9, "content": "hej"})
+
+        self.assertEqual(queue_notifications.call_args.args[0], {3})
+
+
+class NotificationCoalescerTests(SimpleTestCase):
+    def setUp(self):
+        self.sent = []
+        patcher = mock.patch(
+            "comms_api.notifications.send_notification",
+            side_effect=lambda to_user_id, payload: self.sent.append((to_user_id, payload)),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def wait_for(self, count):
+        deadline = time.monotonic() + 2
+        while len(self.sent) < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertGreaterEqual(len(self.sent), count, self.sent)
+
+    def test_messages_coalesce_per_recipient_type_and_chat(self):
+        coalescer = NotificationCoalescer(window=0.05)
+        for i in range(3):
+            coalescer.push(1, {"type": "chat_message", "chat_id": 2, "body": f"m {i}"})
+        coalescer.push(1, {"type": "chat_message", "chat_id": 3, "body": "inna rozmowa"})
+        coalescer.push_many([1, 4], {"type": "group_message", "chat_id": 2, "body": "grupa"})
+
+        self.wait_for(4)
+        time.sleep(0.1)
+        pushes = {(to_user_id, payload["type"], payload["chat_id"]): payload for to_user_id, payload in self.sent}
+        self.assertEqual(len(self.sent), 4)
+        self.assertEqual(pushes[1, "chat_message", 2], {
+            "type": "chat_message", "chat_id": 2, "body": "3 nowe wiadomości", "count": 3,
+        })
+        self.assertEqual(pushes[1, "chat_message", 3]["body"], "inna rozmowa")
+        self.assertEqual(pushes[1, "group_message", 2]["body"], "grupa")
+        self.assertNotIn("count", pushes[4, "group_message", 2])
+
+    def test_push_is_sent_only_after_window(self):
+        coalescer = NotificationCoalescer(window=0.3)
+        started = time.monotonic()
+        coalescer.push(1, {"type": "chat_message", "chat_id": 2, "body": "hej"})
+        time.sleep(0.1)
+        self.assertEqual(self.sent, [])
+
+        self.wait_for(1)
+        self.assertGreaterEqual(time.monotonic() - started, 0.3)
+
+    def test_polish_plural_body(self):
+        for count, body in (
+            (2, "2 nowe wiadomości"), (4, "4 nowe wiadomości"), (5, "5 nowych wiadomości"),
+            (12, "12 nowych wiadomości"), (14, "14 nowych wiadomości"), (22, "22 nowe wiadomości"),
+            (25, "25 nowych wiadomości"), (112, "112 nowych wiadomości"), (123, "123 nowe wiadomości"),
+        ):
+            with self.subTest(count=count):
+                self.assertEqual(_new_messages_body(count), body)
+
+
+class EphemeralTests(SimpleTestCase):
+    def throttle(self, rate=100):
+        emitted = []
+
+        async def emit(key, payload):
+            emitted.append((key, payload))
+
+        return EphemeralThrottle(emit, interval=0.05, refresh=10, rate=rate), emitted
+
+    def test_repeated_state_is_sent_once(self):
+        async def run():
+            throttle, emitted = self.throttle()
+            throttle.push(("typing", 2), {"typing": True})
+            await asyncio.sleep(0.1)
+            throttle.push(("typing", 2), {"typing": True})
+            await asyncio.sleep(0.1)
+            return emitted
+
+        self.assertEqual(asyncio.run(run()), [(("typing", 2), {"typing": True})])
+
+    def test_changes_within_interval_coalesce_to_latest(self):
+        async def run():
+            throttle, emitted = self.throttle()
+            for message_id in (1, 2, 3):
+                throttle.push(("seen", 2), {"id": message_id})
+            await asyncio.sleep(0.1)
+            return emitted
+
+        self.assertEqual(asyncio.run(run()), [(("seen", 2), {"id": 1}), (("seen", 2), {"id": 3})])
+
+    def test_budget_drops_events_over_rate(self):
+        async def run():
+            throttle, emitted = self.throttle(rate=2)
+            for user_id in range(5):
+                throttle.push(("typing", user_id), {"typing": True})
+            await asyncio.sleep(0)
+            return emitted
+
+        self.assertEqual(len(asyncio.run(run())), 2)
+
+    def test_close_cancels_pending_events(self):
+        async def run():
+            throttle, emitted = self.throttle()
+            throttle.push(("seen", 2), {"id": 1})
+            throttle.push(("seen", 2), {"id": 2})
+            throttle.close()
+            await asyncio.sleep(0.1)
+            return emitted
+
+        self.assertEqual(asyncio.run(run()), [])
+
+    def test_events_delayed_in_channel_layer_are_dropped(self):
+        self.assertTrue(is_stale({"sent_at": time.time() - 10}, 3))
+        self.assertFalse(is_stale({"sent_at": time.time()}, 3))
+
+    def test_typing_only_to_friends_and_bad_frames_ignored(self):
+        # SimpleTestCase nie dopuszcza zapytań - ścieżka pisania nie może dotykać bazy
+        consumer = ChatConsumer()
+        consumer.friend_ids = frozenset({2})
+        consumer.ephemeral = mock.Mock()
+
+        for data in ({"to": 3, "id": 1}, {"to": "x", "id": 1}, {}, {"to": [2], "id": 1}):
+            async_to_sync(consumer.handle_typing)(data)
+            async_to_sync(consumer.handle_seen)(data)
+        async_to_sync(consumer.handle_seen)({"to": 2, "id": None})
+        consumer.ephemeral.push.assert_not_called()
+
+        async_to_sync(consumer.handle_typing)({"to": 2, "typing": False})
+        async_to_sync(consumer.handle_seen)({"to": "2", "id": "7"})
+        self.assertEqual(consumer.ephemeral.push.call_args_list, [
+            mock.call(("typing", 2), {"typing": False}), mock.call(("seen", 2), {"id": 7}),
+        ])
+
+
+class RangeParsingTests(SimpleTestCase):
+    def test_satisfiable_ranges(self):
+        cases = {
+            "bytes=0-99": (0, 99),
+            "bytes=10-": (10, 999),
+            "bytes=990-5000": (990, 999),
+            "bytes=-100": (900, 999),
+            "bytes=-5000": (0, 999),
+            " bytes=999-999 ": (999, 999),
+        }
+        for header, expected in cases.items():
+            with self.subTest(header=header):
+                self.assertEqual(parse_range(header, 1000), expected)
+
+    def test_unsupported_header_serves_whole_file(self):
+        for header in ("", "bytes=0-1,5-6", "items=0-9", "bytes=a-b", "bytes 0-9"):
+            with self.subTest(header=header):
+                self.assertIsNone(parse_range(header, 1000))
+
+    def test_unsatisfiable_ranges(self):
+        for header, size in (
+            ("bytes=1000-", 1000), ("bytes=20-10", 1000), ("bytes=-0", 1000), ("bytes=-", 1000),
+            ("bytes=0-", 0), ("bytes=-10", 0),
+        ):
+            with self.subTest(header=header, size=size), self.assertRaises(RangeNotSatisfiable):
+                parse_range(header, size)
+
+
+class ThumbnailTests(TestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.media = Path(media.name)
+        settings = override_settings(MEDIA_ROOT=self.media)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.alice = User.objects.create_user("alice", password="secret")
+        self.bob = User.objects.create_user("bob", password="secret")
+        channel_layer = mock.Mock(group_send=mock.AsyncMock())
+        patcher = mock.patch("comms_api.thumbnails.get_channel_layer", return_value=channel_layer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.group_send = channel_layer.group_send
+
+    def png(self, size):
+        output = BytesIO()
+        Image.new("RGBA", size, (255, 0, 0, 128)).save(output, "PNG")
+        return output.getvalue()
+
+    def test_render_thumbnail_scales_to_jpeg(self):
+        path = self.media / "wide.png"
+        path.write_bytes(self.png((400, 200)))
+
+        data, width, height = render_thumbnail(str(path), "image", 100)
+
+        self.assertEqual((width, height), (100, 50))
+        with Image.open(BytesIO(data)) as thumbnail:
+            self.assertEqual((thumbnail.format, thumbnail.size), ("JPEG", (100, 50)))
+
+    def test_video_without_ffmpeg_has_no_thumbnail(self):
+        with mock.patch("comms_api.imaging.subprocess.run", side_effect=FileNotFoundError):
+            self.assertIsNone(render_thumbnail(str(self.media / "clip.mp4"), "video", 100))
+
+    def send(self, attachment):
+        message, _ = create_message(
+            sender=self.alice, recipient_id=self.bob.id, content="", attachment=attachment, file_type="image"
+        )
+        return message
+
+    def thumbnail_events(self):
+        return [call.args[1]["thumbnail"] for call in self.group_send.call_args_list]
+
+    def test_same_file_keeps_first_thumbnail(self):
+        attachment = store_bytes(self.png((40, 20)), "png")
+        first, second = self.send(attachment), self.send(attachment)
+
+        thumbnails._save_thumbnail(first.id, b"first", 10, 5)
+        thumbnails._save_thumbnail(second.id, b"second", 12, 6)
+
+        attachment.refresh_from_db()
+        self.assertEqual(attachment.thumbnail.read(), b"first")
+        self.assertEqual(len(list((self.media / "thumbnails").iterdir())), 1)
+        self.assertEqual(
+            {(event["id"], event["thumbnail_width"]) for event in self.thumbnail_events()},
+            {(first.id, 10), (second.id, 10)},
+        )
+
+    def test_concurrent_thumbnail_loses_race_cleanly(self):
+        attachment = store_bytes(self.png((40, 20)), "png")
+        message = self.send(attachment)
+
+        def other_worker_wins(data):
+            Attachment.objects.filter(pk=attachment.pk).update(
+                thumbnail="thumbnails/other.jpg", thumbnail_width=8, thumbnail_height=4
+            )
+            return ContentFile(data)
+
+        with mock.patch("comms_api.thumbnails.ContentFile", side_effect=other_worker_wins):
+            thumbnails._save_thumbnail(message.id, b"late", 10, 5)
+
+        self.assertEqual(list((self.media / "thumbnails").iterdir()), [])
+        self.assertEqual(self.thumbnail_events()[0]["thumbnail_width"], 8)
+
+    def test_deleted_message_is_skipped(self):
+        thumbnails._save_thumbnail(10 ** 9, b"data", 10, 5)
+
+        self.group_send.assert_not_called()
+
+    def test_broken_pool_is_replaced(self):
+        self.addCleanup(setattr, thumbnails, "_executor", None)
+        thumbnails._executor = None
+        broken, fresh = mock.Mock(), mock.Mock()
+        broken.submit.side_effect = BrokenProcessPool()
+        message = Message(id=1, attachment=Attachment(id=3, file="a.png"), file_type="image")
+
+        with mock.patch("comms_api.thumbnails.ProcessPoolExecutor", side_effect=[broken, fresh]):
+            with self.assertLogs("comms_api.thumbnails", "WARNING"):
+                thumbnails.schedule_thumbnail(message)
+        fresh.submit.return_value.add_done_callback.assert_called_once()
+        self.assertIs(thumbnails._executor, fresh)
+
+        failed = mock.Mock(result=mock.Mock(side_effect=BrokenProcessPool()))
+        with self.assertLogs("comms_api.thumbnails", "ERROR"):
+            thumbnails._store_thumbnail(1, fresh, failed)
+        self.assertIsNone(thumbnails._executor)
+
+
+class UploadTests(TestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        settings = override_settings(
+            MEDIA_ROOT=Path(media.name), UPLOAD_TEMP_DIR=Path(media.name) / "uploads", MAX_OPEN_UPLOADS=2
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.alice = User.objects.create_user("alice", password="secret")
+
+    def test_start_upload_rejects_invalid_file_type(self):
+        for file_type in (["image"], 7, "x" * 11):
+            with self.assertRaises(UploadError):
+                start_upload(self.alice, 10, "jpg", file_type)
+
+    def test_extension_is_validated_for_chunked_and_inline_files(self):
+        for extension in ("../x", "j p g", "x" * 11, 7):
+            with self.subTest(extension=extension):
+                with self.assertRaises(UploadError):
+                    start_upload(self.alice, 10, extension)
+                with self.assertRaises(UploadError):
+                    store_bytes(b"data", extension)
+        self.assertTrue(store_bytes(b"data", "TXT").file.name.endswith(".txt"))
+
+    def test_upload_is_appended_by_one_session_at_a_time(self):
+        session = start_upload(self.alice, 10, "txt")
+        session.append(0, b"abcd")
+
+        with self.assertRaises(UploadError):
+            resume_upload(self.alice, session.upload.pk)
+
+        session.close()
+        resumed = resume_upload(self.alice, session.upload.pk)
+        self.assertEqual(resumed.received, 4)
+        resumed.append(4, b"efghij")
+        upload = resumed.commit()
+        with upload.attachment.file.open("rb") as f:
+            self.assertEqual(f.read(), b"abcdefghij")
+
+    def test_same_bytes_are_stored_once(self):
+        uploads = []
+        for _ in range(2):
+            session = start_upload(self.alice, 5, "txt")
+            session.append(0, b"hello")
+            uploads.append(session.commit())
+            self.assertFalse(os.path.exists(part_path(session.upload)))
+
+        self.assertEqual(uploads[0].attachment_id, uploads[1].attachment_id)
+        self.assertEqual(store_bytes(b"hello", "txt").pk, uploads[0].attachment_id)
+        self.assertEqual(Attachment.objects.count(), 1)
+
+    def test_attachment_is_released_with_its_last_message(self):
+        attachment = store_bytes(b"shared", "txt")
+        messages = [
+            create_message(sender=self.alice, recipient_id=self.alice.id, content="", attachment=attachment)[0]
+            for _ in range(2)
+        ]
+        attachment.refresh_from_db()
+        self.assertEqual(attachment.ref_count, 2)
+
+        messages[0].delete()
+        attachment.refresh_from_db()
+        self.assertEqual(attachment.ref_count, 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            messages[1].delete()
+        self.assertFalse(Attachment.objects.filter(pk=attachment.pk).exists())
+        self.assertFalse(attachment.file.storage.exists(attachment.file.name))
+
+    def test_open_uploads_are_capped_per_user(self):
+        start_upload(self.alice, 10, "jpg", "image")
+        start_upload(self.alice, 10, "jpg", "image")
+
+        with self.assertRaises(UploadError):
+            start_upload(self.alice, 10, "jpg", "image")
+
+    def test_sweep_removes_expired_uploads_and_unsent_attachments(self):
+        session = start_upload(self.alice, 10, "jpg", "image")
+        unsent = store_bytes(b"never sent", "txt")
+        sent = store_bytes(b"sent", "txt")
+        create_message(sender=self.alice, recipient_id=self.alice.id, content="", attachment=sent, file_type="file")
+        day_ago = timezone.now() - timedelta(days=1, minutes=1)
+        Upload.objects.update(created_at=day_ago)
+        Attachment.objects.update(created_at=day_ago)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            stats = sweep_uploads()
+
+        self.assertEqual(stats, {"uploads": 1, "attachments": 1})
+        self.assertFalse(os.path.exists(part_path(session.upload)))
+        self.assertFalse(Attachment.objects.filter(pk=unsent.pk).exists())
+        self.assertTrue(Attachment.objects.filter(pk=sent.pk).exists())
+        self.assertFalse(unsent.file.storage.exists(unsent.file.name))
+
+
+@skipUnless(connection.vendor == "postgresql", "Message partitioning is PostgreSQL specific")
+class MessageArchiveTests(TransactionTestCase):
+    # TransactionTestCase, bo DETACH PARTITION nie przejdzie przy odroczonych kluczach obcych w otwartej transakcji
+    def setUp(self):
+        self.archive_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.archive_dir.cleanup)
+        self.addCleanup(open_archive.cache_clear)
+        settings = override_settings(MESSAGE_ARCHIVE_DIR=Path(self.archive_dir.name))
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        self.alice = User.objects.create_user("alice", password="secret")
+        self.bob = User.objects.create_user("bob", password="secret")
+        cache.clear()
+        self.old_month = add_months(current_month(), -14)
+        if self.old_month not in monthly_partitions():
+            create_partition(self.old_month)
+        for i in range(30):
+            create_message(sender=self.alice, recipient_id=self.bob.id, content=f"old {i}")
+        # UPDATE timestamp przenosi wiersze do partycji sprzed okresu retencji
+        for i, message in enumerate(Message.objects.order_by("id")):
+            Message.objects.filter(pk=message.pk).update(timestamp=self.old_month_start + timedelta(hours=i))
+        for i in range(10):
+            create_message(sender=self.bob, recipient_id=self.alice.id, content=f"new {i}")
+        self.expected = list(Message.objects.order_by("-timestamp", "-id").values_list("id", flat=True))
+
+    @property
+    def old_month_start(self):
+        return Message._meta.get_field("timestamp").to_python(f"{self.old_month}T00:00:00+00:00")
+
+    def test_archive_moves_old_partition_out_of_database(self):
+        with open(os.devnull, "w") as devnull:
+            call_command("message_partitions", archive=True, retention_months=12, stdout=devnull)
+
+        self.assertNotIn(self.old_month, monthly_partitions())
+        self.assertEqual(Message.objects.count(), 10)
+        archive = MessageArchive.objects.get(month=self.old_month)
+        self.assertEqual(archive.message_count, 30)
+        self.assertTrue((Path(self.archive_dir.name) / archive.path).exists())
+
+    def test_history_reads_archive_transparently(self):
+        with open(os.devnull, "w") as devnull:
+            call_command("message_partitions", archive=True, retention_months=12, stdout=devnull)
+        client = APIClient()
+        client.force_authenticate(self.alice)
+
+        seen = []
+        url = f"/api/chat/history/?user_id={self.bob.id}&limit=7"
+        while url:
+            response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            seen += [message["id"] for message in response.data["data"]]
+            cursor = response.data["nextCursor"]
+            url = f"/api/chat/history/?user_id={self.bob.id}&limit=7&before={cursor}" if cursor else None
+
+        self.assertEqual(seen, self.expected)
+        self.assertEqual(response.data["data"][-1]["content"], "old 0")
+
+    def test_messages_without_conversation_keep_block_index_sorted(self):
+        conversation_id = Message.objects.order_by("id").last().conversation_id
+        Message.objects.filter(pk=Message.objects.filter(content="old 5").get().pk).update(conversation=None)
+        with open(os.devnull, "w") as devnull:
+            call_command("message_partitions", archive=True, retention_months=12, stdout=devnull)
+
+        reader = open_archive(MessageArchive.objects.get(month=self.old_month).path)
+        blocks = [reader._block(i)[0] for i in range(reader._blocks)]
+        self.assertEqual(blocks, sorted(blocks))
+        self.assertEqual(blocks[0], 0)
+        self.assertEqual(len(reader.messages_before(conversation_id, limit=100)), 29)
@@ -0,0 +1,108 @@
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db.models import Q
+from comms_api.db_executor import db_executor
+from comms_api.imaging import render_thumbnail
+from comms_api.groups import group_channel
+from comms_api.models import Attachment, Message
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_FILE_TYPES = ("image", "video")
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    # Procesy, nie wątki: skalowanie obrazów to CPU i nie może blokować pętli ASGI
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=settings.THUMBNAIL_WORKERS, mp_context=multiprocessing.get_context("spawn")
+            )
+        return _executor
+
+
+def _reset_executor(broken):
+    # Po śmierci procesu roboczego (np. OOM na dużym obrazie) pula odrzuca każde kolejne zadanie -
+    # następne get_executor zakłada nową
+    global _executor
+    with _executor_lock:
+        if _executor is broken:
+            _executor = None
+
+
+def schedule_thumbnail(message):
+    if not message.attachment_id or message.file_type not in THUMBNAIL_FILE_TYPES:
+        return
+    job = (render_thumbnail, message.attachment.file.path, message.file_type, settings.THUMBNAIL_SIZE)
+    executor = get_executor()
+    try:
+        future = executor.submit(*job)
+    except BrokenProcessPool:
+        logger.warning("Thumbnail pool broken, starting a new one")
+        _reset_executor(executor)
+        executor = get_executor()
+        future = executor.submit(*job)
+    future.add_done_callback(partial(_store_thumbnail, message.pk, executor))
+
+
+def _store_thumbnail(message_id, executor, future):
+    # Callback działa w wątku zarządzającym pulą procesów - tu tylko odbiór wyniku,
+    # zapis i powiadomienie idą do puli bazodanowej, żeby nie wstrzymywać kolejnych miniatur
+    try:
+        result = future.result()
+    except BrokenProcessPool:
+        logger.exception("Thumbnail worker died for message %s", message_id)
+        _reset_executor(executor)
+        return
+    except Exception:
+        logger.exception("Thumbnail generation failed for message %s", message_id)
+        return
+    if result is not None:
+        db_executor.submit(_save_thumbnail, message_id, *result)
+
+
+def _save_thumbnail(message_id, data, width, height):
+    message = Message.objects.select_related("attachment", "conversation").filter(pk=message_id).first()
+    if message is None:
+        # Wiadomość usunięta, zanim miniatura była gotowa
+        return
+    attachment = message.attachment
+    # Miniatura należy do załącznika; równoległe wysyłki tego samego pliku zapisują ją raz
+    if not attachment.thumbnail:
+        attachment.thumbnail.save(f"{attachment.sha256}.jpg", ContentFile(data), save=False)
+        updated = Attachment.objects.filter(Q(thumbnail="") | Q(thumbnail__isnull=True), pk=attachment.pk).update(
+            thumbnail=attachment.thumbnail.name, thumbnail_width=width, thumbnail_height=height
+        )
+        if updated:
+            attachment.thumbnail_width, attachment.thumbnail_height = width, height
+        else:
+            attachment.thumbnail.delete(save=False)
+            attachment.refresh_from_db()
+    # Wymiary zapisanej miniatury - mogła powstać wcześniej z innej wysyłki tego samego pliku
+    width, height = attachment.thumbnail_width, attachment.thumbnail_height
+
+    # Link podpisuje odbiorca (ChatConsumer.chat_thumbnail), więc jedno zdarzenie pasuje dla wszystkich
+    event = {
+        "type": "chat.thumbnail",
+        "thumbnail": {"id": message_id, "thumbnail_width": width, "thumbnail_height": height},
+    }
+    if message.conversation.is_group:
+        groups = [group_channel(message.conversation_id)]
+    else:
+        groups = [f"user_{user_id}" for user_id in {message.sender_id, message.recipient_id}]
+
+    channel_layer = get_channel_layer()
+    for group in groups:
+        async_to_sync(channel_layer.group_send)(group, event)
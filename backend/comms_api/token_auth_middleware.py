@@ -2,18 +2,18 @@ from urllib.parse import parse_qs
 from channels.middleware import BaseMiddleware
 from channels.db import database_sync_to_async
 from django.contrib.auth.models import AnonymousUser
-from rest_framework_simplejwt.tokens import UntypedToken
-from rest_framework_simplejwt.exceptions import InvalidToken
-from django.contrib.auth.models import User
+from rest_framework_simplejwt.exceptions import InvalidToken, AuthenticationFailed
 from rest_framework_simplejwt.authentication import JWTAuthentication
+from comms_api.authentication import get_cached_user, get_user as get_token_user
+
+jwt_auth = JWTAuthentication()
 
 
 @database_sync_to_async
 def get_user(validated_token):
     try:
-        jwt_auth = JWTAuthentication()
-        return jwt_auth.get_user(validated_token)
-    except:
+        return get_token_user(validated_token)
+    except (InvalidToken, AuthenticationFailed):
         return AnonymousUser()
 
 
@@ -25,9 +25,9 @@ class JWTAuthMiddleware(BaseMiddleware):
 
         if token:
             try:
-                validated_token = JWTAuthentication().get_validated_token(token)
-                scope["user"] = await get_user(validated_token)
-            except InvalidToken:
+                validated_token = jwt_auth.get_validated_token(token)
+                scope["user"] = get_cached_user(validated_token) or await get_user(validated_token)
+            except (InvalidToken, AuthenticationFailed):
                 scope["user"] = AnonymousUser()
         else:
             scope["user"] = AnonymousUser()
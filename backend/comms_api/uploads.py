@@ -0,0 +1,190 @@
+import fcntl
+import hashlib
+import logging
+import os
+import struct
+import uuid
+from datetime import timedelta
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+from comms_api.models import Attachment, Message, Upload
+
+logger = logging.getLogger(__name__)
+
+# Ramka binarna: 16 bajtów UUID uploadu, 8 bajtów offsetu (big-endian), dalej dane
+CHUNK_HEADER = struct.Struct(">16sQ")
+
+
+class UploadError(Exception):
+    pass
+
+
+def part_path(upload):
+    return os.path.join(settings.UPLOAD_TEMP_DIR, f"{upload.pk}.part")
+
+
+def parse_chunk(frame):
+    if len(frame) <= CHUNK_HEADER.size:
+        raise UploadError("chunk too short")
+    upload_id, offset = CHUNK_HEADER.unpack_from(frame)
+    return uuid.UUID(bytes=upload_id), offset, memoryview(frame)[CHUNK_HEADER.size:]
+
+
+class UploadSession:
+    # Stan uploadu w obrębie połączenia: sha256 liczony w locie, przy wznowieniu
+    # doliczany z istniejącego pliku .part. Sesja trzyma blokadę flock na pliku .part, więc drugie
+    # połączenie wznawiające ten sam upload (także w innym procesie) nie dopisze do niego równolegle.
+    # Blokadę zwalnia close(), commit() albo zamknięcie procesu.
+    def __init__(self, upload):
+        self.upload = upload
+        self.hasher = hashlib.sha256()
+        self.received = 0
+        try:
+            self._part = open(part_path(upload), "ab")
+        except FileNotFoundError:
+            raise UploadError("unknown upload")
+        try:
+            fcntl.flock(self._part, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._part.close()
+            raise UploadError("upload is already in progress in another session")
+        with open(part_path(upload), "rb") as part:
+            for block in iter(lambda: part.read(1024 * 1024), b""):
+                self.hasher.update(block)
+                self.received += len(block)
+
+    def close(self):
+        self._part.close()
+
+    def append(self, offset, data):
+        if offset != self.received:
+            raise UploadError(f"expected offset {self.received}")
+        if len(data) > settings.UPLOAD_CHUNK_SIZE:
+            raise UploadError(f"chunk larger than {settings.UPLOAD_CHUNK_SIZE} bytes")
+        if self.received + len(data) > self.upload.size:
+            raise UploadError("chunk exceeds declared size")
+
+        self._part.write(data)
+        self._part.flush()
+        self.hasher.update(data)
+        self.received += len(data)
+        return self.received
+
+    def commit(self):
+        upload = self.upload
+        if self.received != upload.size:
+            raise UploadError("upload incomplete")
+
+        path = part_path(upload)
+        with open(path, "rb") as part:
+            upload.attachment = Attachment.objects.store(
+                File(part), self.hasher.hexdigest(), upload.size, upload.extension
+            )
+        upload.completed_at = timezone.now()
+        upload.save(update_fields=["attachment", "completed_at"])
+        os.remove(path)
+        self.close()
+        return upload
+
+
+def validate_file_type(file_type):
+    # Trafia do Message.file_type (max 10 znaków); klient może przysłać cokolwiek
+    if not isinstance(file_type, str) or len(file_type) > 10:
+        raise UploadError("invalid file_type")
+    return file_type
+
+
+def validate_extension(extension):
+    # Trafia do nazwy pliku w magazynie (Upload.extension, max 10 znaków)
+    if not isinstance(extension, str) or not extension.isalnum() or len(extension) > 10:
+        raise UploadError("invalid extension")
+    return extension.lower()
+
+
+def start_upload(user, size, extension, file_type=""):
+    try:
+        size = int(size)
+    except (TypeError, ValueError):
+        raise UploadError("size must be an integer")
+    if size <= 0 or size > settings.MAX_UPLOAD_SIZE:
+        raise UploadError(f"size must be between 1 and {settings.MAX_UPLOAD_SIZE} bytes")
+    extension = validate_extension(extension)
+    file_type = validate_file_type(file_type)
+    # Każdy otwarty upload to plik .part do MAX_UPLOAD_SIZE na dysku
+    open_uploads = Upload.objects.filter(
+        owner=user, completed_at__isnull=True, created_at__gte=timezone.now() - _upload_ttl()
+    ).count()
+    if open_uploads >= settings.MAX_OPEN_UPLOADS:
+        raise UploadError(f"too many open uploads (max {settings.MAX_OPEN_UPLOADS})")
+
+    upload = Upload.objects.create(owner=user, size=size, extension=extension, file_type=file_type)
+    os.makedirs(settings.UPLOAD_TEMP_DIR, exist_ok=True)
+    open(part_path(upload), "wb").close()
+    return UploadSession(upload)
+
+
+def resume_upload(user, upload_id):
+    try:
+        upload = Upload.objects.get(
+            pk=upload_id, owner=user, completed_at__isnull=True, created_at__gte=timezone.now() - _upload_ttl()
+        )
+    except (Upload.DoesNotExist, ValidationError):
+        raise UploadError("unknown upload")
+    return UploadSession(upload)
+
+
+def get_completed_upload(user, upload_id):
+    try:
+        return Upload.objects.select_related("attachment").get(
+            pk=upload_id, owner=user, completed_at__isnull=False, attachment__isnull=False
+        )
+    except (Upload.DoesNotExist, ValidationError):
+        raise UploadError("unknown upload")
+
+
+def store_bytes(data, extension):
+    extension = validate_extension(extension)
+    return Attachment.objects.store(ContentFile(data), hashlib.sha256(data).hexdigest(), len(data), extension)
+
+
+def _upload_ttl():
+    return timedelta(hours=settings.UPLOAD_TTL_HOURS)
+
+
+def sweep_uploads():
+    # Porzucone uploady i załączniki, których nikt nie wysłał. Wygasłego uploadu nie da się
+    # już wznowić ani wysłać, więc jego .part i niewysłany załącznik można bezpiecznie usunąć.
+    cutoff = timezone.now() - _upload_ttl()
+    stats = {"uploads": 0, "attachments": 0}
+
+    for upload in Upload.objects.filter(created_at__lt=cutoff).iterator():
+        if upload.completed_at is None:
+            try:
+                os.remove(part_path(upload))
+            except FileNotFoundError:
+                pass
+        upload.delete()
+        stats["uploads"] += 1
+
+    orphans = Attachment.objects.filter(ref_count=0, created_at__lt=cutoff).exclude(
+        Exists(Message.objects.filter(attachment=OuterRef("pk")))
+    ).exclude(
+        Exists(Upload.objects.filter(attachment=OuterRef("pk")))
+    )
+    for attachment in orphans.iterator():
+        files = [attachment.file, attachment.thumbnail]
+        with transaction.atomic():
+            # Ten sam plik mógł zostać w międzyczasie wysłany ponownie
+            deleted, _ = Attachment.objects.filter(pk=attachment.pk, ref_count=0).exclude(
+                Exists(Message.objects.filter(attachment=OuterRef("pk")))
+            ).delete()
+            if deleted:
+                transaction.on_commit(lambda files=files: [f.delete(save=False) for f in files if f])
+        stats["attachments"] += deleted
+    logger.info("Swept %s expired uploads and %s unsent attachments", stats["uploads"], stats["attachments"])
+    return stats
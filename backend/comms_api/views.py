@@ -1,16 +1,32 @@
+import re
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
 from livekit.api import AccessToken, VideoGrants
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import generics, status
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework_simplejwt.tokens import RefreshToken, TokenError
 from rest_framework.decorators import api_view, permission_classes
 from django.contrib.auth.models import User
 from django.contrib.auth import authenticate
-from django.db.models import Q
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchHeadline
+from django.db import transaction
+from django.db.models import F, Q, Case, When, Value, Exists, OuterRef, Subquery, FloatField
+from django.db.models.functions import Cast
 from comms_api.mqtt_client import send_notification
-from comms_api.models import Message, FriendRequest, UserFCMToken
-from comms_api.serializers import MessageSerializer, FriendRequestSerializer, UserSerializer
+from comms_api.models import Message, FriendRequest, UserFCMToken, Conversation, ConversationMember, Attachment
+from comms_api.archive import archived_history, find_archived_attachment
+from comms_api.media import serve_media, signed_media_user
+from comms_api.authentication import TOKEN_VERSION_CLAIM, token_version
+from comms_api.presence import get_online_ids
+from comms_api.groups import GroupError, create_group, add_members, remove_member, get_member_ids
+from comms_api.friends import get_friend_ids, are_friends, add_friendship, remove_friendship
+from comms_api.pagination import (
+    InvalidCursor, encode_cursor, decode_cursor, before_cursor, after_cursor, encode_search_cursor,
+    decode_search_cursor, encode_rank_cursor, decode_rank_cursor, parse_limit,
+)
+from comms_api.serializers import MessageSerializer, FriendRequestSerializer, UserSerializer, GroupSerializer
 
 
 class RegisterView(APIView):
@@ -30,6 +46,7 @@ class LoginView(APIView):
         user = authenticate(username=username, password=password)
         if user is not None:
             refresh = RefreshToken.for_user(user)
+            refresh[TOKEN_VERSION_CLAIM] = token_version(user)
             return Response({
                 "refresh": str(refresh),
                 "access": str(refresh.access_token),
@@ -56,24 +73,99 @@ class RefreshTokenView(APIView):
 
 class ChatHistoryView(APIView):
     permission_classes = [IsAuthenticated]
+    MAX_LIMIT = 100
 
     def get(self, request):
         user = request.user
         other_user_id = request.query_params.get("user_id")
-        limit = int(request.query_params.get("limit", 50))
-        offset = int(request.query_params.get("offset", 0))
+        conversation_id = request.query_params.get("conversation_id")
+        try:
+            limit = parse_limit(request.query_params.get("limit"), 50, self.MAX_LIMIT)
+            offset = int(request.query_params.get("offset", 0))
+        except ValueError:
+            return Response({"error": "invalid limit or offset"}, status=400)
+        if offset < 0:
+            return Response({"error": "invalid limit or offset"}, status=400)
+        before = request.query_params.get("before")
+        after = request.query_params.get("after")
+        around = request.query_params.get("around")
+
+        if conversation_id:
+            conversation = Conversation.objects.filter(pk=conversation_id, is_group=True, members__user=user).first()
+            if conversation is None:
+                return Response(status=status.HTTP_404_NOT_FOUND)
+        elif other_user_id:
+            conversation = Conversation.objects.filter(key=Conversation.direct_key(user.id, other_user_id)).first()
+        else:
+            return Response({"error": "user_id or conversation_id is required"}, status=400)
 
-        if not other_user_id:
-            return Response({"error": "user_id is required"}, status=400)
+        if conversation is None:
+            all_messages = Message.objects.none()
+        else:
+            all_messages = Message.objects.filter(conversation=conversation).select_related("sender", "attachment")
 
-        all_messages = Message.objects.filter(
-            Q(sender=user, recipient__id=other_user_id) |
-            Q(sender__id=other_user_id, recipient=user)
-        ).order_by("-timestamp")
-        all_messages.update(is_read=True)
-        messages = all_messages[offset: offset + limit]
-        serialized = MessageSerializer(messages, many=True, context={"request": request})
-        return Response({"data": serialized.data, "friendName": User.objects.get(id=other_user_id).username})
+        # Kursory (timestamp, id) dają stały koszt strony niezależnie od głębokości,
+        # offset zostaje dla starszych klientów.
+        try:
+            if around:
+                # Skok do wyniku wyszukiwania: wiadomość w środku strony, kursory w obie strony
+                pivot = all_messages.filter(pk=int(around)).first()
+                if pivot is None:
+                    return Response(status=status.HTTP_404_NOT_FOUND)
+                pivot_cursor = encode_cursor(pivot.timestamp, pivot.id)
+                newer_count = limit // 2
+                older_count = max(0, limit - newer_count - 1)
+                newer = list(all_messages.filter(after_cursor(pivot_cursor)).order_by("timestamp", "id")[:newer_count])
+                newer.reverse()
+                older = list(
+                    all_messages.filter(before_cursor(pivot_cursor)).order_by("-timestamp", "-id")[:older_count + 1]
+                )
+                has_older = len(older) > older_count
+                page = newer + [pivot] + older[:older_count]
+            elif after:
+                page = list(all_messages.filter(after_cursor(after)).order_by("timestamp", "id")[:limit])
+                page.reverse()
+                has_older = bool(page)
+            else:
+                messages = all_messages.order_by("-timestamp", "-id")
+                if before:
+                    page = list(messages.filter(before_cursor(before))[:limit + 1])
+                else:
+                    page = list(messages[offset: offset + limit + 1])
+                if conversation is not None and len(page) <= limit and not offset:
+                    # Baza skończyła się przed końcem strony - starsze miesiące leżą w archiwum
+                    if page:
+                        oldest = (page[-1].timestamp, page[-1].id)
+                    else:
+                        oldest = decode_cursor(before) if before else None
+                    page += archived_history(conversation.id, oldest, limit + 1 - len(page))
+                has_older = len(page) > limit
+                page = page[:limit]
+        except (InvalidCursor, ValueError):
+            return Response({"error": "invalid cursor"}, status=400)
+
+        # Starsze strony i skok w środek historii nie przesuwają znacznika odczytu
+        if page and not (before or around) and conversation.is_group:
+            Conversation.objects.mark_group_read(user, conversation.id, page[0].id)
+        elif page and not (before or around) and Conversation.objects.mark_read(
+            user, other_user_id, page[0].id, since=page[0].timestamp
+        ):
+            async_to_sync(get_channel_layer().group_send)(
+                f"user_{other_user_id}",
+                {
+                    "type": "chat.read",
+                    "read": {"chat_id": user.id, "last_read_id": page[0].id},
+                }
+            )
+
+        serialized = MessageSerializer(page, many=True, context={"request": request})
+        return Response({
+            "data": serialized.data,
+            "friendName": conversation.title if conversation_id else User.objects.get(id=other_user_id).username,
+            "conversationId": conversation.id if conversation else None,
+            "nextCursor": encode_cursor(page[-1].timestamp, page[-1].id) if has_older else None,
+            "prevCursor": encode_cursor(page[0].timestamp, page[0].id) if page else after,
+        })
 
 
 @api_view(['GET'])
@@ -122,22 +214,30 @@ class RespondToFriendRequestView(APIView):
     permission_classes = [IsAuthenticated]
 
     def patch(self, request, pk):
-        try:
-            fr = FriendRequest.objects.get(pk=pk)
-        except FriendRequest.DoesNotExist:
-            return Response(status=status.HTTP_404_NOT_FOUND)
-
-        fr.status = FriendRequest.Status.ACCEPTED
-        fr.save()
+        with transaction.atomic():
+            # Zaakceptować może tylko adresat i tylko oczekujące zaproszenie
+            fr = FriendRequest.objects.select_for_update().filter(pk=pk, to_user=request.user).first()
+            if fr is None:
+                return Response(status=status.HTTP_404_NOT_FOUND)
+            if fr.status != FriendRequest.Status.PENDING:
+                return Response({"error": "request is not pending"}, status=status.HTTP_400_BAD_REQUEST)
+            fr.status = FriendRequest.Status.ACCEPTED
+            fr.save()
+            add_friendship(fr.from_user_id, fr.to_user_id)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     def delete(self, request, pk):
-        try:
-            fr = FriendRequest.objects.get(pk=pk)
-        except FriendRequest.DoesNotExist:
+        # Odrzucenie, wycofanie albo usunięcie znajomości - tylko przez jedną ze stron
+        fr = FriendRequest.objects.filter(
+            Q(from_user=request.user) | Q(to_user=request.user), pk=pk
+        ).first()
+        if fr is None:
             return Response(status=status.HTTP_404_NOT_FOUND)
 
-        deleted_count, _ = fr.delete()
+        with transaction.atomic():
+            deleted_count, _ = fr.delete()
+            if deleted_count and fr.status == FriendRequest.Status.ACCEPTED:
+                remove_friendship(fr.from_user_id, fr.to_user_id)
 
         if deleted_count:
             return Response(status=status.HTTP_204_NO_CONTENT)
@@ -149,8 +249,11 @@ class FriendRequestsView(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
-        received = FriendRequest.objects.filter(to_user=request.user, status=FriendRequest.Status.PENDING)
-        sent = FriendRequest.objects.filter(from_user=request.user, status=FriendRequest.Status.PENDING)
+        pending = FriendRequest.objects.filter(
+            status=FriendRequest.Status.PENDING
+        ).select_related("from_user", "to_user")
+        received = pending.filter(to_user=request.user)
+        sent = pending.filter(from_user=request.user)
         return Response({
             "received": FriendRequestSerializer(received, many=True).data,
             "sent": FriendRequestSerializer(sent, many=True).data
@@ -162,20 +265,20 @@ class FriendsListView(APIView):
 
     def get(self, request):
         user = request.user
-        friendships = FriendRequest.objects.filter(
-            Q(from_user=user) | Q(to_user=user),
-            status=FriendRequest.Status.ACCEPTED
-        )
-
-        friend_ids = set()
-        for fr in friendships:
-            if fr.from_user == user:
-                friend_ids.add(fr.to_user.id)
-            else:
-                friend_ids.add(fr.from_user.id)
+        friend_ids = get_friend_ids(user.id)
 
-        friends = User.objects.filter(id__in=friend_ids)
-        return Response(UserSerializer(friends, many=True, context={"request": request}).data)
+        summaries = ConversationMember.objects.filter(
+            user=user,
+            conversation__key__in=[Conversation.direct_key(user.id, friend_id) for friend_id in friend_ids],
+            conversation__members__user=OuterRef("pk"),
+        )
+        friends = User.objects.filter(id__in=friend_ids).annotate(
+            last_message_preview=Subquery(summaries.values("conversation__last_message_preview")[:1]),
+            last_message_at=Subquery(summaries.values("conversation__last_message_at")[:1]),
+            unread_count=Subquery(summaries.values("unread_count")[:1]),
+        )
+        context = {"request": request, "online_ids": get_online_ids(friend_ids)}
+        return Response(UserSerializer(friends, many=True, context=context).data)
 
 
 class RemoveFriendView(APIView):
@@ -183,47 +286,279 @@ class RemoveFriendView(APIView):
 
     def delete(self, request, user_id):
         user = request.user
+        if not are_friends(user.id, user_id):
+            return Response(status=status.HTTP_404_NOT_FOUND)
+
+        with transaction.atomic():
+            FriendRequest.objects.filter(
+                status=FriendRequest.Status.ACCEPTED
+            ).filter(
+                (Q(from_user=user) & Q(to_user_id=user_id)) |
+                (Q(from_user_id=user_id) & Q(to_user=user))
+            ).delete()
+            remove_friendship(user.id, user_id)
+
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+def _user_ids(value):
+    # Zbiór id z ciała żądania albo None, gdy to nie lista liczb
+    if not isinstance(value, list):
+        return None
+    try:
+        return {int(user_id) for user_id in value}
+    except (TypeError, ValueError):
+        return None
+
+
+class GroupListView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        memberships = ConversationMember.objects.filter(
+            user=request.user, conversation__is_group=True
+        ).with_unread().select_related("conversation").order_by("-conversation__last_message_at")
+        return Response(GroupSerializer(memberships, many=True).data)
+
+    def post(self, request):
+        user = request.user
+        title = (request.data.get("title") or "").strip()
+        member_ids = _user_ids(request.data.get("userIds", []))
+        if member_ids is None:
+            return Response({"error": "userIds must be a list of user ids"}, status=status.HTTP_400_BAD_REQUEST)
+        if not title:
+            return Response({"error": "title is required"}, status=status.HTTP_400_BAD_REQUEST)
+        if not member_ids <= get_friend_ids(user.id):
+            return Response({"error": "Można dodać tylko znajomych"}, status=status.HTTP_400_BAD_REQUEST)
+
         try:
-            friend = User.objects.get(id=user_id)
-        except User.DoesNotExist:
+            conversation = create_group(user, title, member_ids)
+        except GroupError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        membership = ConversationMember.objects.with_unread().select_related("conversation").get(
+            conversation=conversation, user=user
+        )
+        return Response(GroupSerializer(membership).data, status=status.HTTP_201_CREATED)
+
+
+class GroupMembersView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, conversation_id):
+        if request.user.id not in get_member_ids(conversation_id):
             return Response(status=status.HTTP_404_NOT_FOUND)
+        # Stan odczytu każdego członka - w grupach nie jest rozsyłany na żywo
+        members = ConversationMember.objects.filter(conversation_id=conversation_id).values(
+            "user_id", "user__username", "last_read_message_id"
+        )
+        return Response([{
+            "id": member["user_id"],
+            "username": member["user__username"],
+            "lastReadId": member["last_read_message_id"],
+        } for member in members])
 
-        deleted_count, _ = FriendRequest.objects.filter(
-            status=FriendRequest.Status.ACCEPTED
-        ).filter(
-            (Q(from_user=user) & Q(to_user=friend)) |
-            (Q(from_user=friend) & Q(to_user=user))
-        ).delete()
+    def post(self, request, conversation_id):
+        user = request.user
+        if user.id not in get_member_ids(conversation_id):
+            return Response(status=status.HTTP_404_NOT_FOUND)
+        user_ids = _user_ids(request.data.get("userIds", []))
+        if user_ids is None:
+            return Response({"error": "userIds must be a list of user ids"}, status=status.HTTP_400_BAD_REQUEST)
+        if not user_ids <= get_friend_ids(user.id):
+            return Response({"error": "Można dodać tylko znajomych"}, status=status.HTTP_400_BAD_REQUEST)
 
-        if deleted_count:
-            return Response(status=status.HTTP_204_NO_CONTENT)
-        else:
+        try:
+            added = add_members(conversation_id, user_ids)
+        except GroupError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({"added": sorted(added)})
+
+    def delete(self, request, conversation_id, user_id):
+        user = request.user
+        if user.id not in get_member_ids(conversation_id):
+            return Response(status=status.HTTP_404_NOT_FOUND)
+        # Wyjść może każdy, usuwać innych tylko założyciel grupy
+        if user_id != user.id and not Conversation.objects.filter(pk=conversation_id, created_by=user).exists():
+            return Response(status=status.HTTP_403_FORBIDDEN)
+        if not remove_member(conversation_id, user_id):
             return Response(status=status.HTTP_404_NOT_FOUND)
+        return Response(status=status.HTTP_204_NO_CONTENT)
 
 
 class UserSearchView(APIView):
     permission_classes = [IsAuthenticated]
+    MAX_LIMIT = 50
 
     def get(self, request):
-        query = request.GET.get("q", "")
+        query = request.GET.get("q", "").strip()
         if not query:
             return Response([])
 
-        users = User.objects.filter(username__icontains=query).exclude(id=request.user.id)
-        results = []
+        user = request.user
+        try:
+            limit = parse_limit(request.GET.get("limit"), 20, self.MAX_LIMIT)
+        except ValueError:
+            return Response({"error": "invalid limit"}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Indeks trigramowy nie pomaga dla 1-2 znaków, wtedy wystarcza prefiks
+        if len(query) < 3:
+            matches = Q(username__istartswith=query)
+        else:
+            matches = Q(username__icontains=query)
+
+        users = User.objects.filter(matches).exclude(id=user.id).annotate(
+            rank=Case(
+                When(username__iexact=query, then=Value(0)),
+                When(username__istartswith=query, then=Value(1)),
+                default=Value(2),
+            ),
+            request_sent=Exists(FriendRequest.objects.filter(
+                from_user=user, to_user=OuterRef("pk"), status=FriendRequest.Status.PENDING
+            )),
+            request_received=Exists(FriendRequest.objects.filter(
+                from_user=OuterRef("pk"), to_user=user, status=FriendRequest.Status.PENDING
+            )),
+        ).order_by("rank", "username")
+
+        cursor = request.GET.get("cursor")
+        if cursor:
+            try:
+                rank, username = decode_search_cursor(cursor)
+            except InvalidCursor:
+                return Response({"error": "invalid cursor"}, status=status.HTTP_400_BAD_REQUEST)
+            users = users.filter(Q(rank__gt=rank) | Q(rank=rank, username__gt=username))
+
+        page = list(users.values("id", "username", "rank", "request_sent", "request_received")[:limit + 1])
+        friend_ids = get_friend_ids(user.id)
+        results = [{
+            "id": found["id"],
+            "username": found["username"],
+            "requestSent": found["request_sent"],
+            "requestReceived": found["request_received"],
+            "isFriend": found["id"] in friend_ids,
+        } for found in page[:limit]]
+
+        response = Response(results)
+        if len(page) > limit:
+            last = page[limit - 1]
+            response["X-Next-Cursor"] = encode_search_cursor(last["rank"], last["username"])
+        return response
+
+
+class MessageSearchView(APIView):
+    permission_classes = [IsAuthenticated]
+    MAX_LIMIT = 50
+    MAX_TERMS = 8
 
-        for user in users:
-            request_sent = FriendRequest.objects.filter(from_user=request.user, to_user=user, status=FriendRequest.Status.PENDING).exists()
-            request_received = FriendRequest.objects.filter(from_user=user, to_user=request.user, status=FriendRequest.Status.PENDING).exists()
+    def get(self, request):
+        user = request.user
+        # Każde słowo jako prefiks - bez stemmera "spotkanie" ma znaleźć też "spotkania"
+        terms = re.findall(r"\w+", request.GET.get("q", ""))[:self.MAX_TERMS]
+        if not terms:
+            return Response({"data": [], "nextCursor": None})
+        try:
+            limit = parse_limit(request.GET.get("limit"), 20, self.MAX_LIMIT)
+        except ValueError:
+            return Response({"error": "invalid limit"}, status=status.HTTP_400_BAD_REQUEST)
+        query = SearchQuery(
+            " & ".join(f"{term}:*" for term in terms), search_type="raw", config=Message.SEARCH_CONFIG
+        )
 
+        conversations = ConversationMember.objects.filter(user=user).values("conversation_id")
+        if request.GET.get("conversation_id"):
+            conversations = conversations.filter(conversation_id=request.GET["conversation_id"])
+        elif request.GET.get("user_id"):
+            conversations = conversations.filter(
+                conversation__key=Conversation.direct_key(user.id, request.GET["user_id"])
+            )
+
+        hits = Message.objects.filter(conversation_id__in=conversations, search_vector=query).annotate(
+            # ts_rank zwraca real; rzutowanie daje wartość, którą kursor odtworzy co do bitu
+            rank=Cast(SearchRank(F("search_vector"), query), FloatField()),
+        )
+        cursor = request.GET.get("cursor")
+        if cursor:
+            try:
+                rank, pk = decode_rank_cursor(cursor)
+            except InvalidCursor:
+                return Response({"error": "invalid cursor"}, status=status.HTTP_400_BAD_REQUEST)
+            hits = hits.filter(Q(rank__lt=rank) | Q(rank=rank, id__lt=pk))
+
+        page = list(hits.order_by("-rank", "-id").values(
+            "id", "rank", "conversation_id", "sender_id", "recipient_id", "timestamp"
+        )[:limit + 1])
+
+        # Fragmenty i nazwy osobnym zapytaniem tylko dla strony - ts_headline jest drogie
+        details = {
+            message["id"]: message
+            for message in Message.objects.filter(id__in=[hit["id"] for hit in page[:limit]]).annotate(
+                snippet=SearchHeadline(
+                    "content", query, config=Message.SEARCH_CONFIG,
+                    start_sel="<b>", stop_sel="</b>", max_words=20, min_words=8,
+                )
+            ).values("id", "snippet", "sender__username", "conversation__is_group", "conversation__title")
+        }
+        results = []
+        for hit in page[:limit]:
+            message = details[hit["id"]]
+            is_group = message["conversation__is_group"]
             results.append({
-                "id": user.id,
-                "username": user.username,
-                "requestSent": request_sent,
-                "requestReceived": request_received
+                "id": hit["id"],
+                "conversationId": hit["conversation_id"],
+                "isGroup": is_group,
+                "title": message["conversation__title"] if is_group else None,
+                # Rozmówca w czacie 1:1 - do ChatHistoryView?user_id=...&around=id
+                "chatId": None if is_group else (
+                    hit["recipient_id"] if hit["sender_id"] == user.id else hit["sender_id"]
+                ),
+                "senderId": hit["sender_id"],
+                "senderName": message["sender__username"],
+                "snippet": message["snippet"],
+                "timestamp": hit["timestamp"].isoformat(),
             })
 
-        return Response(results)
+        last = page[limit - 1] if len(page) > limit else None
+        return Response({
+            "data": results,
+            "nextCursor": encode_rank_cursor(last["rank"], last["id"]) if last else None,
+        })
+
+
+class MediaView(APIView):
+    # Dostęp przez JWT albo podpisany link wygenerowany dla konkretnego uczestnika
+    permission_classes = [AllowAny]
+
+    def get(self, request, message_id):
+        if request.user.is_authenticated:
+            user_id = request.user.id
+        else:
+            user_id = signed_media_user(request.query_params.get("sig"), message_id)
+        if user_id is None:
+            return Response(status=status.HTTP_401_UNAUTHORIZED)
+
+        message = Message.objects.filter(
+            pk=message_id, conversation__members__user_id=user_id, attachment__isnull=False
+        ).select_related("attachment").first()
+        if message is not None:
+            attachment = message.attachment
+        else:
+            # Wiadomość mogła już trafić do archiwum; dostęp nadal tylko dla członków rozmowy
+            archived = find_archived_attachment(message_id)
+            if archived is None or not ConversationMember.objects.filter(
+                conversation_id=archived[0], user_id=user_id
+            ).exists():
+                return Response(status=status.HTTP_404_NOT_FOUND)
+            attachment = Attachment.objects.filter(pk=archived[1]).first()
+            if attachment is None:
+                return Response(status=status.HTTP_404_NOT_FOUND)
+        if request.query_params.get("variant") == "thumbnail":
+            field_file, etag = attachment.thumbnail, f"{attachment.sha256}-t"
+        else:
+            field_file, etag = attachment.file, attachment.sha256
+        if not field_file:
+            return Response(status=status.HTTP_404_NOT_FOUND)
+
+        return serve_media(request, field_file, etag)
 
 
 class UpdateFCMTokenView(APIView):
@@ -30,6 +30,11 @@ HOST = os.getenv("HOST", "192.168.0.130")
 
 ALLOWED_HOSTS = [HOST]
 
+MQTT_HOST = os.getenv("MQTT_HOST", HOST)
+MQTT_PORT = int(os.getenv("MQTT_PORT", 1883))
+MQTT_QUEUE_SIZE = int(os.getenv("MQTT_QUEUE_SIZE", 10000))
+NOTIFICATION_COALESCE_WINDOW = float(os.getenv("NOTIFICATION_COALESCE_WINDOW", 1.0))
+
 
 # Application definition
 
@@ -44,9 +49,11 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
 ]
 
 MIDDLEWARE = [
+    'comms_api.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -86,13 +93,17 @@ DATABASES = {
         'PASSWORD': 'secret',
         'HOST': 'db',
         'PORT': 5432,
+        # Żądania REST pod ASGI idą każde w nowym wątku, więc trwałego połączenia nikt by ponownie nie użył.
+        # Wątki DB_EXECUTOR mają własne DB_EXECUTOR_CONN_MAX_AGE.
+        'CONN_MAX_AGE': int(os.getenv("DB_CONN_MAX_AGE", 0)),
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'comms_api.authentication.CachedJWTAuthentication',
     )
 }
 
@@ -137,6 +148,66 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Redis na dane ulotne (obecność online); osobna baza od cache i channel layer
+REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/2")
+# Połączenie bez pingu dłużej niż PRESENCE_TTL sekund uznajemy za offline
+PRESENCE_TTL = int(os.getenv("PRESENCE_TTL", 60))
+
+# Maksymalna liczba wiadomości w odpowiedzi na akcję resume (reszta: has_more)
+RESUME_BATCH_SIZE = int(os.getenv("RESUME_BATCH_SIZE", 500))
+# Resume wysyła ponownie wiadomości z niższym id z tylu sekund przed potwierdzoną
+# (transakcje kończą się poza kolejnością id)
+RESUME_ACK_OVERLAP_SECONDS = float(os.getenv("RESUME_ACK_OVERLAP_SECONDS", 5))
+
+# Zdarzenia ulotne (typing/seen): min. odstęp na odbiorcę, ponowienie tego samego stanu,
+# budżet zdarzeń na sekundę na połączenie i wiek, po którym odbiorca je odrzuca
+EPHEMERAL_MIN_INTERVAL = float(os.getenv("EPHEMERAL_MIN_INTERVAL", 0.5))
+EPHEMERAL_REFRESH = float(os.getenv("EPHEMERAL_REFRESH", 3))
+EPHEMERAL_RATE = float(os.getenv("EPHEMERAL_RATE", 5))
+EPHEMERAL_MAX_AGE = float(os.getenv("EPHEMERAL_MAX_AGE", 3))
+
+# Limity na użytkownika (kubełki żetonów w Redisie): żetony na sekundę i pojemność kubełka.
+# send_message ma własny budżet, pozostałe akcje wspólny, załączniki liczone w bajtach.
+RATE_LIMIT_MESSAGES_PER_SECOND = float(os.getenv("RATE_LIMIT_MESSAGES_PER_SECOND", 5))
+RATE_LIMIT_MESSAGES_BURST = float(os.getenv("RATE_LIMIT_MESSAGES_BURST", 30))
+RATE_LIMIT_ACTIONS_PER_SECOND = float(os.getenv("RATE_LIMIT_ACTIONS_PER_SECOND", 20))
+RATE_LIMIT_ACTIONS_BURST = float(os.getenv("RATE_LIMIT_ACTIONS_BURST", 60))
+RATE_LIMIT_UPLOAD_BYTES_PER_SECOND = float(os.getenv("RATE_LIMIT_UPLOAD_BYTES_PER_SECOND", 2 * 1024 * 1024))
+RATE_LIMIT_UPLOAD_BYTES_BURST = float(os.getenv("RATE_LIMIT_UPLOAD_BYTES_BURST", 20 * 1024 * 1024))
+# Więcej niż RATE_LIMIT_ABUSE_DENIALS odmów w oknie RATE_LIMIT_ABUSE_WINDOW sekund zamyka połączenie
+RATE_LIMIT_ABUSE_DENIALS = int(os.getenv("RATE_LIMIT_ABUSE_DENIALS", 50))
+RATE_LIMIT_ABUSE_WINDOW = float(os.getenv("RATE_LIMIT_ABUSE_WINDOW", 10))
+
+# Pula wątków na zapytania z ChatConsumer; ostrzeżenie w logu, gdy kolejka jest głębsza
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", 8))
+DB_EXECUTOR_WARN_QUEUE = int(os.getenv("DB_EXECUTOR_WARN_QUEUE", 50))
+# Czas życia (s) połączeń trzymanych przez wątki tej puli
+DB_EXECUTOR_CONN_MAX_AGE = int(os.getenv("DB_EXECUTOR_CONN_MAX_AGE", 60))
+
+# /metrics wymaga nagłówka "Authorization: Bearer <token>"; bez tokenu endpoint zwraca 404
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+# Okno (s), w którym zdarzenia dla klienta msgpack są zbierane w jedną ramkę
+WS_BATCH_WINDOW = float(os.getenv("WS_BATCH_WINDOW", 0.01))
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": os.getenv("REDIS_CACHE_URL", "redis://redis:6379/1"),
+    }
+}
+
+FRIEND_IDS_CACHE_TTL = int(os.getenv("FRIEND_IDS_CACHE_TTL", 3600))
+
+GROUP_MAX_MEMBERS = int(os.getenv("GROUP_MAX_MEMBERS", 500))
+GROUP_MEMBERS_CACHE_TTL = int(os.getenv("GROUP_MEMBERS_CACHE_TTL", 3600))
+
+# Użytkownik z tokena JWT: Redis wspólny dla procesów, lokalny LRU z krótkim TTL
+# (inne procesy nie dostają unieważnienia, więc zmiana hasła działa tu z opóźnieniem do TTL)
+AUTH_USER_CACHE_TTL = int(os.getenv("AUTH_USER_CACHE_TTL", 300))
+AUTH_USER_LOCAL_CACHE_TTL = float(os.getenv("AUTH_USER_LOCAL_CACHE_TTL", 5))
+AUTH_USER_LOCAL_CACHE_SIZE = int(os.getenv("AUTH_USER_LOCAL_CACHE_SIZE", 10000))
+
 
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/5.2/howto/static-files/
@@ -146,6 +217,32 @@ STATIC_URL = 'static/'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Adres, pod którym aplikacja widzi serwer (linki do załączników w zdarzeniach ws)
+PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", f"http://{HOST}:8000")
+MEDIA_CACHE_MAX_AGE = int(os.getenv("MEDIA_CACHE_MAX_AGE", 365 * 24 * 3600))
+# Ważność podpisanych linków do załączników; w oknie MEDIA_URL_STABLE_FOR link jest ten sam
+MEDIA_URL_MAX_AGE = int(os.getenv("MEDIA_URL_MAX_AGE", 7 * 24 * 3600))
+MEDIA_URL_STABLE_FOR = int(os.getenv("MEDIA_URL_STABLE_FOR", 24 * 3600))
+# np. "/protected-media/" dla nginx (location internal) albo X-Sendfile dla Apache/lighttpd
+MEDIA_ACCEL_REDIRECT_PREFIX = os.getenv("MEDIA_ACCEL_REDIRECT_PREFIX", "")
+MEDIA_USE_X_SENDFILE = bool(os.getenv("MEDIA_USE_X_SENDFILE", ""))
+
+THUMBNAIL_SIZE = int(os.getenv("THUMBNAIL_SIZE", 480))
+THUMBNAIL_WORKERS = int(os.getenv("THUMBNAIL_WORKERS", 2))
+
+UPLOAD_TEMP_DIR = MEDIA_ROOT / 'uploads'
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", 50 * 1024 * 1024))
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", 256 * 1024))
+# Niedokończony upload wygasa po UPLOAD_TTL_HOURS (sprząta go sweep_uploads); limit otwartych na użytkownika
+UPLOAD_TTL_HOURS = int(os.getenv("UPLOAD_TTL_HOURS", 24))
+MAX_OPEN_UPLOADS = int(os.getenv("MAX_OPEN_UPLOADS", 5))
+
+# Wiadomości są partycjonowane miesięcznie; partycje zakładane są z wyprzedzeniem,
+# a starsze niż okres retencji trafiają do skompresowanych plików archiwum poza bazą
+MESSAGE_PARTITIONS_AHEAD = int(os.getenv("MESSAGE_PARTITIONS_AHEAD", 3))
+MESSAGE_RETENTION_MONTHS = int(os.getenv("MESSAGE_RETENTION_MONTHS", 12))
+MESSAGE_ARCHIVE_DIR = Path(os.getenv("MESSAGE_ARCHIVE_DIR", BASE_DIR / 'archive'))
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
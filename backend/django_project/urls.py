@@ -18,11 +18,12 @@ from django.contrib import admin
 from django.conf import settings
 from django.conf.urls.static import static
 from django.urls import path
+from comms_api.metrics import metrics_view
 from comms_api.views import (
     RegisterView, LoginView, RefreshTokenView, ChatHistoryView,
     livekit_token_view, SendFriendRequestView, RespondToFriendRequestView,
     FriendRequestsView, FriendsListView, RemoveFriendView, UserSearchView,
-    UpdateFCMTokenView
+    UpdateFCMTokenView, MediaView, GroupListView, GroupMembersView, MessageSearchView
 )
 
 urlpatterns = [
@@ -35,8 +36,15 @@ urlpatterns = [
     path('api/livekit-token/', livekit_token_view),
 
     path("api/chat/history/", ChatHistoryView.as_view()),
+    path("api/groups/", GroupListView.as_view(), name="groups"),
+    path("api/groups/<int:conversation_id>/members/", GroupMembersView.as_view(), name="group_members"),
+    path(
+        "api/groups/<int:conversation_id>/members/<int:user_id>/", GroupMembersView.as_view(), name="group_member"
+    ),
+    path("api/media/<int:message_id>/", MediaView.as_view(), name="media"),
 
     path("api/users/search/", UserSearchView.as_view(), name="user-search"),
+    path("api/messages/search/", MessageSearchView.as_view(), name="message-search"),
 
     path("api/friends/", FriendsListView.as_view(), name="friends_list"),
     path("api/friends/request/", SendFriendRequestView.as_view(), name="send_friend_request"),
@@ -45,6 +53,8 @@ urlpatterns = [
     path("api/friends/remove/<int:user_id>/", RemoveFriendView.as_view(), name="remove_friend"),
 
     path("api/fcm/update/", UpdateFCMTokenView.as_view(), name="update-fcm"),
+
+    path("metrics", metrics_view, name="metrics"),
 ]
 if settings.DEBUG:
     urlpatterns += static(settings.MEDIA_URL,